@@ -0,0 +1,217 @@
+import argparse
+import csv
+import json
+import sys
+import time
+from contextlib import nullcontext
+from itertools import islice
+from multiprocessing import Pool
+
+from shapely.geometry import MultiLineString, mapping
+
+from instrumentation import Recorder, recording, save_outputs, stage
+from pipeline import default_radius, evacuation_routes, preload
+from shared_pool import DatasetPool, attach
+
+csv_fields = ['id', 'x', 'y', 'highest_x', 'highest_y', 'start_node', 'end_node', 'travel_time', 'status']
+
+
+def read_locations(path, crs):
+    """Read the locations of residents one by one, without loading the whole file.
+
+    :param path: string
+        A CSV file with the columns x, y (BNG) or lat, lon (WGS84) and an optional id,
+        a GeoJSON file of points, or a GeoJSON lines file with one point feature per line
+    :param crs: string
+        The crs of locations, 'BNG' or 'WGS84'
+    :return: generator
+        tuple(id, x, y) for each location, where x, y are latitude, longitude for WGS84
+    """
+    if path.endswith('.csv'):
+        x_field, y_field = ('lat', 'lon') if crs == 'WGS84' else ('x', 'y')
+        with open(path, 'r', newline='') as f:
+            for n, row in enumerate(csv.DictReader(f)):
+                yield row.get('id', n), float(row[x_field]), float(row[y_field])
+        return
+
+    if path.endswith('.geojson') or path.endswith('.json'):
+        with open(path, 'r') as f:
+            features = json.load(f)['features']
+    else:  # GeoJSON lines
+        features = (json.loads(line) for line in open(path, 'r') if line.strip())
+    for n, feature in enumerate(features):
+        x, y = feature['geometry']['coordinates'][:2]
+        if crs == 'WGS84':  # GeoJSON stores longitude first
+            x, y = y, x
+        yield feature.get('properties', {}).get('id', n), x, y
+
+
+def chunked(iterable, size):
+    """Split an iterable into lists of the given size.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def route_chunk(task):
+    """Route a chunk of locations; this runs in worker processes.
+
+    :param task: tuple(chunk, crs, radius, geometry, use_targets, recorder_origin, engine)
+        recorder_origin is None, or the origin of the recorder of the main process when the stages of
+        a worker process are recorded; engine is passed to evacuation_routes()
+    :return results: list
+        The results of evacuation_routes() with the id of each location
+    :return stages: list or None
+        The stages recorded in the worker process
+    """
+    chunk, crs, radius, geometry, use_targets, recorder_origin, engine = task
+    # A worker process records into its own recorder and returns the stages with the results
+    recorder = Recorder(memory=False, origin=recorder_origin) if recorder_origin is not None else None
+    with recording(recorder) if recorder is not None else nullcontext(), stage('route chunk'):
+        ids, xs, ys = zip(*chunk)
+        results = evacuation_routes(xs, ys, crs, radius, geometry, use_targets, engine)
+        for location_id, result in zip(ids, results):
+            result['id'] = location_id
+            if geometry:
+                path_gdf = result.pop('geometry', None)
+                result['geometry'] = mapping(MultiLineString(list(path_gdf['geometry']))) \
+                    if path_gdf is not None and len(path_gdf) else None
+    return results, recorder.stages if recorder is not None else None
+
+
+def write_results(results, out, output_format):
+    """Write the results of a chunk to the output stream.
+
+    :param results: list
+        The results of a chunk returned by route_chunk()
+    :param out: file
+        The output stream
+    :param output_format: string
+        'csv' or 'geojsonl'
+    """
+    if output_format == 'csv':
+        writer = csv.DictWriter(out, fieldnames=csv_fields, extrasaction='ignore')
+        writer.writerows(results)
+    else:
+        for result in results:
+            properties = {key: value for key, value in result.items() if key != 'geometry'}
+            feature = {'type': 'Feature', 'geometry': result.get('geometry'), 'properties': properties}
+            out.write(json.dumps(feature) + '\n')
+    out.flush()
+
+
+def run_batch(input_path, output_path=None, crs='BNG', radius=default_radius, chunk_size=500, processes=1,
+              output_format=None, use_targets=False, recorder=None, shared=False):
+    """Stream the locations of residents through the evacuation pipeline and write the routes.
+
+    :param input_path: string
+        The file of locations, see read_locations()
+    :param output_path: string or None
+        The output file; None for the standard output
+    :param crs: string
+        The crs of locations, 'BNG' or 'WGS84'
+    :param radius: int or float
+        The radius of searching the highest point; use meter as unit
+    :param chunk_size: int
+        The number of locations routed together
+    :param processes: int
+        The number of worker processes; 1 to run in this process
+    :param output_format: string or None
+        'csv' or 'geojsonl'; None to choose by the extension of the output file
+    :param use_targets: bool
+        Read the highest points from the precomputed target raster, see target_raster.py
+    :param recorder: instrumentation.Recorder or None
+        Record the stages of the batch; worker processes record their time and counts but not memory or profiles
+    :param shared: bool
+        Route over the CSR graph, with the datasets of the worker processes attached from one
+        shared_pool.DatasetPool instead of loaded by each of them
+    :return: dictionary
+        The number of locations and routes, the elapsed seconds and the routes per second
+    """
+    if output_format is None:
+        output_format = 'csv' if output_path and output_path.endswith('.csv') else 'geojsonl'
+    geometry = output_format == 'geojsonl'
+    recorder_origin = recorder.origin if recorder is not None and processes > 1 else None
+    engine = 'csr' if shared else 'networkx'
+    tasks = ((chunk, crs, radius, geometry, use_targets, recorder_origin, engine)
+             for chunk in chunked(read_locations(input_path, crs), chunk_size))
+
+    start_time = time.perf_counter()
+    location_num = 0
+    route_num = 0
+    out = open(output_path, 'w', newline='') if output_path else sys.stdout
+    dataset_pool = DatasetPool() if shared and processes > 1 else None
+    if dataset_pool is not None:
+        pool = Pool(processes, initializer=attach, initargs=(dataset_pool.create(),))
+    else:
+        # Build the derived data once in this process; the worker processes then find it in the cache
+        # instead of all building it at the same time, and forked workers inherit the loaded datasets
+        with recording(recorder), stage('preload'):
+            preload()
+        pool = Pool(processes, initializer=preload) if processes > 1 else None
+    try:
+        with recording(recorder):
+            if output_format == 'csv':
+                csv.DictWriter(out, fieldnames=csv_fields).writeheader()
+            if pool is None:
+                chunk_results = map(route_chunk, tasks)
+            else:
+                chunk_results = pool.imap(route_chunk, tasks)  # Keep the order of input
+            for results, stages in chunk_results:
+                if stages:
+                    recorder.extend(stages)
+                with stage('write results'):
+                    write_results(results, out, output_format)
+                location_num += len(results)
+                route_num += sum(result['status'] == 'ok' for result in results)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if dataset_pool is not None:
+            dataset_pool.close()
+        if out is not sys.stdout:
+            out.close()
+
+    elapsed = time.perf_counter() - start_time
+    return {'locations': location_num, 'routes': route_num, 'seconds': elapsed,
+            'routes_per_second': route_num / elapsed if elapsed > 0 else 0.0}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Route the locations of residents to the highest point '
+                                                 'within the radius without the GUI.')
+    parser.add_argument('input', help='CSV (x,y or lat,lon columns), GeoJSON or GeoJSON lines of locations')
+    parser.add_argument('-o', '--output', help='output file (.csv or .geojsonl); standard output by default')
+    parser.add_argument('--crs', choices=['BNG', 'WGS84'], default='BNG', help='CRS of the input locations')
+    parser.add_argument('--radius', type=float, default=default_radius, help='radius of the search in meters')
+    parser.add_argument('--chunk-size', type=int, default=500, help='locations routed together')
+    parser.add_argument('--processes', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--shared', action='store_true',
+                        help='route over the CSR graph with datasets shared by the worker processes')
+    parser.add_argument('--format', choices=['csv', 'geojsonl'], help='output format')
+    parser.add_argument('--targets', action='store_true',
+                        help='read the highest points from the target raster built by target_raster.py')
+    parser.add_argument('--stats', help='write the time, peak memory and counts of each stage as JSON')
+    parser.add_argument('--trace', help='write the stages in Chrome trace format')
+    parser.add_argument('--profile', help='write the cProfile statistics of the slowest stage')
+    args = parser.parse_args(argv)
+
+    recorder = None
+    if args.stats or args.trace or args.profile:
+        recorder = Recorder(memory=bool(args.stats or args.trace), profile=bool(args.profile))
+    summary = run_batch(args.input, args.output, args.crs, args.radius, args.chunk_size, args.processes, args.format,
+                        args.targets, recorder, args.shared)
+    print('Routed {routes} of {locations} locations in {seconds:.2f} s ({routes_per_second:.1f} routes/s)'
+          .format(**summary), file=sys.stderr)
+    if recorder is not None:
+        print(recorder.summary(), file=sys.stderr)
+        save_outputs(recorder, args.stats, args.trace, args.profile)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,355 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import time
+
+import numpy as np
+
+scales = {  # name: (elevation grid size, ITN grid size), the ITN has about 2 * size^2 links
+    'small': (400, 60),
+    'medium': (800, 120),
+    'large': (2000, 250),
+}
+cell_size = 50.0  # The cell size of the synthetic elevation grid; use meter as unit
+origin = (430000.0, 75000.0)  # The lower left corner of the synthetic dataset in British National Grid
+background_size = 500  # The width and height of the synthetic background map; use pixel as unit
+default_root = 'benchmark_data'
+default_repeat = 20
+stage_names = ['coordinate_transform', 'check_coordinate', 'identify_highest_point', 'get_nearest_itn_node',
+               'shortest_path', 'map_plot']
+
+
+def generate_elevation(root, size, seed=0):
+    """Write a synthetic elevation grid of rolling hills in the same format as SZ.asc.
+
+    :param root: string
+        The directory holding the Material folder
+    :param size: int
+        The width and height of the grid; use cell as unit
+    :param seed: int
+    :return: string
+        The path of the grid
+    """
+    import rasterio
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(seed)
+    rows, cols = np.mgrid[0:size, 0:size]
+    values = (60 * np.sin(cols / 37.0) * np.cos(rows / 23.0) + 40 * np.sin((cols + rows) / 51.0) + 100
+              + rng.random((size, size)) * 5).round(1).astype('float32')
+    path = os.path.join(root, 'Material/elevation/SZ.asc')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with rasterio.open(path, 'w', driver='AAIGrid', width=size, height=size, count=1, dtype='float32',
+                       transform=from_origin(origin[0], origin[1] + size * cell_size, cell_size, cell_size),
+                       crs='EPSG:27700', nodata=-9999) as dst:
+        dst.write(values, 1)
+    return path
+
+
+def generate_itn(root, size, grid_num, seed=0):
+    """Write a synthetic road network in the same format as solent_itn.json.
+    The nodes lie on a jittered grid, neighbours are joined by winding links and about 10% of the links are left out.
+
+    :param root: string
+        The directory holding the Material folder
+    :param size: int
+        The width and height of the elevation grid; use cell as unit
+    :param grid_num: int
+        The number of nodes along each side of the network
+    :param seed: int
+    :return: tuple(int, int)
+        The number of nodes and links
+    """
+    rng = np.random.default_rng(seed)
+    extent = size * cell_size
+    step = extent * 0.9 / grid_num
+
+    def node_id(i, j):
+        return 'osgb%016d' % (i * 10000 + j)
+
+    nodes = {}
+    for i in range(grid_num):
+        for j in range(grid_num):
+            nodes[node_id(i, j)] = {'coords': [origin[0] + extent * 0.05 + i * step + rng.random() * 5,
+                                               origin[1] + extent * 0.05 + j * step + rng.random() * 5]}
+    links = {}
+    ratios = np.linspace(0, 1, 6)[:, None]
+    for i in range(grid_num):
+        for j in range(grid_num):
+            for di, dj in ((1, 0), (0, 1)):
+                if i + di < grid_num and j + dj < grid_num and rng.random() > 0.1:
+                    start, end = node_id(i, j), node_id(i + di, j + dj)
+                    start_coords, end_coords = np.array(nodes[start]['coords']), np.array(nodes[end]['coords'])
+                    points = start_coords + (end_coords - start_coords) * ratios
+                    points[1:-1] += rng.normal(0, 10, (4, 2))
+                    length = float(np.sum(np.hypot(*np.diff(points, axis=0).T)))
+                    links['osgb%016d' % (5000000 + len(links))] = {'start': start, 'end': end, 'length': length,
+                                                                   'coords': points.tolist()}
+    path = os.path.join(root, 'Material/itn/solent_itn.json')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'roadnodes': nodes, 'roadlinks': links}, f)
+    return len(nodes), len(links)
+
+
+def generate_island(root, size):
+    """Write a synthetic island, a wavy ellipse in the middle of the elevation grid, as isle_of_wight.shp.
+
+    :param root: string
+        The directory holding the Material folder
+    :param size: int
+        The width and height of the elevation grid; use cell as unit
+    :return: shapely.geometry.Polygon
+    """
+    import geopandas as gpd
+    from shapely.geometry import Polygon
+
+    extent = size * cell_size
+    centre_x, centre_y = origin[0] + extent / 2, origin[1] + extent / 2
+    angles = np.linspace(0, 2 * np.pi, 200, endpoint=False)
+    radii = extent * 0.42 * (1 + 0.1 * np.sin(5 * angles))
+    island = Polygon(np.c_[centre_x + radii * np.cos(angles), centre_y + 0.7 * radii * np.sin(angles)])
+    path = os.path.join(root, 'Material/shape/isle_of_wight.shp')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    gpd.GeoDataFrame({'id': [1]}, geometry=[island], crs='EPSG:27700').to_file(path)
+    return island
+
+
+def generate_background(root, size, seed=0):
+    """Write a synthetic paletted background map covering the elevation grid as raster-50k_2724246.tif.
+
+    :param root: string
+        The directory holding the Material folder
+    :param size: int
+        The width and height of the elevation grid; use cell as unit
+    :param seed: int
+    :return: string
+        The path of the map
+    """
+    import rasterio
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(seed)
+    extent = size * cell_size
+    pixel_size = extent / background_size
+    path = os.path.join(root, 'Material/background/raster-50k_2724246.tif')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with rasterio.open(path, 'w', driver='GTiff', width=background_size, height=background_size, count=1,
+                       dtype='uint8', transform=from_origin(origin[0], origin[1] + extent, pixel_size, pixel_size),
+                       crs='EPSG:27700') as dst:
+        dst.write(rng.integers(0, 8, (background_size, background_size)).astype('uint8'), 1)
+        dst.write_colormap(1, {value: (value * 30 % 256, 255 - value * 30 % 256, 100, 255) for value in range(256)})
+    return path
+
+
+def generate_dataset(root, scale='small', seed=0):
+    """Generate every input of the application under root/Material, in the same layout as the real dataset.
+
+    :param root: string
+    :param scale: string
+        A key of scales
+    :param seed: int
+    :return: dict
+        A description of the dataset
+    """
+    size, grid_num = scales[scale]
+    generate_elevation(root, size, seed)
+    node_num, link_num = generate_itn(root, size, grid_num, seed)
+    generate_island(root, size)
+    generate_background(root, size, seed)
+    description = {'scale': scale, 'seed': seed, 'elevation_cells': size * size, 'itn_nodes': node_num,
+                   'itn_links': link_num}
+    with open(os.path.join(root, 'Material/benchmark_dataset.json'), 'w') as f:
+        json.dump(description, f)
+    return description
+
+
+def query_locations(island, count, seed=0):
+    """Pick random locations on the island for the queries.
+
+    :param island: shapely.geometry.Polygon
+    :param count: int
+    :param seed: int
+    :return: list[tuple(x, y)]
+    """
+    from shapely.geometry import Point
+
+    rng = np.random.default_rng(seed)
+    left, bottom, right, top = island.bounds
+    locations = []
+    while len(locations) < count:
+        x, y = rng.uniform(left, right), rng.uniform(bottom, top)
+        if island.contains(Point(x, y)):
+            locations.append((float(x), float(y)))
+    return locations
+
+
+def time_calls(function, arguments):
+    """Call a function once for each set of arguments and time every call, hiding what it prints.
+
+    :param function: callable
+    :param arguments: list[tuple]
+    :return: tuple(dict, list)
+        The statistics of timing and the results of calls.
+        'cold' is the first call, which includes loading the dataset, the others are summarised as warm calls.
+    """
+    durations = []
+    results = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for args in arguments:
+            start = time.perf_counter()
+            results.append(function(*args))
+            durations.append(time.perf_counter() - start)
+    warm = durations[1:] or durations
+    stats = {'calls': len(durations), 'cold': durations[0], 'warm_median': statistics.median(warm),
+             'warm_min': min(warm), 'warm_max': max(warm), 'total': sum(durations)}
+    return stats, results
+
+
+def run_benchmark(root=default_root, scale='small', seed=0, repeat=default_repeat, keep_cache=False, plot=True):
+    """Generate the synthetic dataset if needed, and time every stage of the pipeline separately.
+    The task modules read the Material folder relative to the working directory, so the benchmark runs inside root.
+
+    :param root: string
+        The directory of the synthetic dataset
+    :param scale: string
+        A key of scales
+    :param seed: int
+    :param repeat: int
+        The number of queries of each stage
+    :param keep_cache: bool
+        Reuse the derived data cached by an earlier run; otherwise the first call of a stage builds it from scratch
+    :param plot: bool
+        Time map_plot as well, which is much slower than the other stages
+    :return: dict
+    """
+    description_path = os.path.join(root, 'Material/benchmark_dataset.json')
+    description = None
+    if os.path.exists(description_path):
+        with open(description_path) as f:
+            description = json.load(f)
+    if description is None or description['scale'] != scale or description['seed'] != seed:
+        print('Generating the %s dataset in %s...' % (scale, root))
+        description = generate_dataset(root, scale, seed)
+    if not keep_cache:
+        shutil.rmtree(os.path.join(root, 'Material/cache'), ignore_errors=True)
+
+    import geopandas as gpd
+
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        from t1_user_input import check_coordinate, coordinate_transform
+        from t2_highest_point import identify_highest_point
+        from t3_nearest_itn import get_nearest_itn_node
+        from networkx import NetworkXNoPath
+        from t4_shortest_path import shortest_path
+        from t5_map_plotting import MapCanvas
+
+        island = gpd.read_file('Material/shape/isle_of_wight.shp').geometry[0]
+        locations = query_locations(island, repeat, seed)
+        results = {}
+
+        # The stages are chained like gui.run, so that every stage gets realistic input
+        results['coordinate_transform'], _ = time_calls(coordinate_transform,
+                                                        [('BNG', location) for location in locations])
+        results['check_coordinate'], _ = time_calls(check_coordinate, [(location,) for location in locations])
+        results['identify_highest_point'], highest = time_calls(identify_highest_point,
+                                                                [(location, 5000) for location in locations])
+        # Keep each location with its highest point, so that the later stages get matching pairs
+        located = [(location, result) for location, result in zip(locations, highest) if result is not None]
+        starts = [(location,) for location, _ in located]
+        ends = [((result[0], result[1]),) for _, result in located]
+        results['get_nearest_itn_node'], nodes = time_calls(get_nearest_itn_node, starts + ends)
+        node_pairs = list(zip(nodes[:len(starts)], nodes[len(starts):]))
+
+        def route(start_node, end_node):
+            try:
+                return shortest_path(start_node, end_node)
+            except NetworkXNoPath:  # The synthetic network leaves out some links, a few nodes may be cut off
+                return None
+        results['shortest_path'], paths = time_calls(route, node_pairs)
+        if plot:
+            plot_arguments = [(location, (result[0], result[1]), path, result[2], result[3], 1)
+                              for (location, result), path in zip(located, paths)
+                              if path is not None][:max(2, repeat // 4)]
+
+            map_canvas = MapCanvas()  # Rendered offscreen by Agg and reused like the map window of the GUI
+
+            def plot(*args):
+                map_canvas.update(*args)
+                map_canvas.draw()
+            results['map_plot'], _ = time_calls(plot, plot_arguments)
+    finally:
+        os.chdir(cwd)
+
+    return {'dataset': description, 'repeat': repeat, 'keep_cache': keep_cache,
+            'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                            'platform': platform.platform()},
+            'stages': {name: results[name] for name in stage_names if name in results}}
+
+
+def compare(result, baseline, tolerance=0.25, min_difference=0.001):
+    """Compare the warm median time of each stage with a baseline result.
+
+    :param result: dict
+        The result of run_benchmark
+    :param baseline: dict
+        An earlier result of run_benchmark
+    :param tolerance: float
+        The allowed slowdown, 0.25 means 25% slower
+    :param min_difference: float
+        Slowdowns smaller than this are timer noise rather than regressions; use second as unit
+    :return: list[string]
+        The stages slower than the baseline beyond the tolerance
+    """
+    regressions = []
+    for name, stats in result['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        old = baseline['stages'][name]['warm_median']
+        new = stats['warm_median']
+        print('%-24s %10.3f ms %10.3f ms %+7.1f%%' % (name, old * 1000, new * 1000, (new / old - 1) * 100))
+        if new > old * (1 + tolerance) and new - old > min_difference:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time every stage of the evacuation pipeline on synthetic data.')
+    parser.add_argument('--root', default=default_root, help='directory of the synthetic dataset')
+    parser.add_argument('--scale', default='small', choices=sorted(scales))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=default_repeat, help='number of queries of each stage')
+    parser.add_argument('--no-plot', action='store_true', help='skip timing map_plot')
+    parser.add_argument('--keep-cache', action='store_true', help='reuse the derived data cached by an earlier run')
+    parser.add_argument('--output', help='write the result as JSON to this file')
+    parser.add_argument('--baseline', help='compare with an earlier JSON result and fail on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown against the baseline')
+    args = parser.parse_args(argv)
+
+    result = run_benchmark(os.path.abspath(args.root), args.scale, args.seed, args.repeat, args.keep_cache,
+                           not args.no_plot)
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        if regressions:
+            print('Slower than the baseline: ' + ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,303 @@
+import heapq
+import math
+
+import networkx as nx
+import numpy as np
+
+from data_cache import load_cache, save_cache
+from t4_shortest_path import (closed_links, default_climb_penalty, default_walking_speed, get_gdf, graph_cache_key,
+                              load_itn_graph, open_network, shortest_path)
+
+hierarchy_cache_name = 'itn_contraction_hierarchy.pickle'
+hierarchy_cache_version = 1  # Bump when the structure of the cached hierarchy changes
+witness_settle_limit = 30  # The number of nodes a witness search may settle before giving up
+priority_settle_limit = 5  # The same limit when only estimating the priority of a node
+
+_hierarchy_memo = {}  # The hierarchies already loaded in this process, keyed by the key of the graph
+
+
+def build_contraction_hierarchy(itn_graph):
+    """Build a contraction hierarchy over the weighted graph of ITN.
+    Nodes are contracted one by one in the order of their priority: twice the edge difference (shortcuts added
+    minus edges removed) plus the number of contracted neighbours. Contracting a node adds a shortcut u -> x for
+    each pair of its in-neighbour u and out-neighbour x unless a witness search finds a path from u to x avoiding
+    the node which is at most as long, so the travel time between remaining nodes never changes.
+
+    :param itn_graph: networkx.DiGraph()
+        The graph of ITN returned by load_itn_graph()
+    :return: dictionary
+        'nodes': the fid of each node, 'rank': the contraction order of each node,
+        'forward': the upward out edges (to higher rank) of each node as lists of (node, weight),
+        'backward': the upward in edges (from higher rank) of each node as lists of (node, weight),
+        'middle': the middle node of each shortcut keyed by (node, node)
+    """
+    nodes = list(itn_graph)
+    node_index = {node: i for i, node in enumerate(nodes)}
+    node_num = len(nodes)
+    out_edges = [dict() for _ in range(node_num)]
+    in_edges = [dict() for _ in range(node_num)]
+    for u, v, weight in itn_graph.edges(data='weight'):
+        if u != v:
+            out_edges[node_index[u]][node_index[v]] = weight
+            in_edges[node_index[v]][node_index[u]] = weight
+    middle = {}
+    forward = [None] * node_num
+    backward = [None] * node_num
+    contracted = [False] * node_num
+    contracted_neighbours = [0] * node_num
+    rank = [0] * node_num
+
+    def witness_search(source, excluded, max_weight, targets, settle_limit):
+        # A Dijkstra search from the source among uncontracted nodes, stopped early
+        dist = {source: 0.0}
+        heap = [(0.0, source)]
+        remaining = set(targets)
+        settled_num = 0
+        while heap and remaining and settled_num < settle_limit:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            if d > max_weight:
+                break
+            remaining.discard(u)
+            settled_num += 1
+            for v, weight in out_edges[u].items():
+                if v == excluded:
+                    continue
+                if d + weight < dist.get(v, math.inf):
+                    dist[v] = d + weight
+                    heapq.heappush(heap, (d + weight, v))
+        return dist
+
+    def find_shortcuts(v, settle_limit=witness_settle_limit):
+        # The shortcuts needed when contracting v; tentative distances are lengths of real paths too
+        outs = list(out_edges[v].items())
+        ins = list(in_edges[v].items())
+        shortcuts = []
+        for u, in_weight in ins:
+            targets = [(x, out_weight) for x, out_weight in outs if x != u]
+            if not targets:
+                continue
+            dist = witness_search(u, v, in_weight + max(weight for x, weight in targets), [x for x, _ in targets],
+                                  settle_limit)
+            for x, out_weight in targets:
+                if dist.get(x, math.inf) > in_weight + out_weight:
+                    shortcuts.append((u, x, in_weight + out_weight))
+        return shortcuts, len(outs) + len(ins)
+
+    def priority(v):
+        shortcuts, edge_num = find_shortcuts(v, priority_settle_limit)
+        return 2 * (len(shortcuts) - edge_num) + contracted_neighbours[v]
+
+    # The queue of nodes by priority; entries whose priority is out of date are skipped
+    current_priority = [priority(v) for v in range(node_num)]
+    heap = [(current_priority[v], v) for v in range(node_num)]
+    heapq.heapify(heap)
+    order = 0
+    while heap:
+        old_priority, v = heapq.heappop(heap)
+        if contracted[v] or old_priority != current_priority[v]:
+            continue
+        # Lazy update: contract v only if it is still the best after recomputing its priority
+        new_priority = priority(v)
+        if heap and new_priority > heap[0][0]:
+            current_priority[v] = new_priority
+            heapq.heappush(heap, (new_priority, v))
+            continue
+        shortcuts, _ = find_shortcuts(v)
+        for u, x, weight in shortcuts:
+            if weight < out_edges[u].get(x, math.inf):
+                out_edges[u][x] = weight
+                in_edges[x][u] = weight
+                middle[(u, x)] = v
+        contracted[v] = True
+        rank[v] = order
+        order += 1
+        # The remaining edges of v go up the hierarchy; remove them from the graph of uncontracted nodes
+        forward[v] = list(out_edges[v].items())
+        backward[v] = list(in_edges[v].items())
+        for x in out_edges[v]:
+            del in_edges[x][v]
+        for u in in_edges[v]:
+            del out_edges[u][v]
+        out_edges[v], in_edges[v] = {}, {}
+        # The priority of neighbours changes with the edges around them
+        for neighbour in {x for x, _ in forward[v]} | {u for u, _ in backward[v]}:
+            contracted_neighbours[neighbour] += 1
+            current_priority[neighbour] = priority(neighbour)
+            heapq.heappush(heap, (current_priority[neighbour], neighbour))
+
+    return {'nodes': nodes, 'rank': rank, 'forward': forward, 'backward': backward, 'middle': middle}
+
+
+def load_contraction_hierarchy(walking_speed=default_walking_speed, climb_penalty=default_climb_penalty):
+    """Load the contraction hierarchy of the graph of ITN, building it only when no valid cache exists.
+    The cache is rebuilt whenever the cached graph is rebuilt. It always covers the whole network,
+    whatever links are closed.
+
+    :param walking_speed: float
+        The walking speed on flat ground; use meter/minute as unit
+    :param climb_penalty: float
+        The meters of climb which cost one additional minute
+    :return: dictionary
+        The hierarchy returned by build_contraction_hierarchy(), with 'node_index' mapping fid to index
+    """
+    key = '{}-{}'.format(graph_cache_key(walking_speed, climb_penalty), hierarchy_cache_version)
+    if key in _hierarchy_memo:
+        return _hierarchy_memo[key]
+
+    hierarchy = load_cache(hierarchy_cache_name, key)
+    if hierarchy is None:
+        itn_graph, itn_store = load_itn_graph(walking_speed, climb_penalty)
+        hierarchy = build_contraction_hierarchy(open_network(itn_graph))
+        save_cache(hierarchy_cache_name, key, hierarchy)
+    hierarchy['node_index'] = {node: i for i, node in enumerate(hierarchy['nodes'])}
+
+    _hierarchy_memo.clear()
+    _hierarchy_memo[key] = hierarchy
+    return hierarchy
+
+
+def unpack_edge(hierarchy, u, v):
+    """Replace a shortcut by the original edges it stands for.
+
+    :return: list
+        The indexes of nodes from u to v along original edges
+    """
+    middle = hierarchy['middle']
+    path = [u]
+    stack = [(u, v)]
+    while stack:
+        a, b = stack.pop()
+        if (a, b) in middle:
+            m = middle[(a, b)]
+            stack.append((m, b))
+            stack.append((a, m))
+        else:
+            path.append(b)
+    return path
+
+
+def ch_query(hierarchy, start_node, end_node):
+    """Search the shortest path by a bidirectional Dijkstra search which only goes up the hierarchy.
+
+    :param hierarchy: dictionary
+        The hierarchy returned by load_contraction_hierarchy()
+    :param start_node: string
+        This is the fid of start node in ITN
+    :param end_node: string
+        This is the fid of end node in ITN
+    :return travel_time: float
+        The travel time of the path; use minute as unit
+    :return path: list
+        The sequence of fid of nodes constructing the path, along original edges
+    """
+    node_index = hierarchy['node_index']
+    source, target = node_index[start_node], node_index[end_node]
+    if source == target:
+        return 0.0, [start_node]
+
+    dists = ({source: 0.0}, {target: 0.0})
+    preds = ({}, {})
+    heaps = ([(0.0, source)], [(0.0, target)])
+    edges = (hierarchy['forward'], hierarchy['backward'])
+    best, meeting_node = math.inf, None
+    while True:
+        # Go on with the direction whose queue has the smaller key, until both reach the best travel time
+        keys = [heap[0][0] if heap else math.inf for heap in heaps]
+        direction = 0 if keys[0] <= keys[1] else 1
+        if keys[direction] >= best:
+            break
+        d, u = heapq.heappop(heaps[direction])
+        if d > dists[direction][u]:
+            continue
+        if u in dists[1 - direction] and d + dists[1 - direction][u] < best:
+            best, meeting_node = d + dists[1 - direction][u], u
+        # Stall on demand: u is not reached by a shortest path if a higher node reaches it for less
+        if any(dists[direction].get(x, math.inf) + weight < d for x, weight in edges[1 - direction][u]):
+            continue
+        for v, weight in edges[direction][u]:
+            if d + weight < dists[direction].get(v, math.inf):
+                dists[direction][v] = d + weight
+                preds[direction][v] = u
+                heapq.heappush(heaps[direction], (d + weight, v))
+    if meeting_node is None:
+        raise nx.NetworkXNoPath('No path between {} and {}.'.format(start_node, end_node))
+
+    # Join the two halves at the meeting node, then unpack the shortcuts
+    up_path = [meeting_node]
+    while up_path[-1] != source:
+        up_path.append(preds[0][up_path[-1]])
+    up_path.reverse()
+    while up_path[-1] != target:
+        up_path.append(preds[1][up_path[-1]])
+    path = [source]
+    for u, v in zip(up_path[:-1], up_path[1:]):
+        path.extend(unpack_edge(hierarchy, u, v)[1:])
+    nodes = hierarchy['nodes']
+    return best, [nodes[i] for i in path]
+
+
+def ch_shortest_path(start_node, end_node, walking_speed=default_walking_speed, climb_penalty=default_climb_penalty):
+    """Calculate the shortest path between two nodes by the contraction hierarchy.
+    The hierarchy is stale while links are closed, so the search falls back to shortest_path() then.
+
+    :param start_node: string
+        This is the fid of start node in ITN
+    :param end_node: string
+        This is the fid of end node in ITN
+    :param walking_speed: float
+        The walking speed on flat ground; use meter/minute as unit
+    :param climb_penalty: float
+        The meters of climb which cost one additional minute
+    :return: geopandas.GeoDataFrame
+        A GeoDataFrame for the shortest path
+    """
+    if closed_links():
+        return shortest_path(start_node, end_node, walking_speed, climb_penalty)
+    hierarchy = load_contraction_hierarchy(walking_speed, climb_penalty)
+    travel_time, path = ch_query(hierarchy, start_node, end_node)
+    itn_graph, itn_store = load_itn_graph(walking_speed, climb_penalty)
+    return get_gdf(path, itn_graph, itn_store)
+
+
+def check_consistency(pair_num=200, seed=0):
+    """Check the contraction hierarchy against networkx.dijkstra_path on random pairs of nodes.
+
+    :param pair_num: int
+        The number of random pairs of nodes
+    :param seed: int
+        The seed of random pairs
+    :return: float
+        The largest difference of travel time found; use minute as unit
+    """
+    itn_graph, itn_store = load_itn_graph()
+    hierarchy = load_contraction_hierarchy()
+    nodes = hierarchy['nodes']
+    random_generator = np.random.default_rng(seed)
+    max_difference = 0.0
+    for start_index, end_index in random_generator.integers(len(nodes), size=(pair_num, 2)):
+        start_node, end_node = nodes[start_index], nodes[end_index]
+        try:
+            expected_path = nx.dijkstra_path(itn_graph, start_node, end_node, weight='weight')
+        except nx.NetworkXNoPath:
+            try:
+                ch_query(hierarchy, start_node, end_node)
+            except nx.NetworkXNoPath:
+                continue
+            raise AssertionError('A path between {} and {} was found by the hierarchy only'.format(start_node,
+                                                                                                  end_node))
+        travel_time, path = ch_query(hierarchy, start_node, end_node)
+        # The unpacked path must follow original edges and cost what the search reported
+        assert path[0] == start_node and path[-1] == end_node
+        path_weight = nx.path_weight(itn_graph, path, 'weight')
+        expected = nx.path_weight(itn_graph, expected_path, 'weight')
+        max_difference = max(max_difference, abs(path_weight - expected), abs(travel_time - expected))
+    return max_difference
+
+
+if __name__ == '__main__':
+    # For Unit Test
+    difference = check_consistency()
+    print('The largest difference of travel time from Dijkstra:', difference)
+    assert difference < 1e-6
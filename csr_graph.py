@@ -0,0 +1,367 @@
+import pickle
+import time
+import tracemalloc
+
+import networkx as nx
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from data_cache import load_cache, save_cache
+from t4_shortest_path import (batch_shortest_path, closed_links, default_climb_penalty, default_walking_speed, get_gdf,
+                              graph_cache_key, load_itn_graph, open_network, shortest_path)
+
+csr_cache_name = 'itn_csr_graph.pickle'
+csr_cache_version = 1  # Bump when the structure of the cached arrays changes
+min_weight = np.finfo(np.float32).tiny  # Zero weights are raised to this, see build_csr_graph()
+
+_csr_memo = {}  # The CSR graphs already loaded in this process, keyed by the key of the graph
+
+
+def build_csr_graph(sources, targets, weights, link_indexes, node_ids, link_fids):
+    """Build the compressed sparse row (CSR) arrays of a weighted directed graph.
+    The out edges of node i are the slice indptr[i]:indptr[i + 1] of indices (target node),
+    weights and links. Parallel edges between the same pair of nodes are reduced to the lightest one here,
+    since scipy would add their weights up, and zero weights are raised to min_weight so that the edges
+    can never be taken for missing entries of the sparse matrix.
+
+    :param sources: numpy.ndarray
+        The index of the start node of each directed edge
+    :param targets: numpy.ndarray
+        The index of the end node of each directed edge
+    :param weights: numpy.ndarray
+        The travel time of each directed edge; use minute as unit
+    :param link_indexes: numpy.ndarray
+        The index in link_fids of the link of each directed edge
+    :param node_ids: numpy.ndarray
+        The fid of each node
+    :param link_fids: numpy.ndarray
+        The fid of each link
+    :return: dictionary
+        'node_ids', 'link_fids', 'indptr' (int32, one more than nodes), 'indices' (int32), 'weights' (float32)
+        and 'links' (int32 index in link_fids) of the edges
+    """
+    sources = np.asarray(sources, dtype=np.int32)
+    targets = np.asarray(targets, dtype=np.int32)
+    weights = np.maximum(np.asarray(weights, dtype=np.float32), min_weight)
+    link_indexes = np.asarray(link_indexes, dtype=np.int32)
+
+    # Sort the edges by source, target and weight, then keep the first (lightest) edge of each pair of nodes
+    order = np.lexsort((weights, targets, sources))
+    sources, targets, weights, link_indexes = sources[order], targets[order], weights[order], link_indexes[order]
+    first = np.ones(len(sources), dtype=bool)
+    first[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+    sources, targets, weights, link_indexes = sources[first], targets[first], weights[first], link_indexes[first]
+
+    indptr = np.zeros(len(node_ids) + 1, dtype=np.int32)
+    np.cumsum(np.bincount(sources, minlength=len(node_ids)), out=indptr[1:])
+    return {'node_ids': np.asarray(node_ids), 'link_fids': np.asarray(link_fids), 'indptr': indptr,
+            'indices': targets, 'weights': weights, 'links': link_indexes}
+
+
+def csr_from_itn_graph(itn_graph):
+    """Convert the networkx graph of ITN to CSR arrays with interned integer ids of nodes and links.
+
+    :param itn_graph: networkx.DiGraph()
+        The graph of ITN returned by load_itn_graph()
+    :return: dictionary
+        See build_csr_graph()
+    """
+    node_ids = np.array(list(itn_graph))
+    node_index = {node: i for i, node in enumerate(node_ids.tolist())}
+    link_index = {}
+    edge_num = itn_graph.number_of_edges()
+    sources = np.empty(edge_num, dtype=np.int32)
+    targets = np.empty(edge_num, dtype=np.int32)
+    weights = np.empty(edge_num, dtype=np.float32)
+    link_indexes = np.empty(edge_num, dtype=np.int32)
+    for i, (u, v, data) in enumerate(itn_graph.edges(data=True)):
+        sources[i] = node_index[u]
+        targets[i] = node_index[v]
+        weights[i] = data['weight']
+        link_indexes[i] = link_index.setdefault(data['fid'], len(link_index))
+    return build_csr_graph(sources, targets, weights, link_indexes, node_ids, np.array(list(link_index)))
+
+
+def csr_cache_key(walking_speed=default_walking_speed, climb_penalty=default_climb_penalty):
+    """Get the key of the cached CSR graph.
+
+    :param walking_speed: float
+        The walking speed on flat ground; use meter/minute as unit
+    :param climb_penalty: float
+        The meters of climb which cost one additional minute
+    :return: string
+    """
+    return '{}-{}'.format(graph_cache_key(walking_speed, climb_penalty), csr_cache_version)
+
+
+def prepare_csr_graph(csr_graph):
+    """Add the 'node_index' of each node fid and the scipy 'matrix' sharing the arrays to a CSR graph.
+
+    :param csr_graph: dictionary
+        See build_csr_graph()
+    :return: dictionary
+        The same dictionary
+    """
+    node_num = len(csr_graph['node_ids'])
+    csr_graph['node_index'] = {node: i for i, node in enumerate(csr_graph['node_ids'].tolist())}
+    csr_graph['matrix'] = csr_matrix((csr_graph['weights'], csr_graph['indices'], csr_graph['indptr']),
+                                     shape=(node_num, node_num), copy=False)
+    return csr_graph
+
+
+def set_csr_graph(csr_graph, walking_speed=default_walking_speed, climb_penalty=default_climb_penalty):
+    """Use CSR arrays loaded elsewhere, e.g. attached from shared memory by shared_pool.attach(),
+    as the result of load_csr_graph() in this process.
+
+    :param csr_graph: dictionary
+        See build_csr_graph(), optionally with the 'reverse_matrix' of reverse_matrix()
+    :param walking_speed: float
+        The walking speed on flat ground; use meter/minute as unit
+    :param climb_penalty: float
+        The meters of climb which cost one additional minute
+    """
+    _csr_memo.clear()
+    _csr_memo[csr_cache_key(walking_speed, climb_penalty)] = prepare_csr_graph(csr_graph)
+
+
+def load_csr_graph(walking_speed=default_walking_speed, climb_penalty=default_climb_penalty):
+    """Load the CSR graph of ITN, building it from the networkx graph only when no valid cache exists.
+    The cache is rebuilt whenever the graph it is converted from changes. It always covers the whole network,
+    whatever links are closed.
+
+    :param walking_speed: float
+        The walking speed on flat ground; use meter/minute as unit
+    :param climb_penalty: float
+        The meters of climb which cost one additional minute
+    :return: dictionary
+        See build_csr_graph(), with the 'node_index' of each node fid and the scipy 'matrix' sharing the arrays
+    """
+    key = csr_cache_key(walking_speed, climb_penalty)
+    if key in _csr_memo:
+        return _csr_memo[key]
+
+    csr_graph = load_cache(csr_cache_name, key)
+    if csr_graph is None:
+        itn_graph, _ = load_itn_graph(walking_speed, climb_penalty)
+        csr_graph = csr_from_itn_graph(open_network(itn_graph))
+        save_cache(csr_cache_name, key, csr_graph)
+
+    _csr_memo.clear()
+    _csr_memo[key] = prepare_csr_graph(csr_graph)
+    return csr_graph
+
+
+def reverse_matrix(csr_graph):
+    """Get the matrix of the reversed graph, whose rows are the in edges of each node; it is built at first use.
+
+    :param csr_graph: dictionary
+        The graph returned by load_csr_graph()
+    :return: scipy.sparse.csr_matrix
+    """
+    if 'reverse_matrix' not in csr_graph:
+        csr_graph['reverse_matrix'] = csr_graph['matrix'].transpose().tocsr()
+    return csr_graph['reverse_matrix']
+
+
+def edge_link(csr_graph, u, v):
+    """Get the index in link_fids of the link of the edge from node u to node v.
+
+    :param csr_graph: dictionary
+        The graph returned by load_csr_graph()
+    :param u: int
+    :param v: int
+    :return: int
+    """
+    row_start, row_stop = csr_graph['indptr'][u], csr_graph['indptr'][u + 1]
+    position = np.flatnonzero(csr_graph['indices'][row_start:row_stop] == v)[0]
+    return int(csr_graph['links'][row_start + position])
+
+
+def csr_query(csr_graph, start_node, end_node):
+    """Search the shortest path between two nodes by the Dijkstra of scipy.sparse.csgraph.
+
+    :param csr_graph: dictionary
+        The graph returned by load_csr_graph()
+    :param start_node: string
+        This is the fid of start node in ITN
+    :param end_node: string
+        This is the fid of end node in ITN
+    :return travel_time: float
+        Use minute as unit
+    :return path: list
+        The sequence of fid of nodes constructing the path
+    :return links: list
+        The fid of links along the path
+    """
+    start = csr_graph['node_index'][start_node]
+    end = csr_graph['node_index'][end_node]
+    distances, predecessors = dijkstra(csr_graph['matrix'], indices=start, return_predecessors=True)
+    if np.isinf(distances[end]):
+        raise nx.NetworkXNoPath('Node {} not reachable from {}'.format(end_node, start_node))
+
+    path = [end]
+    while path[-1] != start:
+        path.append(int(predecessors[path[-1]]))
+    path.reverse()
+    links = [edge_link(csr_graph, u, v) for u, v in zip(path[:-1], path[1:])]
+    node_ids = csr_graph['node_ids']
+    return float(distances[end]), [str(node_ids[i]) for i in path], [str(csr_graph['link_fids'][i]) for i in links]
+
+
+def csr_batch_query(csr_graph, start_nodes, end_node):
+    """Search the shortest paths from many start nodes to one end node by one Dijkstra over the reversed graph,
+    as t4_shortest_path.batch_shortest_path() does over the networkx graph.
+
+    :param csr_graph: dictionary
+        The graph returned by load_csr_graph()
+    :param start_nodes: list
+        The fid of start nodes in ITN
+    :param end_node: string
+        This is the fid of end node in ITN
+    :return: dictionary
+        For each start node, a dictionary with the 'path' (sequence of fid of nodes), the 'travel_time'
+        in minutes and the 'links' (fid of links along the path); None when the end node can not be reached
+    """
+    node_index = csr_graph['node_index']
+    node_ids = csr_graph['node_ids']
+    link_fids = csr_graph['link_fids']
+    end = node_index[end_node]
+    # In the reversed graph, the predecessor of a node is the next node on its way to the end node
+    distances, predecessors = dijkstra(reverse_matrix(csr_graph), indices=end, return_predecessors=True)
+    routes = {}
+    for start_node in start_nodes:
+        start = node_index[start_node]
+        if np.isinf(distances[start]):
+            routes[start_node] = None
+            continue
+        path = [start]
+        while path[-1] != end:
+            path.append(int(predecessors[path[-1]]))
+        links = [edge_link(csr_graph, u, v) for u, v in zip(path[:-1], path[1:])]
+        routes[start_node] = {'path': [str(node_ids[i]) for i in path], 'travel_time': float(distances[start]),
+                              'links': [str(link_fids[i]) for i in links]}
+    return routes
+
+
+def csr_batch_shortest_path(start_nodes, end_node, walking_speed=default_walking_speed,
+                            climb_penalty=default_climb_penalty):
+    """Calculate the shortest paths from many start nodes to one end node over the CSR graph.
+    The CSR graph is stale while links are closed, so the search falls back to batch_shortest_path() then.
+
+    :param start_nodes: list
+        The fid of start nodes in ITN
+    :param end_node: string
+        This is the fid of end node in ITN
+    :param walking_speed: float
+        The walking speed on flat ground; use meter/minute as unit
+    :param climb_penalty: float
+        The meters of climb which cost one additional minute
+    :return: dictionary
+        See csr_batch_query()
+    """
+    if closed_links():
+        return batch_shortest_path(start_nodes, end_node, walking_speed, climb_penalty)
+    return csr_batch_query(load_csr_graph(walking_speed, climb_penalty), start_nodes, end_node)
+
+
+def csr_shortest_path(start_node, end_node, walking_speed=default_walking_speed,
+                      climb_penalty=default_climb_penalty):
+    """Calculate the shortest path between two nodes over the CSR graph.
+    The CSR graph is stale while links are closed, so the search falls back to shortest_path() then.
+
+    :param start_node: string
+        This is the fid of start node in ITN
+    :param end_node: string
+        This is the fid of end node in ITN
+    :param walking_speed: float
+        The walking speed on flat ground; use meter/minute as unit
+    :param climb_penalty: float
+        The meters of climb which cost one additional minute
+    :return: geopandas.GeoDataFrame
+        A GeoDataFrame for the shortest path
+    """
+    if closed_links():
+        return shortest_path(start_node, end_node, walking_speed, climb_penalty)
+    csr_graph = load_csr_graph(walking_speed, climb_penalty)
+    travel_time, path, links = csr_query(csr_graph, start_node, end_node)
+    itn_graph, itn_store = load_itn_graph(walking_speed, climb_penalty)
+    return get_gdf(path, itn_graph, itn_store)
+
+
+def graph_memory(itn_graph, csr_graph):
+    """Measure the memory held by the networkx graph and by the arrays of the CSR graph.
+
+    :param itn_graph: networkx.DiGraph()
+    :param csr_graph: dictionary
+        The graph returned by load_csr_graph()
+    :return: dictionary
+        The bytes of each graph; the networkx graph is measured by tracemalloc while a copy is unpickled
+    """
+    data = pickle.dumps(itn_graph, protocol=pickle.HIGHEST_PROTOCOL)
+    tracemalloc.start()
+    copy = pickle.loads(data)
+    networkx_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del copy
+    csr_bytes = sum(csr_graph[name].nbytes for name in ('indptr', 'indices', 'weights', 'links'))
+    id_bytes = csr_graph['node_ids'].nbytes + csr_graph['link_fids'].nbytes
+    return {'networkx': networkx_bytes, 'csr': csr_bytes, 'csr_with_ids': csr_bytes + id_bytes}
+
+
+def compare_engines(pair_num=100, seed=0):
+    """Compare the CSR graph with the networkx graph in memory, speed and travel time on random pairs of nodes.
+
+    :param pair_num: int
+        The number of random pairs of nodes
+    :param seed: int
+        The seed of random pairs
+    :return: dictionary
+        The memory of both graphs, the mean query time of both engines (second)
+        and the largest relative difference of travel time, which comes from the float32 weights
+    """
+    itn_graph, _ = load_itn_graph()
+    csr_graph = load_csr_graph()
+    nodes = csr_graph['node_ids']
+    random_generator = np.random.default_rng(seed)
+    pairs = [(str(nodes[i]), str(nodes[j])) for i, j in random_generator.integers(len(nodes), size=(pair_num, 2))]
+
+    networkx_times, csr_times = [], []
+    max_difference = 0.0
+    for start_node, end_node in pairs:
+        start_time = time.perf_counter()
+        try:
+            expected_time, _ = nx.single_source_dijkstra(itn_graph, start_node, end_node, weight='weight')
+        except nx.NetworkXNoPath:
+            expected_time = None
+        networkx_times.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        try:
+            travel_time, path, links = csr_query(csr_graph, start_node, end_node)
+        except nx.NetworkXNoPath:
+            travel_time = None
+        csr_times.append(time.perf_counter() - start_time)
+
+        assert (expected_time is None) == (travel_time is None)
+        if expected_time is not None:
+            # The path must follow edges of the graph and cost what the search reported
+            path_weight = nx.path_weight(itn_graph, path, 'weight')
+            assert links == [itn_graph.edges[u, v]['fid'] for u, v in zip(path[:-1], path[1:])]
+            scale = max(expected_time, 1e-9)
+            max_difference = max(max_difference, abs(travel_time - expected_time) / scale,
+                                 abs(path_weight - expected_time) / scale)
+    return {'memory': graph_memory(itn_graph, csr_graph), 'networkx_query': float(np.mean(networkx_times)),
+            'csr_query': float(np.mean(csr_times)), 'max_relative_difference': max_difference}
+
+
+if __name__ == '__main__':
+    # For Unit Test
+    comparison = compare_engines()
+    memory = comparison['memory']
+    print('Memory of networkx graph: {:.1f} MB, CSR arrays: {:.1f} MB ({:.1f} MB with ids)'.format(
+        memory['networkx'] / 1e6, memory['csr'] / 1e6, memory['csr_with_ids'] / 1e6))
+    print('Mean query time of networkx: {:.2f} ms, CSR: {:.2f} ms'.format(
+        comparison['networkx_query'] * 1000, comparison['csr_query'] * 1000))
+    print('The largest relative difference of travel time:', comparison['max_relative_difference'])
+    assert comparison['max_relative_difference'] < 1e-5
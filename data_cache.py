@@ -0,0 +1,89 @@
+import hashlib
+import os
+import pickle
+import threading
+
+cache_dir = 'Material/cache'
+
+
+def file_signature(path):
+    """Get a cheap signature of a file which changes whenever the file is rewritten.
+
+    :param path: string
+        The path of the file
+    :return: tuple(path, size, mtime)
+        The size in bytes and the modification time in nanoseconds of the file
+    """
+    stat = os.stat(path)
+    return path, stat.st_size, stat.st_mtime_ns
+
+
+def cache_key(paths, params=()):
+    """Build the key identifying a cached product from its source files and parameters.
+
+    :param paths: list
+        The paths of the source files the product is derived from
+    :param params: tuple
+        The parameters used to derive the product, e.g. walking speed and climb penalty
+    :return: string
+        A hex digest which changes when any source file or parameter changes
+    """
+    signature = [file_signature(path) for path in paths]
+    return hashlib.sha1(repr((signature, tuple(params))).encode('utf-8')).hexdigest()
+
+
+def temp_path(path):
+    """Get a temporary path next to the given path which is unique to this process and thread,
+    so that concurrent writers of the same product never write to the same file before os.replace().
+
+    :param path: string
+        The path the temporary file will be renamed to
+    :return: string
+    """
+    return '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+
+
+def load_cache(name, key):
+    """Load a cached product from the cache directory.
+
+    :param name: string
+        The file name of the cache, e.g. 'itn_graph.pickle'
+    :param key: string
+        The key returned by cache_key()
+    :return: object or None
+        Return the cached product when it exists and was built with the same key, otherwise, return None
+    """
+    path = os.path.join(cache_dir, name)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            cached = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if cached.get('key') != key:
+        return None
+    return cached['value']
+
+
+def save_cache(name, key, value):
+    """Save a product to the cache directory together with its key.
+    The file is written to a temporary file of this writer first so a half written cache is never loaded.
+
+    :param name: string
+        The file name of the cache
+    :param key: string
+        The key returned by cache_key()
+    :param value: object
+        The product to be cached, which must be picklable
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, name)
+    tmp_path = temp_path(path)
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'key': key, 'value': value}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):  # Writing failed
+            os.remove(tmp_path)
@@ -0,0 +1,121 @@
+import json
+import os
+
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.coords import BoundingBox
+
+from data_cache import cache_dir, file_signature, temp_path
+
+elevation_path = 'Material/elevation/SZ.asc'
+
+
+class ElevationStore:
+    """The elevation converted to a raw .npy file, which is opened by np.memmap so that reading a cell
+    or a window only pages in the part of the file it touches.
+    It provides the attributes of rasterio datasets used by this program (shape, bounds, transform, nodata, read).
+    """
+
+    def __init__(self, npy_path, meta):
+        self.matrix = np.load(npy_path, mmap_mode='r')
+        self.shape = self.matrix.shape
+        self.height, self.width = self.shape
+        self.transform = Affine(*meta['transform'])
+        self.bounds = BoundingBox(*meta['bounds'])
+        self.nodata = meta['nodata']
+        self.crs = meta['crs']
+
+    def read(self, band=1, window=None, masked=False):
+        """Read the elevation without parsing or copying the whole raster.
+
+        :param band: int
+            Only band 1 exists; kept for compatibility with rasterio datasets
+        :param window: rasterio.windows.Window or None
+            The window to read; None for the whole raster
+        :param masked: bool
+            Return a masked array where cells without data are masked
+        :return: numpy.memmap or numpy.ma.MaskedArray
+            The elevation matrix or its window
+        """
+        if band != 1:
+            raise IndexError('band index {} out of range'.format(band))
+        matrix = self.matrix
+        if window is not None:
+            matrix = matrix[window.toslices()]
+        if masked:
+            return np.ma.masked_equal(matrix, self.nodata, copy=False) if self.nodata is not None \
+                else np.ma.masked_array(matrix)
+        return matrix
+
+
+def store_paths(path):
+    """Get the paths of the binary elevation and its sidecar of the given raster.
+
+    :param path: string
+        The path of the source raster, e.g. 'Material/elevation/SZ.asc'
+    :return: tuple(npy_path, meta_path)
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, name + '.npy'), os.path.join(cache_dir, name + '.json')
+
+
+def convert_elevation(path=elevation_path):
+    """Convert the raster of elevation to a .npy file and a JSON sidecar holding the transform.
+    This parses the ASCII grid once; later runs open the .npy file by memory mapping.
+
+    :param path: string
+        The path of the source raster
+    :return: dictionary
+        The metadata written to the sidecar
+    """
+    npy_path, meta_path = store_paths(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Each writer fills its own temporary files, so a reader never maps a file another writer is truncating
+    npy_tmp_path, meta_tmp_path = temp_path(npy_path), temp_path(meta_path)
+    try:
+        with rasterio.open(path) as elevation:
+            matrix = np.lib.format.open_memmap(npy_tmp_path, mode='w+',
+                                               dtype=elevation.dtypes[0], shape=elevation.shape)
+            matrix[:] = elevation.read(1)
+            matrix.flush()
+            del matrix
+            meta = {'source': list(file_signature(path)),
+                    'transform': list(elevation.transform)[:6],
+                    'bounds': list(elevation.bounds),
+                    'nodata': elevation.nodata,
+                    'crs': elevation.crs.to_wkt() if elevation.crs else None}
+        with open(meta_tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(npy_tmp_path, npy_path)
+        os.replace(meta_tmp_path, meta_path)
+    finally:
+        for tmp_path in (npy_tmp_path, meta_tmp_path):
+            if os.path.exists(tmp_path):  # Writing failed
+                os.remove(tmp_path)
+    return meta
+
+
+def open_elevation(path=elevation_path):
+    """Open the binary elevation of the given raster, converting the raster first when it is missing
+    or the raster has changed since the conversion.
+
+    :param path: string
+        The path of the source raster
+    :return: ElevationStore
+    """
+    npy_path, meta_path = store_paths(path)
+    meta = None
+    if os.path.exists(npy_path) and os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta['source'] != list(file_signature(path)):
+            meta = None
+    if meta is None:
+        meta = convert_elevation(path)
+    return ElevationStore(npy_path, meta)
+
+
+if __name__ == '__main__':
+    # Convert the elevation ahead of the first request
+    print(convert_elevation())
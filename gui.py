@@ -1,25 +1,29 @@
+import queue
+import threading
 import tkinter as tk
 from tkinter import ttk
 import tkinter.messagebox
 
-from t1_user_input import check_coordinate, coordinate_transform
-from t2_highest_point import identify_highest_point
-from t3_nearest_itn import get_nearest_itn_node
-from t4_shortest_path import shortest_path
-from t5_map_plotting import map_plot
+from instrumentation import recording, stage
 
+# The task modules pull in geopandas, rasterio, cartopy, matplotlib and networkx, which take seconds to import.
+# They are imported by the preload thread after the window is shown, and by the functions using them.
 
-def get_input_gui(input_crs, x_entry, y_entry):
-    """Get user's location input from GUI and check the validity of coordinates.
+poll_interval = 100  # The interval of checking the messages from the worker thread; use millisecond as unit
+
+
+def get_input_gui(input_crs, user_input):
+    """Check the validity of coordinates got from GUI.
     when coordinates are legal then return a coordinate pair in CRS of British National Grid, otherwise, return None.
 
     :param input_crs: string
-    :param x_entry: instance of entry widget
-    :param y_entry: instance of entry widget
+    :param user_input: tuple(x, y)
+        The coordinates read from the entry widgets
     :return: tuple(x, y) or None
     """
-    user_location = (float(x_entry.get()), float(y_entry.get()))
-    user_location = coordinate_transform(input_crs, user_location)
+    from t1_user_input import check_coordinate, coordinate_transform
+
+    user_location = coordinate_transform(input_crs, user_input)
     if check_coordinate(user_location):
         print("This coordinate is valid!")
         return user_location
@@ -28,9 +32,119 @@ def get_input_gui(input_crs, x_entry, y_entry):
         return None
 
 
-def run(input_crs, x_entry, y_entry, clip_mode, pb_window, progress_bar, progress_var):
+def run_pipeline(input_crs, user_input, cancel_event, messages, high_ground=False):
+    """Combine tasks together; this runs on a worker thread so that the window keeps responding.
+    The worker never touches widgets; it puts messages into the queue, which are handled by the main thread.
+
+    :param input_crs: string
+    :param user_input: tuple(x, y)
+        The coordinates read from the entry widgets
+    :param cancel_event: threading.Event
+        Set by the Cancel button; the pipeline stops at the next stage or inside the route search
+    :param messages: queue.Queue
+        ('progress', value, text), ('warning', text), ('done', result), ('cancelled',) or ('error', exception)
+    :param high_ground: bool
+        Route to the high point reached first among the highest points around, see pipeline.rank_high_ground(),
+        instead of the single highest point
+    :return:
+    """
+    from pipeline import rank_high_ground
+    from t2_highest_point import identify_highest_point
+    from t3_nearest_itn import get_nearest_itn_node
+    from t4_shortest_path import RouteCancelled, shortest_path
+
+    def check_cancel():
+        if cancel_event.is_set():
+            raise RouteCancelled()
+
+    try:
+        # Get the location from entry box
+        print("Get user's input...")
+        messages.put(('progress', 0, "(1/5) Get user's input..."))
+        with stage('user input'):
+            user_location = get_input_gui(input_crs, user_input)
+        if user_location is None:
+            messages.put(('warning', 'Please input valid coordinates on the Isle of Wight '
+                                     'and click run button again'))
+            return
+
+        # Identify the highest point within a 5km radius from the user location
+        check_cancel()
+        print('Identifying the highest point...')
+        messages.put(('progress', 1, "(2/5) Identifying the highest point..."))
+        radius = 5000
+        with stage('highest point'):
+            result = identify_highest_point(user_location, radius)
+        highest_point = [result[0], result[1]]
+        local_elevation_array = result[2]
+        out_transform = result[3]
+
+        # Identify the nearest ITN node to the user and the nearest ITN node to the highest point
+        check_cancel()
+        print('Identifying the nearest ITN node...')
+        messages.put(('progress', 2, "(3/5) Identifying the nearest ITN node..."))
+        with stage('nearest node'):
+            start_node = get_nearest_itn_node(user_location)
+            end_node = get_nearest_itn_node(highest_point)
+        if high_ground:
+            # Compare the highest points around by one search, and head for the one reached first
+            with stage('high ground'):
+                candidates = rank_high_ground(user_location, radius, cancel_event=cancel_event)
+            for rank, candidate in enumerate(candidates, 1):
+                print('{}. ({:.0f}, {:.0f}) elevation {:.1f} m, {:.1f} minutes'.format(
+                    rank, candidate['x'], candidate['y'], candidate['elevation'], candidate['travel_time']))
+            if candidates:
+                highest_point = [candidates[0]['x'], candidates[0]['y']]
+                end_node = candidates[0]['end_node']
+
+        # Identify the shortest path
+        check_cancel()
+        print('Identifying the shortest path...')
+        messages.put(('progress', 3, "(4/5) Identifying the shortest path..."))
+        with stage('shortest path'):
+            path = shortest_path(start_node, end_node, cancel_event=cancel_event)
+
+        messages.put(('done', (user_location, highest_point, path, local_elevation_array, out_transform)))
+    except RouteCancelled:
+        print('Cancelled')
+        messages.put(('cancelled',))
+    except Exception as error:
+        messages.put(('error', error))
+
+
+def show_map(master, map_view, map_args):
+    """Draw the map of a request in the map window. The window and its figure are created at the first request
+    and kept; later requests only swap the layers of the request, see t5_map_plotting.MapCanvas.
+
+    :param master: tkinter widget
+        The parent of the map window
+    :param map_view: dictionary
+        Holds the 'window' and the 'canvas' (MapCanvas) once they are created
+    :param map_args: tuple
+        The arguments of MapCanvas.update()
+    """
+    from t5_map_plotting import MapCanvas, screen_dpi  # Already imported by the preload thread
+
+    if 'canvas' not in map_view:
+        map_window = tk.Toplevel(master)
+        map_window.title('Evacuation map')
+        map_window.protocol('WM_DELETE_WINDOW', map_window.withdraw)  # Keep the figure for the next request
+        map_canvas = MapCanvas(dpi=screen_dpi)
+        map_canvas.embed(map_window)
+        map_view.update(window=map_window, canvas=map_canvas)
+    map_canvas = map_view['canvas']
+    map_canvas.update(*map_args)
+    map_canvas.draw()
+    map_view['window'].deiconify()
+    map_view['window'].lift()
+    print('Map drawn in {:.0f} ms'.format(map_canvas.render_time * 1000))
+
+
+def run(input_crs, x_entry, y_entry, clip_mode, pb_window, progress_bar, progress_var, run_button, cancel_event,
+        preload_thread, recorder=None, high_ground_mode=None, map_view=None):
     """This is the main body of software which combine tasks together and can be called by click the button.
-    The progress of running the program can be shown by the progress bar.
+    The tasks run on a worker thread; their progress is shown by the progress bar,
+    and the map is drawn on the main thread when the worker finishes.
 
     :param input_crs: tkinter::StringVar
     :param x_entry: instance of entry widget
@@ -39,58 +153,82 @@ def run(input_crs, x_entry, y_entry, clip_mode, pb_window, progress_bar, progres
     :param pb_window: tkinter::Toplevel
     :param progress_bar: instance of progressbar widget
     :param progress_var: tkinter::StringVar
+    :param run_button: instance of button widget
+    :param cancel_event: threading.Event
+    :param preload_thread: threading.Thread
+        The thread loading datasets since the window is created
+    :param recorder: instrumentation.Recorder or None
+        Record the stages of the request
+    :param high_ground_mode: tkinter::IntVar or None
+        1 to route to the high point reached first instead of the highest point
+    :param map_view: dictionary or None
+        The map window kept between requests, see show_map()
     :return:
     """
+    try:
+        user_input = (float(x_entry.get()), float(y_entry.get()))
+    except ValueError:
+        tkinter.messagebox.showwarning(title='Warning', message='Please input numbers as coordinates')
+        return
+
     # Show progress window
-    pb_window.update()
+    progress_bar['value'] = 0
+    progress_var.set('Loading datasets...' if preload_thread.is_alive() else "(1/5) Get user's input...")
     pb_window.deiconify()
+    run_button.config(state=tk.DISABLED)
+    cancel_event.clear()
+    crs = input_crs.get()
+    if map_view is None:
+        map_view = {}
+    high_ground = bool(high_ground_mode.get()) if high_ground_mode is not None else False
+    messages = queue.Queue()
 
-    # Get the location from entry box
-    print("Get user's input...")
-    progress_bar['value'] = 0
-    progress_var.set("(1/5) Get user's input...")
-    progress_bar.update()
-    user_location = get_input_gui(input_crs.get(), x_entry, y_entry)
-    if user_location is None:
-        tkinter.messagebox.showwarning(title='Warning',
-                                       message='Please input valid coordinates on the Isle of Wight '
-                                               'and click run button again')
-        return
+    def work():
+        preload_thread.join()  # Wait for the warm-up so that datasets are loaded only once
+        with recording(recorder):
+            run_pipeline(crs, user_input, cancel_event, messages, high_ground)
+
+    def finish():
+        pb_window.withdraw()
+        run_button.config(state=tk.NORMAL)
 
-    # Identify the highest point within a 5km radius from the user location
-    print('Identifying the highest point...')
-    progress_bar['value'] = 1
-    progress_var.set("(2/5) Identifying the highest point...")
-    progress_bar.update()
-    radius = 5000
-    result = identify_highest_point(user_location, radius)
-    highest_point = [result[0], result[1]]
-    local_elevation_array = result[2]
-    out_transform = result[3]
-
-    # Identify the nearest ITN node to the user and the nearest ITN node to the highest point
-    print('Identifying the nearest ITN node...')
-    progress_bar['value'] = 2
-    progress_var.set("(3/5) Identifying the nearest ITN node...")
-    progress_bar.update()
-
-    start_node = get_nearest_itn_node(user_location)
-    end_node = get_nearest_itn_node(highest_point)
-
-    # Identify the shortest path
-    print('Identifying the shortest path...')
-    progress_bar['value'] = 3
-    progress_var.set("(4/5) Identifying the shortest path...")
-    progress_bar.update()
-    path = shortest_path(start_node, end_node)
-
-    # Plot a map
-    print('Drawing the map...')
-    progress_bar['value'] = 5
-    progress_var.set("(5/5) Drawing the map...")
-    progress_bar.update()
-    map_plot(user_location, highest_point, path, local_elevation_array, out_transform, clip_mode.get())
-    pb_window.withdraw()
+    def poll():
+        # Handle the messages from the worker thread on the main thread
+        while True:
+            try:
+                message = messages.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == 'progress':
+                progress_bar['value'] = message[1]
+                progress_var.set(message[2])
+            elif message[0] == 'warning':
+                finish()
+                tkinter.messagebox.showwarning(title='Warning', message=message[1])
+                return
+            elif message[0] == 'error':
+                finish()
+                tkinter.messagebox.showerror(title='Error', message=str(message[1]))
+                return
+            elif message[0] == 'cancelled':
+                finish()
+                return
+            elif message[0] == 'done':
+                # Plot a map
+                print('Drawing the map...')
+                progress_bar['value'] = 5
+                progress_var.set("(5/5) Drawing the map...")
+                progress_bar.update()
+                user_location, highest_point, path, local_elevation_array, out_transform = message[1]
+                finish()
+                with recording(recorder), stage('map'):
+                    show_map(pb_window.master, map_view, (user_location, highest_point, path,
+                                                          local_elevation_array, out_transform, clip_mode.get()))
+                return
+        pb_window.after(poll_interval, poll)
+
+    threading.Thread(target=work, daemon=True).start()
+    pb_window.after(poll_interval, poll)
 
 
 def change_input_crs(input_crs, x_label, y_label):
@@ -109,18 +247,22 @@ def change_input_crs(input_crs, x_label, y_label):
         y_label.config(text='Y(Northing):')
 
 
-def init_gui():
+def init_gui(recorder=None):
     """Construct and initialize the body of GUI
+
+    :param recorder: instrumentation.Recorder or None
+        Record the stages of loading datasets and of every request
     """
     print('Initialize gui')
     # Create main window
     window = tk.Tk()
     window.title('Flood Emergency Planning')
-    window.geometry('680x330+580+330')
+    window.geometry('680x370+580+330')
 
     # Variable for widgets'use
     input_crs = tk.StringVar()
     clip_mode = tk.IntVar()
+    high_ground_mode = tk.IntVar()
 
     # Create widgets
     # Label
@@ -134,16 +276,33 @@ def init_gui():
                          font=('Arial', 11), width=20, height=3)
     clip_label = tk.Label(window, text='Map clipping option:', anchor='w',
                           font=('Arial', 11), width=20, height=1)
+    route_label = tk.Label(window, text='Routing option:', anchor='w',
+                           font=('Arial', 11), width=20, height=2)
     # Entry
     x_entry = tk.Entry(window, width=30, font=('Arial', 11))
     y_entry = tk.Entry(window, width=30, font=('Arial', 11))
     x_entry.insert(index=0, string='439619')
     y_entry.insert(index=0, string='85800')
 
+    # Import the task modules and load datasets in the background, so that the window shows up at once
+    # and the first run hits warm caches
+    def warm_up():
+        with recording(recorder):
+            with stage('import modules'):
+                from pipeline import preload
+                import t5_map_plotting  # noqa: F401
+            with stage('preload'):
+                preload()
+    preload_thread = threading.Thread(target=warm_up, daemon=True)
+    preload_thread.start()
+    cancel_event = threading.Event()
+    map_view = {}  # The map window, created by the first request
+
     # Button
     run_button = tk.Button(window, text='Run', font=('Arial', 11), width=30, height=2,
                            command=lambda: run(input_crs, x_entry, y_entry, clip_mode,
-                                               pb_window, progress_bar, progress_var))
+                                               pb_window, progress_bar, progress_var, run_button, cancel_event,
+                                               preload_thread, recorder, high_ground_mode, map_view))
 
     # Radio
     crs_bng_radio = tk.Radiobutton(window, text='British National Grid', font=('Arial', 11),
@@ -157,10 +316,12 @@ def init_gui():
     # Checkbutton
     map_clip_check = tk.Checkbutton(window, text='Clip the map by the range of background', font=('Arial', 11),
                                     height=1, variable=clip_mode, onvalue=1, offvalue=0)
+    high_ground_check = tk.Checkbutton(window, text='Go to the high point reached first', font=('Arial', 11),
+                                       height=1, variable=high_ground_mode, onvalue=1, offvalue=0)
 
     # Create Progressbar and label in a new window
     pb_window = tk.Toplevel(window)
-    pb_window.geometry('470x100+700+450')
+    pb_window.geometry('470x130+700+450')
     pb_window.title('Running progress')
     progress_var = tk.StringVar()  # The variable used by label
     progress_label = tk.Label(pb_window, textvariable=progress_var, anchor='w',
@@ -168,8 +329,12 @@ def init_gui():
     progress_bar = ttk.Progressbar(pb_window, orient="horizontal", length=400, mode="determinate")
     progress_bar['maximum'] = 5
     progress_bar['value'] = 0
+    cancel_button = tk.Button(pb_window, text='Cancel', font=('Arial', 10), width=10,
+                              command=cancel_event.set)
+    pb_window.protocol('WM_DELETE_WINDOW', cancel_event.set)  # Closing the progress window also cancels
     progress_label.grid(row=1, sticky='W', padx=30)
     progress_bar.grid(row=2, sticky='W', padx=30)
+    cancel_button.grid(row=3, sticky='E', padx=30, pady=5)
     pb_window.withdraw()  # Hide the progress window
 
     # Place widgets by grids in main window
@@ -189,6 +354,9 @@ def init_gui():
     clip_label.grid(row=5, column=1)
     map_clip_check.grid(row=5, column=2, columnspan=2, sticky='W')
     # Row 6
-    run_button.grid(row=6, column=1, columnspan=3, pady=20)
+    route_label.grid(row=6, column=1)
+    high_ground_check.grid(row=6, column=2, columnspan=2, sticky='W')
+    # Row 7
+    run_button.grid(row=7, column=1, columnspan=3, pady=20)
 
     return window
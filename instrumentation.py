@@ -0,0 +1,260 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+_local = threading.local()  # The recorder and the open stages of each thread
+
+
+class Recorder:
+    """Record the wall time, the peak memory and the item counts of each stage of the pipeline.
+
+    A recorder only collects stages of threads bound to it by recording(); code of the pipeline marks its
+    stages by stage() and its counts by count(), which do nothing when no recorder is bound.
+    The peak memory is traced by tracemalloc, which covers every thread of the process and slows Python down,
+    so it can be turned off.
+    """
+
+    def __init__(self, memory=True, profile=False, origin=None):
+        """
+        :param memory: bool
+            Trace the peak memory of stages by tracemalloc
+        :param profile: bool
+            Run cProfile over each outermost stage, so that the slowest one can be dumped by dump_profile()
+        :param origin: float or None
+            The time.perf_counter() which the start of stages is relative to; pass the origin of the recorder
+            of the main process in worker processes, so that their stages line up on one timeline
+        """
+        self.memory = memory
+        self.profile = profile
+        self.origin = time.perf_counter() if origin is None else origin
+        self.stages = []
+        self.profiles = {}  # The profile of each recorded outermost stage, keyed by its index in stages
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """Record a stage of the current thread; stages can be nested.
+
+        :param name: string
+        :return: dictionary
+            The record of the stage, which is filled when the stage ends
+        """
+        stack = _stack()
+        record = {'name': name, 'start': time.perf_counter() - self.origin, 'duration': None, 'peak_memory': None,
+                  'counts': {}, 'depth': len(stack), 'process': os.getpid(), 'thread': threading.get_ident()}
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:  # Keep the peak of the parent stage before resetting it
+                stack[-1]['_peak'] = max(stack[-1].get('_peak', 0), peak)
+            tracemalloc.reset_peak()
+            record['_base'], record['_peak'] = current, current
+        profiler = None
+        if self.profile and not stack:  # Only one profiler can be enabled at a time
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        stack.append(record)
+        try:
+            yield record
+        finally:
+            stack.pop()
+            if profiler is not None:
+                profiler.disable()
+            record['duration'] = time.perf_counter() - self.origin - record['start']
+            if self.memory:
+                peak = max(record.pop('_peak'), tracemalloc.get_traced_memory()[1])
+                record['peak_memory'] = peak - record.pop('_base')
+                if stack:
+                    stack[-1]['_peak'] = max(stack[-1].get('_peak', 0), peak)
+            with self._lock:
+                if profiler is not None:
+                    self.profiles[len(self.stages)] = profiler
+                self.stages.append(record)
+
+    def extend(self, records):
+        """Add the stages recorded by another recorder, e.g. in a worker process.
+
+        :param records: list
+            The 'stages' of report() of the other recorder
+        """
+        with self._lock:
+            self.stages.extend(records)
+
+    def slowest(self):
+        """Get the record of the slowest outermost stage, or None when nothing is recorded.
+        """
+        outermost = [record for record in self.stages if record['depth'] == 0]
+        return max(outermost, key=lambda record: record['duration']) if outermost else None
+
+    def report(self):
+        """Summarise the recorded stages, in the order they started.
+
+        :return: dictionary
+            'stages' as a list of records with 'name', 'start' and 'duration' (second), 'peak_memory' (byte),
+            'counts', 'depth' (nesting level), 'process' and 'thread'; 'totals' of the calls, duration and counts
+            of stages by name; and the name of the 'slowest' outermost stage
+        """
+        stages = sorted(self.stages, key=lambda record: record['start'])
+        totals = {}
+        for record in stages:
+            total = totals.setdefault(record['name'], {'calls': 0, 'duration': 0.0, 'counts': {}})
+            total['calls'] += 1
+            total['duration'] += record['duration']
+            for key, value in record['counts'].items():
+                total['counts'][key] = total['counts'].get(key, 0) + value
+        slowest = self.slowest()
+        return {'stages': stages, 'totals': totals, 'slowest': slowest['name'] if slowest else None}
+
+    def chrome_trace(self):
+        """Convert the recorded stages to the Chrome trace event format, viewable in chrome://tracing or Perfetto.
+
+        :return: dictionary
+        """
+        events = []
+        for record in self.stages:
+            args = dict(record['counts'])
+            if record['peak_memory'] is not None:
+                args['peak_memory'] = record['peak_memory']
+            events.append({'name': record['name'], 'ph': 'X', 'ts': record['start'] * 1e6,
+                           'dur': record['duration'] * 1e6, 'pid': record['process'], 'tid': record['thread'],
+                           'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, path, trace_format='json'):
+        """Write the report or the trace to a file.
+
+        :param path: string
+        :param trace_format: string
+            'json' for report(), 'chrome' for chrome_trace()
+        """
+        data = self.chrome_trace() if trace_format == 'chrome' else self.report()
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=1)
+
+    def dump_profile(self, path):
+        """Write the cProfile statistics of the slowest profiled stage, readable by pstats or snakeviz.
+
+        :param path: string
+        :return: string or None
+            The name of the stage, None when no stage was profiled
+        """
+        if not self.profiles:
+            return None
+        index = max(self.profiles, key=lambda i: self.stages[i]['duration'])
+        self.profiles[index].dump_stats(path)
+        return self.stages[index]['name']
+
+    def summary(self):
+        """Format the totals of stages as lines of text.
+        """
+        lines = []
+        for name, total in self.report()['totals'].items():
+            counts = ', '.join('{} {}'.format(value, key) for key, value in total['counts'].items())
+            lines.append('{:<28} {:>4} x {:>10.3f} s  {}'.format(name, total['calls'], total['duration'], counts))
+        return '\n'.join(lines)
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+@contextmanager
+def recording(recorder):
+    """Bind a recorder to the current thread, so that stage() and count() record into it.
+
+    :param recorder: Recorder or None
+        Nothing is recorded when None
+    """
+    previous = getattr(_local, 'recorder', None)
+    _local.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _local.recorder = previous
+
+
+@contextmanager
+def stage(name):
+    """Mark a stage of the pipeline; it is recorded by the recorder bound to the current thread, if any.
+
+    :param name: string
+    """
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is None:
+        yield None
+        return
+    with recorder.stage(name) as record:
+        yield record
+
+
+def active():
+    """Whether a stage is being recorded in the current thread; use it to skip the work of counting.
+    """
+    return bool(getattr(_local, 'recorder', None) is not None and getattr(_local, 'stack', None))
+
+
+def count(name, number=1):
+    """Add to a count of the innermost recorded stage of the current thread, e.g. count('nodes settled', 120).
+    It does nothing when no stage is being recorded.
+
+    :param name: string
+    :param number: int
+    """
+    stack = getattr(_local, 'stack', None)
+    if stack and getattr(_local, 'recorder', None) is not None:
+        counts = stack[-1]['counts']
+        counts[name] = counts.get(name, 0) + number
+
+
+def save_outputs(recorder, stats_path=None, trace_path=None, profile_path=None):
+    """Write the outputs asked for on the command line and print where they are to the standard error,
+    which keeps the standard output for results.
+
+    :param recorder: Recorder
+    :param stats_path: string or None
+        The file of the JSON report
+    :param trace_path: string or None
+        The file of the Chrome trace
+    :param profile_path: string or None
+        The file of the cProfile statistics of the slowest stage
+    """
+    if stats_path:
+        recorder.save(stats_path, 'json')
+        print('Stage statistics written to ' + stats_path, file=sys.stderr)
+    if trace_path:
+        recorder.save(trace_path, 'chrome')
+        print('Stage trace written to ' + trace_path, file=sys.stderr)
+    if profile_path:
+        name = recorder.dump_profile(profile_path)
+        if name is not None:
+            print('Profile of the slowest stage ({}) written to {}'.format(name, profile_path), file=sys.stderr)
+
+
+if __name__ == "__main__":  # For Unit Test
+    test_recorder = Recorder(profile=True)
+    with recording(test_recorder):
+        with stage('outer'):
+            count('items', 2)
+            with stage('inner'):
+                data = [0] * 1000000
+                count('items')
+            del data
+        with stage('after'):
+            sum(range(100000))
+    test_report = test_recorder.report()
+    print(test_recorder.summary())
+    assert [record['name'] for record in test_report['stages']] == ['outer', 'inner', 'after']
+    assert test_report['totals']['outer']['counts'] == {'items': 2}
+    assert test_report['stages'][0]['peak_memory'] >= test_report['stages'][1]['peak_memory'] >= 8000000
+    assert not active()
+    count('items')  # Nothing is recorded outside stages
+    assert len(test_recorder.chrome_trace()['traceEvents']) == 3
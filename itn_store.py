@@ -0,0 +1,183 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import shapely
+
+from data_cache import cache_dir, file_signature, temp_path
+
+solent_itn_json_path = 'Material/itn/solent_itn.json'
+store_arrays = ['node_ids', 'node_coords', 'link_fids', 'link_start', 'link_end', 'link_length', 'coord_offsets',
+                'coords']
+
+_store_memo = {}  # The stores already opened in this process, keyed by the path and signature of the source
+
+
+class ItnStore:
+    """The ITN converted to columnar .npy files, which are opened by np.memmap so that nothing is parsed
+    or copied when the store is opened.
+    Nodes and links are referred to by their position in the arrays:
+
+    - node_ids, node_coords: the fid and the (x, y) of each node
+    - link_fids, link_start, link_end, link_length: the fid, the position of the start and end node
+      and the length of each link
+    - coords, coord_offsets: the points of all links in one (n, 2) array; the points of link i are
+      coords[coord_offsets[i]:coord_offsets[i + 1]]
+    """
+
+    def __init__(self, directory):
+        for name in store_arrays:
+            setattr(self, name, np.load(os.path.join(directory, name + '.npy'), mmap_mode='r'))
+        self._node_index = None
+        self._link_index = None
+
+    @property
+    def node_index(self):
+        """The position of each node keyed by fid, built at first use."""
+        if self._node_index is None:
+            self._node_index = {node: i for i, node in enumerate(self.node_ids.tolist())}
+        return self._node_index
+
+    @property
+    def link_index(self):
+        """The position of each link keyed by fid, built at first use."""
+        if self._link_index is None:
+            self._link_index = {link: i for i, link in enumerate(self.link_fids.tolist())}
+        return self._link_index
+
+    def link_coords(self, link):
+        """Get the points of a link as a view of the coordinate buffer.
+
+        :param link: int
+            The position of the link
+        :return: numpy.ndarray of shape (n, 2)
+        """
+        return self.coords[self.coord_offsets[link]:self.coord_offsets[link + 1]]
+
+    def link_geometries(self, links):
+        """Build the LineString of each of the links by one call, slicing the points out of the coordinate buffer.
+
+        :param links: array-like
+            The positions of links
+        :return: numpy.ndarray
+            The shapely.geometry.LineString of each link
+        """
+        links = np.asarray(links, dtype=np.intp)
+        if len(links) == 0:
+            return np.empty(0, dtype=object)
+        starts = self.coord_offsets[links]
+        counts = self.coord_offsets[links + 1] - starts
+        # The index in coords of every point of the links, in order
+        first_points = np.cumsum(counts) - counts
+        point_indexes = np.arange(counts.sum()) + np.repeat(starts - first_points, counts)
+        return shapely.linestrings(self.coords[point_indexes], indices=np.repeat(np.arange(len(links)), counts))
+
+
+def store_directory(path):
+    """Get the directory of the columnar store of the given ITN file.
+
+    :param path: string
+        The path of the source GeoJSON, e.g. 'Material/itn/solent_itn.json'
+    :return: string
+    """
+    return os.path.join(cache_dir, os.path.splitext(os.path.basename(path))[0])
+
+
+def convert_itn(path=solent_itn_json_path):
+    """Convert the ITN GeoJSON to columnar .npy files and a JSON sidecar recording the source.
+    This parses the JSON once; later runs open the arrays by memory mapping.
+    Concurrent writers each convert into their own directory; the store is published by renaming it.
+
+    :param path: string
+        The path of the source GeoJSON
+    :return: dictionary
+        The metadata written to the sidecar
+    """
+    with open(path, 'r') as f:
+        itn_json = json.load(f)
+    road_nodes = itn_json['roadnodes']
+    road_links = itn_json['roadlinks']
+
+    node_ids = np.array(list(road_nodes))
+    node_index = {node: i for i, node in enumerate(road_nodes)}
+    node_coords = np.array([road_nodes[node]['coords'][:2] for node in road_nodes], dtype=float).reshape(-1, 2)
+    links = list(road_links)
+    coords_list = [road_links[link]['coords'] for link in links]
+    counts = np.fromiter(map(len, coords_list), dtype=np.int64, count=len(links))
+    coord_offsets = np.zeros(len(links) + 1, dtype=np.int64)
+    np.cumsum(counts, out=coord_offsets[1:])
+    arrays = {
+        'node_ids': node_ids,
+        'node_coords': node_coords,
+        'link_fids': np.array(links),
+        'link_start': np.fromiter((node_index[road_links[link]['start']] for link in links), dtype=np.int32,
+                                  count=len(links)),
+        'link_end': np.fromiter((node_index[road_links[link]['end']] for link in links), dtype=np.int32,
+                                count=len(links)),
+        'link_length': np.fromiter((road_links[link]['length'] for link in links), dtype=float, count=len(links)),
+        'coord_offsets': coord_offsets,
+        'coords': np.array([point[:2] for coords in coords_list for point in coords], dtype=float).reshape(-1, 2),
+    }
+
+    meta = {'source': list(file_signature(path)), 'nodes': len(node_ids), 'links': len(links),
+            'points': int(coord_offsets[-1])}
+    # Write the whole store into a directory of this writer and rename it into place,
+    # so a reader never sees a mix of the columns of two writers
+    directory = store_directory(path)
+    tmp_directory = temp_path(directory)
+    os.makedirs(tmp_directory)
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_directory, name + '.npy'), array)
+        with open(os.path.join(tmp_directory, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        if os.path.isdir(directory):  # A store of an older file, moved aside since a directory is not replaced
+            old_directory = temp_path(directory) + '.old'
+            try:
+                os.replace(directory, old_directory)
+            except FileNotFoundError:  # Already moved aside by another writer
+                pass
+            shutil.rmtree(old_directory, ignore_errors=True)  # Open memory maps keep the files they use
+        try:
+            os.replace(tmp_directory, directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+            # Another writer converted the same file and published its store first
+    finally:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+    return meta
+
+
+def open_itn(path=solent_itn_json_path):
+    """Open the columnar store of the given ITN file, converting the file first when the store is missing
+    or the file has changed since the conversion.
+
+    :param path: string
+        The path of the source GeoJSON
+    :return: ItnStore
+        The same store is returned while the file is unchanged
+    """
+    key = (path, file_signature(path))
+    if key in _store_memo:
+        return _store_memo[key]
+
+    directory = store_directory(path)
+    meta_path = os.path.join(directory, 'meta.json')
+    meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta['source'] != list(file_signature(path)):
+            meta = None
+    if meta is None:
+        convert_itn(path)
+    _store_memo.clear()
+    _store_memo[key] = ItnStore(directory)
+    return _store_memo[key]
+
+
+if __name__ == '__main__':
+    # Convert the ITN ahead of the first request
+    print(convert_itn())
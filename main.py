@@ -1,6 +1,8 @@
+import argparse
 import os
 
 from gui import init_gui
+from instrumentation import Recorder, save_outputs
 
 def check_files():
     """Check the existence of all files request by the program.
@@ -25,11 +27,23 @@ def check_files():
             print('Can not find ' + value + 'in root directory')
     return all_file_exist
 
-def main():
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Flood Emergency Planning')
+    parser.add_argument('--stats', help='write the time, peak memory and counts of each stage as JSON on exit')
+    parser.add_argument('--trace', help='write the stages in Chrome trace format on exit')
+    parser.add_argument('--profile', help='write the cProfile statistics of the slowest stage on exit')
+    args = parser.parse_args(argv)
+
     if check_files():
-        window = init_gui()
+        recorder = None
+        if args.stats or args.trace or args.profile:
+            recorder = Recorder(memory=bool(args.stats or args.trace), profile=bool(args.profile))
+        window = init_gui(recorder)
         # Show the window
         window.mainloop()
+        if recorder is not None:
+            print(recorder.summary())
+            save_outputs(recorder, args.stats, args.trace, args.profile)
     else:
         return
 
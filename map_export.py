@@ -0,0 +1,168 @@
+import argparse
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from batch import read_locations
+from instrumentation import Recorder, recording, save_outputs, stage
+from pipeline import default_radius, evacuation_routes, preload
+from shared_pool import DatasetPool, attach
+from t2_highest_point import buffer_mask, clip_elevation, load_elevation
+
+_canvas_memo = {}  # The map canvas of this process, reused by every map it exports
+
+
+def export_map(task):
+    """Route one location and save its map as a PNG file; this runs in worker processes.
+    The figure is created by the first map of the process, later maps only swap the layers of the request.
+
+    :param task: tuple(location_id, x, y, crs, radius, clip_mode, out_dir, engine)
+        engine is passed to evacuation_routes()
+    :return: dictionary
+        The 'id', the 'path' of the map (None when the location is not routed), the 'status' of the route,
+        the seconds of 'route' (routing and clipping the elevation) and of 'render' (drawing and saving the map)
+    """
+    from t5_map_plotting import MapCanvas  # Imported by the worker processes only
+
+    location_id, x, y, crs, radius, clip_mode, out_dir, engine = task
+    start_time = time.perf_counter()
+    result = evacuation_routes([x], [y], crs, radius, geometry=True, engine=engine)[0]
+    summary = {'id': location_id, 'path': None, 'status': result['status'], 'route': None, 'render': None}
+    if result['status'] != 'ok':
+        summary['route'] = time.perf_counter() - start_time
+        return summary
+    user_location = (result['x'], result['y'])
+    highest_point = (result['highest_x'], result['highest_y'])
+    with stage('clip elevation'):
+        elevation_index = load_elevation()
+        _, mask_polygon = buffer_mask(elevation_index, user_location, radius)
+        local_elevation_array, out_transform = clip_elevation(elevation_index, mask_polygon)
+    summary['route'] = time.perf_counter() - start_time
+
+    if 'canvas' not in _canvas_memo:
+        _canvas_memo['canvas'] = MapCanvas()
+    map_canvas = _canvas_memo['canvas']
+    summary['path'] = os.path.join(out_dir, '{}.png'.format(location_id))
+    map_canvas.update(user_location, highest_point, result['geometry'], local_elevation_array, out_transform,
+                      clip_mode)
+    map_canvas.save(summary['path'])
+    summary['render'] = map_canvas.render_time
+    return summary
+
+
+def render_summary(render_times, elapsed):
+    """Summarise the render time of maps.
+
+    :param render_times: list
+        The seconds taken to render each map
+    :param elapsed: float
+        The seconds of the whole export
+    :return: dictionary
+        The number of 'maps', the 'mean', 'median' and 'p95' render seconds, the elapsed 'seconds'
+        and the 'maps_per_second'
+    """
+    times = np.array(render_times, dtype=float)
+    if len(times) == 0:
+        return {'maps': 0, 'mean': None, 'median': None, 'p95': None, 'seconds': elapsed, 'maps_per_second': 0.0}
+    return {'maps': len(times), 'mean': float(times.mean()), 'median': float(np.median(times)),
+            'p95': float(np.percentile(times, 95)), 'seconds': elapsed,
+            'maps_per_second': len(times) / elapsed if elapsed > 0 else 0.0}
+
+
+def export_maps(input_path, out_dir, crs='BNG', radius=default_radius, clip_mode=1, processes=1, shared=False,
+                recorder=None):
+    """Export the map of every location of the input file as a PNG file, rendered offscreen.
+
+    :param input_path: string
+        The file of locations, see batch.read_locations()
+    :param out_dir: string
+        The directory of the maps, which are named by the id of locations
+    :param crs: string
+        The crs of locations, 'BNG' or 'WGS84'
+    :param radius: int or float
+        The radius of searching the highest point; use meter as unit
+    :param clip_mode: int
+        1 to clip the map by the range of the background, see t5_map_plotting.display_extent_of()
+    :param processes: int
+        The number of worker processes; 1 to run in this process
+    :param shared: bool
+        Route over the CSR graph, with the datasets of the worker processes attached from one
+        shared_pool.DatasetPool instead of loaded by each of them
+    :param recorder: instrumentation.Recorder or None
+        Record the stages of the export in this process
+    :return summaries: list
+        The dictionary returned by export_map() for each location
+    :return timing: dictionary
+        The summary of render times, see render_summary()
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    engine = 'csr' if shared else 'networkx'
+    tasks = ((location_id, x, y, crs, radius, clip_mode, out_dir, engine)
+             for location_id, x, y in read_locations(input_path, crs))
+
+    start_time = time.perf_counter()
+    summaries = []
+    dataset_pool = DatasetPool() if shared and processes > 1 else None
+    if dataset_pool is not None:
+        pool = Pool(processes, initializer=attach, initargs=(dataset_pool.create(),))
+    else:
+        # Build the derived data once in this process; the worker processes then find it in the cache
+        # instead of all building it at the same time, and forked workers inherit the loaded datasets
+        with recording(recorder), stage('preload'):
+            preload()
+        pool = Pool(processes, initializer=preload) if processes > 1 else None
+    try:
+        with recording(recorder):
+            if pool is None:
+                results = map(export_map, tasks)
+            else:
+                results = pool.imap(export_map, tasks)
+            for summary in results:
+                summaries.append(summary)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if dataset_pool is not None:
+            dataset_pool.close()
+
+    elapsed = time.perf_counter() - start_time
+    return summaries, render_summary([summary['render'] for summary in summaries if summary['path']], elapsed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export the evacuation map of each location as a PNG file '
+                                                 'without the GUI.')
+    parser.add_argument('input', help='CSV (x,y or lat,lon columns), GeoJSON or GeoJSON lines of locations')
+    parser.add_argument('-o', '--output', default='maps', help='directory of the maps')
+    parser.add_argument('--crs', choices=['BNG', 'WGS84'], default='BNG', help='CRS of the input locations')
+    parser.add_argument('--radius', type=float, default=default_radius, help='radius of the search in meters')
+    parser.add_argument('--clip', type=int, choices=[0, 1], default=1,
+                        help='1 to clip the map by the range of the background')
+    parser.add_argument('--processes', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--shared', action='store_true',
+                        help='route over the CSR graph with datasets shared by the worker processes')
+    parser.add_argument('--stats', help='write the time, peak memory and counts of each stage as JSON')
+    args = parser.parse_args(argv)
+
+    recorder = Recorder() if args.stats else None
+    summaries, timing = export_maps(args.input, args.output, args.crs, args.radius, args.clip, args.processes,
+                                    args.shared, recorder)
+    for summary in summaries:
+        if summary['path'] is None:
+            print('{}: {}'.format(summary['id'], summary['status']), file=sys.stderr)
+    if timing['maps']:
+        print('Exported {maps} maps in {seconds:.2f} s ({maps_per_second:.2f} maps/s); render time mean '
+              '{mean:.3f} s, median {median:.3f} s, p95 {p95:.3f} s'.format(**timing), file=sys.stderr)
+    else:
+        print('No map exported', file=sys.stderr)
+    if recorder is not None:
+        print(recorder.summary(), file=sys.stderr)
+        save_outputs(recorder, args.stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+from collections import defaultdict
+
+import numpy as np
+
+from csr_graph import csr_batch_shortest_path
+from instrumentation import stage
+from itn_store import open_itn, solent_itn_json_path
+from t1_user_input import check_coordinates, coordinates_transform, load_island
+from t2_highest_point import find_highest_point, find_highest_points, load_elevation, point_elevation
+from t3_nearest_itn import get_nearest_itn_node, get_nearest_itn_nodes, load_node_index
+from t4_shortest_path import batch_shortest_path, links_gdf, load_itn_graph, one_to_many_shortest_path, route_gdf
+from target_raster import lookup_target
+
+default_radius = 5000  # The radius of searching the highest point; use meter as unit
+default_candidate_num = 5  # The number of high points compared by rank_high_ground()
+default_candidate_separation = 500  # The distance between two high points compared; use meter as unit
+
+
+def preload():
+    """Load every dataset used by the pipeline, so that later requests only hit the in-memory caches.
+    """
+    with stage('load island'):
+        load_island()
+    with stage('load elevation'):
+        load_elevation()
+    with stage('load node index'):
+        load_node_index()
+    with stage('load graph'):
+        load_itn_graph()
+
+
+def evacuation_routes(xs, ys, crs='BNG', radius=default_radius, geometry=False, use_targets=False,
+                      engine='networkx'):
+    """Run the same pipeline as gui.run for many locations at once: coordinate transform, island check,
+    highest point, nearest ITN nodes and the shortest path.
+    Locations heading for the same ITN node are routed by one search.
+
+    :param xs: array-like
+        The x coordinates (or latitudes) of locations
+    :param ys: array-like
+        The y coordinates (or longitudes) of locations
+    :param crs: string
+        The crs of locations, 'BNG' or 'WGS84'
+    :param radius: int or float
+        The radius of searching the highest point; use meter as unit
+    :param geometry: bool
+        Also build the GeoDataFrame of each route
+    :param use_targets: bool
+        Read the highest point from the precomputed target raster (the highest point of the centre of the
+        cell containing the location) when it exists for the radius
+    :param engine: string
+        'networkx' to search the graph of t4_shortest_path, or 'csr' to search the CSR graph of csr_graph,
+        which is what processes attached to a shared_pool.DatasetPool have
+    :return: list
+        A dictionary for each location with 'x', 'y' (British National Grid), 'highest_x', 'highest_y',
+        'start_node', 'end_node', 'travel_time' (minute), 'path' (sequence of nodes), 'geometry'
+        (GeoDataFrame, only when asked for) and 'status' ('ok', 'outside island', 'no high ground' or 'no route')
+    """
+    with stage('coordinate transform'):
+        xs, ys = coordinates_transform(crs, xs, ys)
+    with stage('check coordinates'):
+        on_island = check_coordinates(xs, ys)
+    results = [{'x': float(x), 'y': float(y), 'highest_x': None, 'highest_y': None,
+                'start_node': None, 'end_node': None, 'travel_time': None, 'path': None,
+                'status': 'ok' if valid else 'outside island'}
+               for x, y, valid in zip(xs, ys, on_island)]
+
+    # Identify the highest point of each location on the island
+    routed = []
+    with stage('highest point'):
+        for i in np.flatnonzero(on_island):
+            highest_point = lookup_target((xs[i], ys[i]), radius) if use_targets else None
+            if highest_point is None:
+                highest_point = find_highest_point((xs[i], ys[i]), radius)
+            else:
+                highest_point = highest_point[:2]
+            if highest_point is None:
+                results[i]['status'] = 'no high ground'
+                continue
+            results[i]['highest_x'], results[i]['highest_y'] = highest_point
+            routed.append(i)
+    if not routed:
+        return results
+
+    # Identify the nearest ITN nodes of all locations and highest points by two queries
+    with stage('nearest node'):
+        start_nodes = get_nearest_itn_nodes([(results[i]['x'], results[i]['y']) for i in routed])
+        end_nodes = get_nearest_itn_nodes([(results[i]['highest_x'], results[i]['highest_y']) for i in routed])
+    groups = defaultdict(list)
+    for i, start_node, end_node in zip(routed, start_nodes.tolist(), end_nodes.tolist()):
+        results[i]['start_node'], results[i]['end_node'] = start_node, end_node
+        groups[end_node].append(i)
+
+    # Identify the shortest paths, one search for each end node
+    search = csr_batch_shortest_path if engine == 'csr' else batch_shortest_path
+    links = {}  # The links of the routes found by the CSR graph, whose geometries are built without the graph
+    with stage('shortest path'):
+        for end_node, group in groups.items():
+            routes = search([results[i]['start_node'] for i in group], end_node)
+            for i in group:
+                route = routes[results[i]['start_node']]
+                if route is None:
+                    results[i]['status'] = 'no route'
+                    continue
+                results[i]['travel_time'] = route['travel_time']
+                results[i]['path'] = route['path']
+                if 'links' in route:
+                    links[i] = route['links']
+    if geometry:
+        with stage('path geometry'):
+            for i in routed:
+                if i in links:
+                    results[i]['geometry'] = links_gdf(links[i], open_itn(solent_itn_json_path))
+                elif results[i]['path'] is not None:
+                    results[i]['geometry'] = route_gdf(results[i]['path'])
+    return results
+
+
+def rank_high_ground(location, radius=default_radius, candidate_num=default_candidate_num,
+                     separation=default_candidate_separation, cancel_event=None):
+    """Compare the highest points around a location by the time of walking there, instead of taking the
+    single highest point: a point nearly as high may be much closer on foot.
+    The candidates are the highest points inside the radius apart from each other by the separation;
+    they are snapped to ITN nodes and reached by one search from the node of the location,
+    which stops once every candidate is settled.
+
+    :param location: tuple(x, y)
+        A xy coordinate pair in CRS of British National Grid
+    :param radius: int or float
+        The radius of searching the high points; use meter as unit
+    :param candidate_num: int
+        The number of high points compared
+    :param separation: int or float
+        The distance between two high points compared; use meter as unit
+    :param cancel_event: threading.Event or None
+        When given, setting this event aborts the search with t4_shortest_path.RouteCancelled
+    :return: list
+        A dictionary for each candidate reached, ranked by travel time, with 'x', 'y', 'elevation',
+        'elevation_gain' (meter above the location, None when the location has no elevation),
+        'start_node', 'end_node', 'travel_time' (minute) and 'path' (sequence of nodes).
+        Candidates snapped to the same node as a higher candidate, or not reachable, are left out.
+    """
+    with stage('high points'):
+        points = find_highest_points(location, radius, candidate_num, separation)
+    if not points:
+        return []
+    with stage('nearest node'):
+        start_node = get_nearest_itn_node(location)
+        end_nodes = get_nearest_itn_nodes([(x, y) for x, y, _ in points]).tolist()
+    with stage('shortest path'):
+        routes = one_to_many_shortest_path(start_node, list(dict.fromkeys(end_nodes)), cancel_event=cancel_event)
+
+    location_elevation = point_elevation(location)
+    candidates = []
+    used_nodes = set()
+    for (x, y, elevation), end_node in zip(points, end_nodes):
+        if end_node in used_nodes or routes[end_node] is None:
+            continue
+        used_nodes.add(end_node)
+        candidates.append({'x': x, 'y': y, 'elevation': elevation,
+                           'elevation_gain': None if location_elevation is None else elevation - location_elevation,
+                           'start_node': start_node, 'end_node': end_node,
+                           'travel_time': routes[end_node]['travel_time'], 'path': routes[end_node]['path']})
+    candidates.sort(key=lambda candidate: candidate['travel_time'])
+    return candidates
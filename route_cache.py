@@ -0,0 +1,218 @@
+import atexit
+import threading
+from collections import OrderedDict
+
+from data_cache import load_cache, save_cache
+from instrumentation import count
+
+route_cache_name = 'route_cache.pickle'
+default_cache_size = 256  # The number of routes kept in memory
+
+
+class RouteCache:
+    """A bounded least-recently-used cache of routes keyed by (start node, end node, weighting profile).
+
+    Each route is a dictionary with the 'path' (sequence of fid of nodes), the 'links' along it (fid of links),
+    the 'travel_time' in minutes, the 'geometry' (GeoDataFrame, or None when it has not been built)
+    and the links 'closed' when it was found (see t4_shortest_path.close_links()).
+    The cache belongs to one version of the network and elevation, identified by
+    t4_shortest_path.network_cache_key(); it is emptied whenever a lookup comes with another key,
+    so routes over an old network or elevation are never returned.
+    With the persistent tier, the routes are also written to the derived data cache under the key of the graph,
+    and read back by a later process using the same graph; routes found while links were closed are not written,
+    since the closures only last as long as the process.
+    """
+
+    def __init__(self, max_size=default_cache_size, persistent=False):
+        """
+        :param max_size: int
+            The number of routes kept; the least recently used route is evicted beyond it
+        :param persistent: bool
+            Keep the routes on disk between processes, see save()
+        """
+        self.max_size = max_size
+        self.persistent = persistent
+        self.graph_key = None
+        self.routes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.closed_links = frozenset()  # Routes along these links are never returned, see close_links()
+        self._lock = threading.Lock()
+        if persistent:
+            atexit.register(self.save)
+
+    def configure(self, max_size=None, persistent=None):
+        """Change the size of the cache or turn the persistent tier on or off.
+
+        :param max_size: int or None
+            The number of routes kept; None to keep the current size
+        :param persistent: bool or None
+            Keep the routes on disk between processes; None to keep the current setting
+        """
+        with self._lock:
+            if max_size is not None:
+                self.max_size = max_size
+                self._evict()
+            if persistent and not self.persistent:
+                atexit.register(self.save)
+                self.graph_key = None  # Read the persistent tier at the next lookup
+                self.routes.clear()
+            elif persistent is False and self.persistent:
+                atexit.unregister(self.save)
+            if persistent is not None:
+                self.persistent = persistent
+
+    def _use_graph(self, graph_key):
+        # Switch to the routes of the given graph; the lock is held by the caller
+        if graph_key == self.graph_key:
+            return
+        self.routes.clear()
+        self.graph_key = graph_key
+        if self.persistent:
+            self.routes.update((key, route) for key, route in load_cache(route_cache_name, graph_key) or []
+                               if not self._uses_closed_links(route))
+            self._evict()
+
+    def _evict(self):
+        while len(self.routes) > self.max_size:
+            self.routes.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, graph_key, start_node, end_node, profile):
+        """Look up a route, marking it as the most recently used.
+
+        :param graph_key: string
+            The key of the graph the route is searched on
+        :param start_node: string
+        :param end_node: string
+        :param profile: tuple
+            The weighting parameters, e.g. (walking_speed, climb_penalty)
+        :return: dictionary or None
+        """
+        key = (start_node, end_node, profile)
+        with self._lock:
+            self._use_graph(graph_key)
+            route = self.routes.get(key)
+            if route is None:
+                self.misses += 1
+                count('route cache misses')
+                return None
+            self.routes.move_to_end(key)
+            self.hits += 1
+        count('route cache hits')
+        return route
+
+    def put(self, graph_key, start_node, end_node, profile, route):
+        """Add a route, evicting the least recently used routes beyond the size of the cache.
+
+        :param graph_key: string
+        :param start_node: string
+        :param end_node: string
+        :param profile: tuple
+        :param route: dictionary
+            With 'path', 'travel_time' and 'geometry'
+        """
+        key = (start_node, end_node, profile)
+        with self._lock:
+            self._use_graph(graph_key)
+            self.routes[key] = route
+            self.routes.move_to_end(key)
+            self._evict()
+
+    def invalidate(self, predicate):
+        """Drop the routes for which the predicate is true, leaving the others and their order alone.
+
+        :param predicate: function
+            Called with each route dictionary
+        :return: int
+            The number of routes dropped
+        """
+        with self._lock:
+            stale = [key for key, route in self.routes.items() if predicate(route)]
+            for key in stale:
+                del self.routes[key]
+            self.invalidations += len(stale)
+        count('routes invalidated', len(stale))
+        return len(stale)
+
+    def _uses_closed_links(self, route):
+        # A route cached without its links can not be checked, so it is taken as using them
+        return bool(self.closed_links) and ('links' not in route or not self.closed_links.isdisjoint(route['links']))
+
+    def close_links(self, links):
+        """Drop the routes along any of the links, and keep dropping them when they are read from the persistent
+        tier later, until the links are reopened.
+
+        :param links: iterable
+            The fid of links
+        :return: int
+            The number of routes dropped
+        """
+        with self._lock:
+            self.closed_links = self.closed_links | frozenset(links)
+        return self.invalidate(self._uses_closed_links)
+
+    def reopen_links(self, links):
+        """Stop dropping the routes along the links, and drop the routes found while any of them was closed,
+        since a shorter route may now go along it.
+
+        :param links: iterable
+            The fid of links
+        :return: int
+            The number of routes dropped
+        """
+        links = frozenset(links)
+        with self._lock:
+            self.closed_links = self.closed_links - links
+        return self.invalidate(lambda route: not links.isdisjoint(route.get('closed', ())))
+
+    def clear(self):
+        """Drop every route in memory and reset the counters.
+        """
+        with self._lock:
+            self.routes.clear()
+            self.graph_key = None
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def save(self):
+        """Write the routes in memory to the persistent tier; it does nothing without the persistent tier.
+        """
+        with self._lock:
+            if self.persistent and self.graph_key is not None:
+                save_cache(route_cache_name, self.graph_key,
+                           [(key, route) for key, route in self.routes.items() if not route.get('closed')])
+
+    def stats(self):
+        """Get the counters of the cache.
+
+        :return: dictionary
+            'size', 'max_size', 'hits', 'misses', 'evictions', 'invalidations' and the 'hit_rate'
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.routes), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'invalidations': self.invalidations,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+if __name__ == "__main__":  # For Unit Test
+    test_cache = RouteCache(max_size=2)
+    test_cache.put('graph', 'a', 'b', (1, 10), {'path': ['a', 'b'], 'travel_time': 1.0, 'geometry': None})
+    test_cache.put('graph', 'a', 'c', (1, 10), {'path': ['a', 'c'], 'travel_time': 2.0, 'geometry': None})
+    assert test_cache.get('graph', 'a', 'b', (1, 10))['travel_time'] == 1.0
+    test_cache.put('graph', 'b', 'c', (1, 10), {'path': ['b', 'c'], 'travel_time': 3.0, 'geometry': None})
+    assert test_cache.get('graph', 'a', 'c', (1, 10)) is None  # The least recently used route was evicted
+    assert test_cache.get('graph', 'a', 'b', (1, 10)) is not None
+    assert test_cache.get('graph', 'a', 'b', (2, 10)) is None  # Another weighting profile
+    assert test_cache.get('new graph', 'a', 'b', (1, 10)) is None  # Invalidated by a new graph
+    test_cache.put('new graph', 'a', 'b', (1, 10), {'path': ['a', 'b'], 'travel_time': 1.0, 'geometry': None})
+    test_cache.put('new graph', 'b', 'c', (1, 10), {'path': ['b', 'c'], 'travel_time': 3.0, 'geometry': None})
+    assert test_cache.invalidate(lambda route: 'c' in route['path']) == 1
+    assert test_cache.get('new graph', 'a', 'b', (1, 10)) is not None
+    test_cache.put('new graph', 'a', 'c', (1, 10), {'path': ['a', 'c'], 'links': ['ac'], 'travel_time': 2.0,
+                                                    'geometry': None})
+    assert test_cache.close_links(['ac']) == 2  # The route along the link and the route without its links
+    assert test_cache.reopen_links(['ac']) == 0
+    print(test_cache.stats())
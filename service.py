@@ -0,0 +1,367 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+
+from batch import route_chunk
+from pipeline import default_radius, preload
+
+default_host = '127.0.0.1'
+default_port = 8080
+latency_window = 1000  # The number of latest requests whose latency is summarised by /stats
+status_reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                  500: 'Internal Server Error'}
+
+
+def route_location(params):
+    """Route one location through the same pipeline as gui.run; this runs in the executor.
+
+    :param params: dictionary
+        'x', 'y', and optionally 'crs' ('BNG' or 'WGS84'), 'radius' (meter), 'geometry' (a JSON boolean) and 'id'
+    :return: dictionary
+        The result of pipeline.evacuation_routes(), with the route as GeoJSON when 'geometry' is asked for
+    """
+    task = ([(params.get('id'), float(params['x']), float(params['y']))], params.get('crs', 'BNG'),
+            float(params.get('radius', default_radius)), params.get('geometry', False), False, None, 'networkx')
+    results, _ = route_chunk(task)
+    return results[0]
+
+
+def percentiles(values):
+    """Summarise latencies by their mean and percentiles.
+
+    :param values: list
+        Use second as unit
+    :return: dictionary
+        'mean', 'p50', 'p95', 'p99' and 'max'; use millisecond as unit
+    """
+    if not values:
+        return {'mean': None, 'p50': None, 'p95': None, 'p99': None, 'max': None}
+    values = np.asarray(values) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'mean': float(values.mean()), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99),
+            'max': float(values.max())}
+
+
+class RoutingService:
+    """A long-running routing service which keeps the datasets and the graph loaded in its workers.
+
+    Requests are parsed on the event loop, and the CPU-bound pipeline runs in an executor: worker processes
+    by default, which search in parallel, or threads sharing the datasets of this process.
+    Endpoints:
+
+    - POST /route with a JSON body, or GET /route?x=..&y=.., see route_location() for the parameters
+    - GET /health
+    - GET /stats: the number of requests and errors and the latency of the latest requests
+    """
+
+    def __init__(self, workers=None, threads=False):
+        """
+        :param workers: int or None
+            The number of workers; None for the number of CPUs
+        :param threads: bool
+            Use threads instead of processes
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.threads = threads
+        self.executor = None
+        self.requests = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=latency_window)
+        self.started = time.time()
+
+    def start(self):
+        """Create the executor and load the datasets in every worker before serving.
+        """
+        # Build the derived data once here; worker processes then find it in the cache instead of all
+        # building it at the same time, and forked workers inherit the loaded datasets
+        preload()
+        if self.threads:
+            self.executor = ThreadPoolExecutor(self.workers)
+        else:
+            self.executor = ProcessPoolExecutor(self.workers, initializer=preload)
+            # Start every worker process now, so that the first requests do not wait for the datasets;
+            # processes are only added while none is idle, so keep them all busy for a moment
+            for future in [self.executor.submit(time.sleep, 0.5) for _ in range(self.workers)]:
+                future.result()
+
+    def close(self):
+        """Stop the workers.
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    async def route(self, params):
+        """Route a location in the executor.
+
+        :param params: dictionary
+        :return: tuple(status, payload)
+        """
+        if 'x' not in params or 'y' not in params:
+            return 400, {'error': 'x and y are required'}
+        if params.get('crs', 'BNG') not in ('BNG', 'WGS84'):
+            return 400, {'error': 'crs must be BNG or WGS84'}
+        try:
+            float(params['x']), float(params['y']), float(params.get('radius', default_radius))
+        except (TypeError, ValueError):
+            return 400, {'error': 'x, y and radius must be numbers'}
+        if not isinstance(params.get('geometry', False), bool):  # e.g. "false" would be read as true
+            return 400, {'error': 'geometry must be true or false'}
+        loop = asyncio.get_running_loop()
+        return 200, await loop.run_in_executor(self.executor, route_location, params)
+
+    def stats(self):
+        """Get the counters of the service for /stats.
+        """
+        return {'requests': self.requests, 'errors': self.errors, 'uptime': time.time() - self.started,
+                'workers': self.workers, 'executor': 'threads' if self.threads else 'processes',
+                'latency': percentiles(list(self.latencies))}
+
+    async def dispatch(self, method, target, body):
+        """Answer a request.
+
+        :param method: string
+        :param target: string
+            The path and query of the request
+        :param body: bytes
+        :return: tuple(status, payload)
+        """
+        url = urlsplit(target)
+        if url.path == '/route':
+            if method == 'POST':
+                try:
+                    params = json.loads(body or b'{}')
+                except ValueError:
+                    return 400, {'error': 'the body is not JSON'}
+                if not isinstance(params, dict):
+                    return 400, {'error': 'the body must be a JSON object'}
+            elif method == 'GET':
+                params = dict(parse_qsl(url.query))
+                if 'geometry' in params:
+                    params['geometry'] = params['geometry'].lower() in ('1', 'true', 'yes')
+            else:
+                return 405, {'error': 'use GET or POST'}
+            return await self.route(params)
+        if url.path == '/health':
+            return 200, {'status': 'ok'}
+        if url.path == '/stats':
+            return 200, self.stats()
+        return 404, {'error': 'unknown path ' + url.path}
+
+    async def handle_connection(self, reader, writer):
+        """Serve the requests of a connection, keeping it alive between requests as HTTP/1.1 does.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                start_time = time.perf_counter()
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                    headers = await read_headers(reader)
+                    body = await reader.readexactly(int(headers.get('content-length', 0)))
+                except (ValueError, asyncio.IncompleteReadError):
+                    await write_response(writer, 400, {'error': 'malformed request'}, False)
+                    break
+                try:
+                    status, payload = await self.dispatch(method, target, body)
+                except Exception as error:
+                    status, payload = 500, {'error': str(error)}
+                self.requests += 1
+                if status != 200:
+                    self.errors += 1
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                await write_response(writer, status, payload, keep_alive)
+                self.latencies.append(time.perf_counter() - start_time)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=default_host, port=default_port, ready=None):
+        """Serve until cancelled.
+
+        :param host: string
+        :param port: int
+            0 to choose a free port
+        :param ready: asyncio.Future or None
+            Set to the (host, port) listened on once the service accepts connections
+        """
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        address = server.sockets[0].getsockname()[:2]
+        print('Serving on http://{}:{}'.format(*address), file=sys.stderr)
+        if ready is not None:
+            ready.set_result(address)
+        async with server:
+            await server.serve_forever()
+
+
+async def read_headers(reader):
+    """Read the header lines of a request or response.
+
+    :param reader: asyncio.StreamReader
+    :return: dictionary
+        The headers keyed by their lowercase name
+    """
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            return headers
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+
+async def write_response(writer, status, payload, keep_alive):
+    """Write a JSON response.
+
+    :param writer: asyncio.StreamWriter
+    :param status: int
+    :param payload: dictionary
+    :param keep_alive: bool
+    """
+    body = json.dumps(payload).encode('utf-8')
+    head = 'HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+        status, status_reasons.get(status, ''), len(body), 'keep-alive' if keep_alive else 'close')
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+
+
+def sample_locations(count, seed=0):
+    """Pick random locations on the island for the load generator.
+
+    :param count: int
+    :param seed: int
+    :return: list[tuple(x, y)]
+        Coordinates in British National Grid
+    """
+    from t1_user_input import check_coordinates, load_island
+
+    min_x, min_y, max_x, max_y = load_island()['geometry'].bounds
+    random_generator = np.random.default_rng(seed)
+    locations = []
+    while len(locations) < count:
+        xs = random_generator.uniform(min_x, max_x, count)
+        ys = random_generator.uniform(min_y, max_y, count)
+        on_island = check_coordinates(xs, ys)
+        locations.extend(zip(xs[on_island].tolist(), ys[on_island].tolist()))
+    return locations[:count]
+
+
+async def load_test(host, port, locations, concurrency=16, radius=default_radius, geometry=False):
+    """Send a route request for every location over concurrent keep-alive connections, and measure the latency.
+
+    :param host: string
+    :param port: int
+    :param locations: list[tuple(x, y)]
+        Coordinates in British National Grid
+    :param concurrency: int
+        The number of connections sending requests at the same time
+    :param radius: int or float
+    :param geometry: bool
+        Ask for the geometry of routes
+    :return: dictionary
+        The number of 'requests' and 'errors', the 'seconds' taken, the 'requests_per_second', the 'latency'
+        (see percentiles()) and the count of the 'statuses' of the routes
+    """
+    pending = deque(locations)
+    latencies = []
+    statuses = Counter()
+    errors = 0
+
+    async def client():
+        nonlocal errors
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while pending:
+                x, y = pending.popleft()
+                body = json.dumps({'x': x, 'y': y, 'radius': radius, 'geometry': geometry}).encode('utf-8')
+                start_time = time.perf_counter()
+                writer.write('POST /route HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\n'
+                             'Content-Length: {}\r\n\r\n'.format(host, len(body)).encode('latin-1') + body)
+                await writer.drain()
+                status_line = await reader.readline()
+                headers = await read_headers(reader)
+                payload = json.loads(await reader.readexactly(int(headers['content-length'])))
+                latencies.append(time.perf_counter() - start_time)
+                if status_line.split()[1] != b'200':
+                    errors += 1
+                else:
+                    statuses[payload['status']] += 1
+        finally:
+            writer.close()
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(min(concurrency, len(locations)))])
+    elapsed = time.perf_counter() - start_time
+    return {'requests': len(latencies), 'errors': errors, 'seconds': elapsed,
+            'requests_per_second': len(latencies) / elapsed if elapsed > 0 else 0.0,
+            'latency': percentiles(latencies), 'statuses': dict(statuses)}
+
+
+async def serve_and_load(service, args):
+    """Start the service on a free local port, run the load generator against it and stop the service.
+    """
+    ready = asyncio.get_running_loop().create_future()
+    server_task = asyncio.create_task(service.serve(default_host, 0, ready))
+    host, port = await ready
+    locations = sample_locations(args.requests, args.seed)
+    try:
+        return await load_test(host, port, locations, args.concurrency, args.radius, args.geometry)
+    finally:
+        server_task.cancel()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve evacuation routes over HTTP/JSON, or load test the service.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='run the service')
+    serve_parser.add_argument('--host', default=default_host)
+    serve_parser.add_argument('--port', type=int, default=default_port)
+    load_parser = subparsers.add_parser('load', help='load test a running service')
+    load_parser.add_argument('--host', default=default_host)
+    load_parser.add_argument('--port', type=int, default=default_port)
+    bench_parser = subparsers.add_parser('bench', help='start the service on localhost and load test it')
+    for subparser in (serve_parser, bench_parser):
+        subparser.add_argument('--workers', type=int, help='number of workers, the number of CPUs by default')
+        subparser.add_argument('--threads', action='store_true', help='run the pipeline in threads, not processes')
+    for subparser in (load_parser, bench_parser):
+        subparser.add_argument('--requests', type=int, default=200, help='number of requests')
+        subparser.add_argument('--concurrency', type=int, default=16, help='number of concurrent connections')
+        subparser.add_argument('--radius', type=float, default=default_radius)
+        subparser.add_argument('--geometry', action='store_true', help='ask for the geometry of routes')
+        subparser.add_argument('--seed', type=int, default=0, help='seed of the random locations')
+    args = parser.parse_args(argv)
+
+    if args.command == 'load':
+        locations = sample_locations(args.requests, args.seed)
+        print(json.dumps(asyncio.run(load_test(args.host, args.port, locations, args.concurrency, args.radius,
+                                                args.geometry)), indent=2))
+        return
+
+    service = RoutingService(args.workers, args.threads)
+    service.start()
+    try:
+        if args.command == 'serve':
+            try:
+                asyncio.run(service.serve(args.host, args.port))
+            except KeyboardInterrupt:
+                pass
+        else:
+            print(json.dumps(asyncio.run(serve_and_load(service, args)), indent=2))
+    finally:
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+import argparse
+import json
+import os
+import sys
+import time
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+
+from csr_graph import load_csr_graph, reverse_matrix, set_csr_graph
+from instrumentation import stage
+from itn_store import open_itn, solent_itn_json_path
+from pipeline import default_radius, evacuation_routes, preload
+from t1_user_input import load_island
+from t2_highest_point import load_elevation, set_elevation
+from t3_nearest_itn import set_node_index
+from t4_shortest_path import default_climb_penalty, default_walking_speed
+
+csr_arrays = ['node_ids', 'link_fids', 'indptr', 'indices', 'weights', 'links']
+benchmark_modes = ('shared', 'private')
+
+_attached = []  # The blocks of shared memory attached by this process, kept open while their arrays are in use
+
+
+def share_array(array, blocks):
+    """Describe an array so that other processes can attach it without copying.
+    An array memory-mapped from the whole payload of a .npy file is described by the file, which every process
+    maps from the same page cache; any other array is copied once into a new block of shared memory.
+
+    :param array: numpy.ndarray
+    :param blocks: list
+        The blocks of shared memory created so far; a new block is appended to it
+    :return: dictionary
+        The 'shape' and 'dtype' of the array, with the 'path' and 'offset' of the file or the 'name' of the block
+    """
+    spec = {'shape': array.shape, 'dtype': array.dtype.str}
+    if isinstance(array, np.memmap) and array.filename is not None and array.flags.c_contiguous \
+            and array.offset + array.nbytes == os.path.getsize(array.filename):
+        spec.update(path=array.filename, offset=array.offset)
+        return spec
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+    blocks.append(block)
+    spec['name'] = block.name
+    return spec
+
+
+def attach_array(spec):
+    """Attach an array described by share_array(), without copying it. The array is read only.
+
+    :param spec: dictionary
+    :return: numpy.ndarray
+    """
+    if 'path' in spec:
+        return np.memmap(spec['path'], dtype=spec['dtype'], mode='r', offset=spec['offset'], shape=spec['shape'])
+    block = shared_memory.SharedMemory(name=spec['name'])
+    _attached.append(block)
+    array = np.ndarray(spec['shape'], spec['dtype'], buffer=block.buf)
+    array.flags.writeable = False
+    return array
+
+
+class DatasetPool:
+    """The datasets of the evacuation pipeline, placed once where every worker process can attach them
+    without copying:
+
+    - the elevation grid (the memory-mapped .npy file) and its max-pyramid
+    - the fid and coordinates of ITN nodes (memory-mapped from the ITN store)
+    - the CSR arrays of the graph and of the reversed graph, see csr_graph.py
+
+    Workers search the CSR graph (engine 'csr' of pipeline.evacuation_routes()), so no process loads
+    a networkx graph of its own; what is left per worker is the KD-tree of nodes, the island and the node index
+    of the CSR graph. Use it as a context manager, or call close() to free the shared memory.
+    """
+
+    def __init__(self, walking_speed=default_walking_speed, climb_penalty=default_climb_penalty):
+        """
+        :param walking_speed: float
+            The walking speed on flat ground; use meter/minute as unit
+        :param climb_penalty: float
+            The meters of climb which cost one additional minute
+        """
+        self.walking_speed = walking_speed
+        self.climb_penalty = climb_penalty
+        self.blocks = []
+        self.descriptor = None
+
+    def create(self):
+        """Load the datasets in this process and share them.
+
+        :return: dictionary
+            The descriptor passed to attach() in the worker processes
+        """
+        if self.descriptor is not None:
+            return self.descriptor
+        with stage('share datasets'):
+            elevation_index = load_elevation()
+            itn_store = open_itn(solent_itn_json_path)
+            csr_graph = load_csr_graph(self.walking_speed, self.climb_penalty)
+            reverse = reverse_matrix(csr_graph)
+
+            arrays = {'elevation': elevation_index['values'], 'node_ids': itn_store.node_ids,
+                      'node_coords': itn_store.node_coords, 'reverse_indptr': reverse.indptr,
+                      'reverse_indices': reverse.indices, 'reverse_weights': reverse.data}
+            for level, (max_values, max_indexes) in enumerate(elevation_index['levels']):
+                arrays['pyramid_values_{}'.format(level)] = max_values
+                arrays['pyramid_indexes_{}'.format(level)] = max_indexes
+            for name in csr_arrays:
+                arrays['csr_' + name] = csr_graph[name]
+            self.descriptor = {'arrays': {name: share_array(array, self.blocks) for name, array in arrays.items()},
+                               'levels': len(elevation_index['levels']), 'nodata': elevation_index['nodata'],
+                               'transform': elevation_index['transform'], 'bounds': elevation_index['bounds'],
+                               'walking_speed': self.walking_speed, 'climb_penalty': self.climb_penalty}
+        return self.descriptor
+
+    def shared_bytes(self):
+        """Get the size of the blocks of shared memory created by this pool; use byte as unit.
+
+        :return: int
+        """
+        return sum(block.size for block in self.blocks)
+
+    def close(self):
+        """Free the shared memory; processes still attached keep their mapping until they exit.
+        """
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+        self.descriptor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def attach(descriptor):
+    """Attach the datasets of a DatasetPool and use them in this process; this is the initializer
+    of worker processes.
+
+    :param descriptor: dictionary
+        The descriptor returned by DatasetPool.create()
+    """
+    arrays = {name: attach_array(spec) for name, spec in descriptor['arrays'].items()}
+    levels = [(arrays['pyramid_values_{}'.format(level)], arrays['pyramid_indexes_{}'.format(level)])
+              for level in range(descriptor['levels'])]
+    set_elevation({'values': arrays['elevation'], 'nodata': descriptor['nodata'], 'levels': levels,
+                   'transform': descriptor['transform'], 'bounds': descriptor['bounds']})
+    set_node_index(arrays['node_ids'], cKDTree(arrays['node_coords']))
+
+    csr_graph = {name: arrays['csr_' + name] for name in csr_arrays}
+    node_num = len(csr_graph['node_ids'])
+    csr_graph['reverse_matrix'] = csr_matrix(
+        (arrays['reverse_weights'], arrays['reverse_indices'], arrays['reverse_indptr']),
+        shape=(node_num, node_num), copy=False)
+    set_csr_graph(csr_graph, descriptor['walking_speed'], descriptor['climb_penalty'])
+    load_island()
+
+
+def process_memory():
+    """Get the memory of this process from /proc/self/smaps_rollup; elsewhere, every value is the peak RSS.
+
+    :return: dictionary
+        'rss' (resident), 'pss' (resident, with each shared page divided among the processes mapping it)
+        and 'private' (resident pages used by this process only); use byte as unit
+    """
+    memory = {}
+    try:
+        with open('/proc/self/smaps_rollup', 'r') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                    memory[name] = int(value.split()[0]) * 1024
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        return {'rss': peak, 'pss': peak, 'private': peak}
+    return {'rss': memory['Rss'], 'pss': memory['Pss'],
+            'private': memory['Private_Clean'] + memory['Private_Dirty']}
+
+
+def route_sample(task):
+    """Route a chunk of locations in a worker process of scaling_benchmark().
+
+    :param task: tuple(locations, radius, engine)
+    :return: tuple(route_num, pid, memory)
+        The number of routes found, the id of the worker process and its process_memory() afterwards
+    """
+    locations, radius, engine = task
+    xs, ys = zip(*locations)
+    results = evacuation_routes(xs, ys, 'BNG', radius, engine=engine)
+    return sum(result['status'] == 'ok' for result in results), os.getpid(), process_memory()
+
+
+def scaling_benchmark(locations, max_processes=None, chunk_size=50, radius=default_radius, modes=('shared',)):
+    """Route the same locations with 1 to N worker processes and measure the throughput and the memory
+    of each worker. The workers are spawned rather than forked, so that none of them starts with the datasets
+    loaded by this process.
+
+    :param locations: list[tuple(x, y)]
+        Locations in British National Grid, e.g. service.sample_locations()
+    :param max_processes: int or None
+        The largest number of processes; None for the number of CPUs
+    :param chunk_size: int
+        The number of locations routed together by a worker
+    :param radius: int or float
+        The radius of searching the highest point; use meter as unit
+    :param modes: tuple
+        'shared' attaches the datasets of a DatasetPool; 'private' preloads every dataset in each worker
+        as batch.py does without --shared
+    :return: list
+        A dictionary for each mode and number of processes, with 'mode', 'processes', 'routes', 'seconds',
+        'routes_per_second', 'speedup' and 'efficiency' against one process, the mean 'rss', 'pss' and 'private'
+        memory of a worker and the 'shared_bytes' of the pool; use byte as unit
+    """
+    max_processes = max_processes or os.cpu_count()
+    context = get_context('spawn')
+    chunks = [locations[i:i + chunk_size] for i in range(0, len(locations), chunk_size)]
+    rows = []
+    with DatasetPool() as dataset_pool:
+        descriptor = dataset_pool.create() if 'shared' in modes else None
+        for mode in modes:
+            if mode == 'shared':
+                initializer, initargs, engine = attach, (descriptor,), 'csr'
+            else:
+                initializer, initargs, engine = preload, (), 'networkx'
+            single_rate = None
+            for processes in range(1, max_processes + 1):
+                with context.Pool(processes, initializer=initializer, initargs=initargs) as pool:
+                    # One small task for each worker, so that the timing starts with the workers loaded
+                    pool.map(route_sample, [(locations[:1], radius, engine)] * processes, chunksize=1)
+                    start_time = time.perf_counter()
+                    outputs = pool.map(route_sample, [(chunk, radius, engine) for chunk in chunks], chunksize=1)
+                    seconds = time.perf_counter() - start_time
+                worker_memory = {}  # The latest memory of each worker
+                for _, pid, memory in outputs:
+                    worker_memory[pid] = memory
+                route_num = sum(output[0] for output in outputs)
+                rate = route_num / seconds if seconds > 0 else 0.0
+                single_rate = single_rate or rate
+                row = {'mode': mode, 'processes': processes, 'routes': route_num, 'seconds': seconds,
+                       'routes_per_second': rate, 'speedup': rate / single_rate if single_rate else 0.0,
+                       'shared_bytes': dataset_pool.shared_bytes() if mode == 'shared' else 0}
+                row['efficiency'] = row['speedup'] / processes
+                for name in ('rss', 'pss', 'private'):
+                    row[name] = float(np.mean([memory[name] for memory in worker_memory.values()]))
+                rows.append(row)
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure how batch routing scales with worker processes '
+                                                 'attached to the shared datasets.')
+    parser.add_argument('--locations', type=int, default=2000, help='number of random locations on the island')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random locations')
+    parser.add_argument('--max-processes', type=int, help='largest number of processes; the CPUs by default')
+    parser.add_argument('--chunk-size', type=int, default=50, help='locations routed together')
+    parser.add_argument('--radius', type=float, default=default_radius, help='radius of the search in meters')
+    parser.add_argument('--modes', nargs='+', choices=benchmark_modes, default=['shared'],
+                        help='shared datasets, and/or datasets preloaded by every worker for comparison')
+    parser.add_argument('--json', action='store_true', help='print the rows as JSON')
+    args = parser.parse_args(argv)
+
+    from service import sample_locations
+    locations = sample_locations(args.locations, args.seed)
+    rows = scaling_benchmark(locations, args.max_processes, args.chunk_size, args.radius, tuple(args.modes))
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print('{:>8} {:>9} {:>10} {:>8} {:>10} {:>10} {:>10} {:>12}'.format(
+        'mode', 'processes', 'routes/s', 'speedup', 'RSS MB', 'PSS MB', 'private MB', 'shared MB'))
+    for row in rows:
+        print('{mode:>8} {processes:>9} {routes_per_second:>10.1f} {speedup:>8.2f} {rss_mb:>10.1f} {pss_mb:>10.1f} '
+              '{private_mb:>10.1f} {shared_mb:>12.1f}'.format(
+                  rss_mb=row['rss'] / 1e6, pss_mb=row['pss'] / 1e6, private_mb=row['private'] / 1e6,
+                  shared_mb=row['shared_bytes'] / 1e6, **row))
+
+
+if __name__ == '__main__':
+    main()
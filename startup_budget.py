@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+startup_budget = 150  # The budget of importing main.py before the window is created; use millisecond as unit
+heavy_modules = ['numpy', 'scipy', 'shapely', 'pyproj', 'rtree', 'networkx', 'rasterio', 'geopandas', 'matplotlib',
+                 'cartopy']  # Imported by the task modules, which must not be imported at start
+
+
+def import_times(module='main', repeat=3):
+    """Import a module in fresh interpreters with -X importtime, and keep the fastest run.
+    The first run is usually slower since the files are not in the disk cache yet.
+
+    :param module: string
+        The module to import, relative to the directory of this file
+    :param repeat: int
+        The number of interpreters to run
+    :return: dictionary
+        The (self, cumulative) import time of each imported module; use millisecond as unit
+    """
+    best = None
+    for _ in range(repeat):
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                                   cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+                                   check=True)
+        times = {}
+        for line in completed.stderr.splitlines():
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            self_time, cumulative, name = line[len('import time:'):].split('|')
+            times[name.strip()] = (int(self_time) / 1000, int(cumulative) / 1000)
+        if best is None or times[module][1] < best[module][1]:
+            best = times
+    return best
+
+
+def check_startup(module='main', budget=startup_budget, repeat=3, top=10):
+    """Measure the import time of a module, and check it against the budget and the list of heavy modules.
+
+    :param module: string
+    :param budget: float
+        The budget of the cumulative import time; use millisecond as unit
+    :param repeat: int
+        The number of interpreters to run
+    :param top: int
+        The number of the slowest imports listed in the report
+    :return: dictionary
+        'module', 'import_time' and 'budget' (millisecond), 'heavy_modules' imported,
+        the 'slowest' imports by their own time and whether the check 'passed'
+    """
+    times = import_times(module, repeat)
+    heavy = [name for name in heavy_modules if name in times]
+    slowest = sorted(times.items(), key=lambda item: item[1][0], reverse=True)[:top]
+    import_time = times[module][1]
+    return {'module': module, 'import_time': import_time, 'budget': budget, 'heavy_modules': heavy,
+            'slowest': [{'module': name, 'self': self_time, 'cumulative': cumulative}
+                        for name, (self_time, cumulative) in slowest],
+            'passed': import_time <= budget and not heavy}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check that main.py starts without importing heavy dependencies.')
+    parser.add_argument('--module', default='main', help='module to import')
+    parser.add_argument('--budget', type=float, default=startup_budget, help='budget of import time in ms')
+    parser.add_argument('--repeat', type=int, default=3, help='number of interpreters to run')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    report = check_startup(args.module, args.budget, args.repeat)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print('Importing {module} takes {import_time:.1f} ms, the budget is {budget:.0f} ms'.format(**report))
+        for item in report['slowest']:
+            print('  {self:8.1f} ms {cumulative:8.1f} ms  {module}'.format(**item))
+        if report['heavy_modules']:
+            print('Heavy modules imported at start: ' + ', '.join(report['heavy_modules']))
+    return 0 if report['passed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,34 @@
 import geopandas as gpd
-from shapely.geometry import Point
+import numpy as np
+import shapely
 from pyproj import Transformer
 
+from data_cache import file_signature
+from instrumentation import count, stage
+
+island_shp_path = 'Material/shape/isle_of_wight.shp'
+grid_cell_size = 250  # The size of cells of the coarse grid over the island; use meter as unit
+
+crs_codes = {'WGS84': 'EPSG:4326', 'BNG': 'EPSG:27700'}  # The CRS users can choose for input
+
+_island_memo = {}  # The island already loaded in this process, keyed by the signature of the shapefile
+_transformer_memo = {}  # The transformers already created in this process, keyed by (source CRS, target CRS)
+
+
+def get_transformer(source_crs, target_crs):
+    """Get the transformer between two CRS, creating it only on the first call.
+
+    :param source_crs: string
+        The source CRS, e.g. 'EPSG:4326'
+    :param target_crs: string
+        The target CRS, e.g. 'EPSG:27700'
+    :return: pyproj.Transformer
+    """
+    key = (source_crs, target_crs)
+    if key not in _transformer_memo:
+        _transformer_memo[key] = Transformer.from_crs(source_crs, target_crs)
+    return _transformer_memo[key]
+
 
 def coordinate_transform(crs, coordinate):
     """Transform the coordinate from WGS84 to British National Grid when the input of user is in CRS of WGS84.
@@ -14,12 +41,48 @@ def coordinate_transform(crs, coordinate):
         Return the coordinate in CRS of British National Grid
     """
     if crs == 'WGS84':
-        transfomer = Transformer.from_crs("EPSG:4326", "EPSG:27700")
+        transfomer = get_transformer(crs_codes['WGS84'], crs_codes['BNG'])
         coordinate = transfomer.transform(coordinate[0], coordinate[1])
         print(coordinate)
     return coordinate
 
 
+def coordinates_transform(crs, xs, ys):
+    """Transform arrays of coordinates to British National Grid by one call.
+
+    :param crs: string
+        The crs of input coordinates, 'WGS84' (xs are latitudes and ys are longitudes) or 'BNG'
+    :param xs: array-like
+        The x coordinates (or latitudes)
+    :param ys: array-like
+        The y coordinates (or longitudes)
+    :return: tuple(numpy.ndarray, numpy.ndarray)
+        The x and y coordinates in CRS of British National Grid
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    if crs == 'WGS84':
+        transfomer = get_transformer(crs_codes['WGS84'], crs_codes['BNG'])
+        xs, ys = transfomer.transform(xs, ys)
+    return xs, ys
+
+
+def coordinates_transform_chunks(crs, chunks):
+    """Transform a stream of chunks of coordinates to British National Grid, one chunk at a time.
+
+    :param crs: string
+        The crs of input coordinates, 'WGS84' or 'BNG'
+    :param chunks: iterable
+        Arrays of shape (n, 2) holding x, y (or latitude, longitude) pairs
+    :return: generator
+        Arrays of shape (n, 2) holding the x, y coordinates in CRS of British National Grid
+    """
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=float).reshape(-1, 2)
+        xs, ys = coordinates_transform(crs, chunk[:, 0], chunk[:, 1])
+        yield np.column_stack([xs, ys])
+
+
 def check_coordinate(coordinate):
     """Check whether the coordinate from user is within the box (430000, 80000) and (465000, 95000)
     and whether it is on the Isle of Wight respectively.
@@ -35,9 +98,7 @@ def check_coordinate(coordinate):
         print('The coordinate is outside the box (430000, 80000) and (465000, 95000)')
 
     # Check whether the point is on the island
-    island_shp_path = 'Material/shape/isle_of_wight.shp'
-    island_gdf = gpd.read_file(island_shp_path)
-    if Point(coordinate).within(island_gdf['geometry'][0]) or Point(coordinate).touches(island_gdf['geometry'][0]):
+    if check_coordinates([coordinate[0]], [coordinate[1]])[0]:
         print('Your location is on the Isle of Wight')
         return True
     else:
@@ -45,6 +106,72 @@ def check_coordinate(coordinate):
         return False
 
 
+def load_island():
+    """Load the polygon of the Isle of Wight once, prepare it for repeated tests and
+    classify the cells of a coarse grid over it as inside, outside or on the boundary of the island.
+
+    :return: dictionary
+        'geometry': the prepared polygon of the island, 'grid': the class of each cell
+        (1 inside, 0 outside, 2 boundary), 'origin': the (x, y) of the lower left corner of the grid
+    """
+    signature = file_signature(island_shp_path)
+    if signature in _island_memo:
+        return _island_memo[signature]
+
+    with stage('read island'):
+        island_gdf = gpd.read_file(island_shp_path)
+    island = island_gdf['geometry'][0]
+    shapely.prepare(island)
+
+    # Construct the cells of the grid covering the bounds of the island
+    min_x, min_y, max_x, max_y = island.bounds
+    col_num = int((max_x - min_x) // grid_cell_size) + 1
+    row_num = int((max_y - min_y) // grid_cell_size) + 1
+    cell_x, cell_y = np.meshgrid(min_x + np.arange(col_num) * grid_cell_size,
+                                 min_y + np.arange(row_num) * grid_cell_size)
+    cells = shapely.box(cell_x, cell_y, cell_x + grid_cell_size, cell_y + grid_cell_size)
+    grid = np.full(cells.shape, 2, dtype=np.int8)
+    grid[shapely.contains(island, cells)] = 1
+    grid[~shapely.intersects(island, cells)] = 0
+
+    island_index = {'geometry': island, 'grid': grid, 'origin': (min_x, min_y)}
+    _island_memo.clear()
+    _island_memo[signature] = island_index
+    return island_index
+
+
+def check_coordinates(xs, ys):
+    """Check whether each of the coordinates is on the Isle of Wight (inside it or on its coastline) by one call.
+    Points in cells of the coarse grid which are completely inside or outside the island are decided
+    by the grid; only points in cells on the coastline are tested against the polygon.
+
+    :param xs: array-like
+        The x coordinates in CRS of British National Grid
+    :param ys: array-like
+        The y coordinates in CRS of British National Grid
+    :return: numpy.ndarray
+        A boolean mask which is True for coordinates on the island
+    """
+    island_index = load_island()
+    grid = island_index['grid']
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+
+    # Look up the class of the cell of each point; points outside the grid are outside the island
+    cols = np.floor((xs - island_index['origin'][0]) / grid_cell_size)
+    rows = np.floor((ys - island_index['origin'][1]) / grid_cell_size)
+    in_grid = (cols >= 0) & (cols < grid.shape[1]) & (rows >= 0) & (rows < grid.shape[0])
+    cell_class = np.zeros(xs.shape, dtype=np.int8)
+    cell_class[in_grid] = grid[rows[in_grid].astype(np.intp), cols[in_grid].astype(np.intp)]
+
+    on_island = cell_class == 1
+    boundary = cell_class == 2
+    on_island[boundary] = shapely.intersects_xy(island_index['geometry'], xs[boundary], ys[boundary])
+    count('points checked', len(xs))
+    count('points on coastline', int(boundary.sum()))
+    return on_island
+
+
 def get_user_input():
     """Get the user input, and check them by check_coordinate(coordinate) function
     """
@@ -1,12 +1,347 @@
+import heapq
+
 import numpy as np
 import rasterio
 import rasterio.plot
-from rasterio import mask
+import shapely
 from shapely.geometry import Polygon
 from shapely.geometry import Point
 
+from data_cache import cache_key, load_cache, save_cache
+from elevation_store import open_elevation
+from instrumentation import count, stage
 
 elevation_path = 'Material/elevation/SZ.asc'
+pyramid_cache_name = 'elevation_pyramid.pickle'
+
+_elevation_memo = {}  # The elevation and its pyramid already loaded in this process, keyed by the cache key
+
+
+def build_max_pyramid(values):
+    """Build a max-pyramid over the elevation grid.
+    Each level halves the grid of the level below it; every block stores the maximum elevation inside it
+    and the flat index (row * width + col) of that maximum. Ties are broken by the smallest flat index,
+    which is the first occurrence when the grid is scanned row by row.
+
+    :param values: numpy.ndarray
+        The elevation grid where cells without data are -inf
+    :return: list
+        The (max_values, max_indexes) of every level, from the finest (2 * 2 cells per block)
+        to the coarsest (one block covering the whole grid)
+    """
+    no_index = np.iinfo(np.int64).max
+    levels = []
+    curr_values = values
+    curr_indexes = np.arange(values.size, dtype=np.int64).reshape(values.shape)
+    while curr_values.shape[0] > 1 or curr_values.shape[1] > 1:
+        # Pad the level to an even shape so that it can be split into 2 * 2 blocks
+        height, width = curr_values.shape
+        padded_height, padded_width = height + height % 2, width + width % 2
+        padded_values = np.full((padded_height, padded_width), -np.inf, dtype=curr_values.dtype)
+        padded_values[:height, :width] = curr_values
+        padded_indexes = np.full((padded_height, padded_width), no_index, dtype=np.int64)
+        padded_indexes[:height, :width] = curr_indexes
+
+        block_shape = (padded_height // 2, padded_width // 2, 4)
+        block_values = padded_values.reshape(padded_height // 2, 2, padded_width // 2, 2)
+        block_values = block_values.transpose(0, 2, 1, 3).reshape(block_shape)
+        block_indexes = padded_indexes.reshape(padded_height // 2, 2, padded_width // 2, 2)
+        block_indexes = block_indexes.transpose(0, 2, 1, 3).reshape(block_shape)
+
+        curr_values = block_values.max(axis=2)
+        curr_indexes = np.where(block_values == curr_values[..., np.newaxis], block_indexes, no_index).min(axis=2)
+        levels.append((curr_values, curr_indexes))
+    return levels
+
+
+def load_elevation():
+    """Open the binary elevation and load its max-pyramid.
+    The pyramid is cached on disk and in memory, and the cache is rebuilt whenever the elevation file changes.
+
+    :return: dictionary
+        'values': the memory-mapped elevation grid, 'nodata': the value of cells without data,
+        'levels': the max-pyramid from build_max_pyramid(), 'transform' and 'bounds' of the raster
+    """
+    key = cache_key([elevation_path])
+    if key in _elevation_memo:
+        return _elevation_memo[key]
+
+    elevation_data = open_elevation(elevation_path)
+    values = elevation_data.read(1)
+    levels = load_cache(pyramid_cache_name, key)
+    if levels is None:
+        with stage('build max-pyramid'):
+            levels = build_max_pyramid(elevation_data.read(1, masked=True).filled(-np.inf))
+        save_cache(pyramid_cache_name, key, levels)
+
+    elevation_index = {'values': values, 'nodata': elevation_data.nodata, 'levels': levels,
+                       'transform': elevation_data.transform, 'bounds': elevation_data.bounds}
+    _elevation_memo.clear()
+    _elevation_memo[key] = elevation_index
+    return elevation_index
+
+
+def set_elevation(elevation_index):
+    """Use an elevation and pyramid loaded elsewhere, e.g. attached from shared memory by shared_pool.attach(),
+    as the result of load_elevation() in this process.
+
+    :param elevation_index: dictionary
+        The same keys as returned by load_elevation()
+    """
+    _elevation_memo.clear()
+    _elevation_memo[cache_key([elevation_path])] = elevation_index
+
+
+def find_highest_cells(elevation_index, location, buffer, k=1, separation=0):
+    """Find the k highest cells whose centre is inside the buffer by a best-first search over the max-pyramid,
+    each farther than the separation from the cells found before it, so that one hill top does not fill the list.
+    Blocks completely inside the circle are answered by their stored maximum, blocks crossing the boundary
+    are split, and only single cells on the boundary are checked exactly against the buffer polygon.
+    Blocks within the separation of a cell found before are skipped as a whole.
+
+    :param elevation_index: dictionary
+        The elevation and its pyramid returned by load_elevation()
+    :param location: tuple(x, y)
+        The centre of the buffer in CRS of British National Grid
+    :param buffer: shapely.geometry.Polygon
+        The buffer around the location
+    :param k: int
+        The number of cells to find
+    :param separation: int or float
+        The distance that each cell keeps from the higher cells; use meter as unit
+    :return: list
+        The (row, col) of the cells from the highest down; shorter than k when no more cells with data
+        are inside the buffer
+    """
+    values = elevation_index['values']
+    nodata = elevation_index['nodata']
+    levels = elevation_index['levels']
+    transform = elevation_index['transform']
+    height, width = values.shape
+    centre = Point(location)
+    # The buffer polygon lies between these two circles
+    inner_radius = buffer.exterior.distance(centre)
+    outer_radius = buffer.hausdorff_distance(centre)
+
+    def cell_centre_range(level, block_row, block_col):
+        # The range of the x and y of cell centres inside a block
+        size = 2 ** level
+        row_first, col_first = block_row * size, block_col * size
+        row_last, col_last = min(row_first + size, height) - 1, min(col_first + size, width) - 1
+        x_first, y_first = transform * (col_first + 0.5, row_first + 0.5)
+        x_last, y_last = transform * (col_last + 0.5, row_last + 0.5)
+        return min(x_first, x_last), max(x_first, x_last), min(y_first, y_last), max(y_first, y_last)
+
+    def distance_range(point, min_x, max_x, min_y, max_y):
+        # The distance from a point to the nearest and the farthest corner of a range
+        nearest = np.hypot(max(min_x - point[0], 0, point[0] - max_x), max(min_y - point[1], 0, point[1] - max_y))
+        farthest = np.hypot(max(abs(point[0] - min_x), abs(point[0] - max_x)),
+                            max(abs(point[1] - min_y), abs(point[1] - max_y)))
+        return nearest, farthest
+
+    def block_entry(level, block_row, block_col):
+        if level == 0:
+            max_value, max_index = values[block_row, block_col], block_row * width + block_col
+            if max_value == nodata:
+                max_value = -np.inf
+        else:
+            max_value = levels[level - 1][0][block_row, block_col]
+            max_index = levels[level - 1][1][block_row, block_col]
+        return -max_value, int(max_index), level, block_row, block_col
+
+    # The heap is ordered by the highest elevation of each block, then by the first occurrence
+    top_level = len(levels)
+    heap = [block_entry(top_level, 0, 0)]
+    cells = []
+    found_points = []  # The centre of each cell found
+    while heap and len(cells) < k:
+        negative_value, max_index, level, block_row, block_col = heapq.heappop(heap)
+        count('blocks scanned')
+        if negative_value == np.inf:  # Only cells without data are left
+            break
+        block_range = cell_centre_range(level, block_row, block_col)
+        nearest, farthest = distance_range(location, *block_range)
+        if nearest > outer_radius:  # The block is outside the buffer
+            continue
+        if any(distance_range(point, *block_range)[1] <= separation for point in found_points):
+            continue  # Every cell of the block is too close to a higher cell
+        if level == 0:  # A single cell, checked exactly against the buffer when it is on the boundary
+            if farthest < inner_radius or shapely.contains_xy(buffer, block_range[0], block_range[2]):
+                cells.append((block_row, block_col))
+                found_points.append((block_range[0], block_range[2]))
+            continue
+        if farthest < inner_radius:  # The block is inside the buffer, so its maximum is the next cell
+            max_row, max_col = divmod(max_index, width)
+            max_point = transform * (max_col + 0.5, max_row + 0.5)
+            if all(np.hypot(max_point[0] - x, max_point[1] - y) > separation for x, y in found_points):
+                cells.append((max_row, max_col))
+                found_points.append(max_point)
+                if len(cells) == k:
+                    break
+        # Split the block into the blocks of the level below; the cell just found is skipped there
+        child_height, child_width = values.shape if level == 1 else levels[level - 2][0].shape
+        for child_row in range(2 * block_row, min(2 * block_row + 2, child_height)):
+            for child_col in range(2 * block_col, min(2 * block_col + 2, child_width)):
+                heapq.heappush(heap, block_entry(level - 1, child_row, child_col))
+    return cells
+
+
+def find_highest_cell(elevation_index, location, buffer):
+    """Find the highest cell whose centre is inside the buffer, see find_highest_cells().
+
+    :param elevation_index: dictionary
+        The elevation and its pyramid returned by load_elevation()
+    :param location: tuple(x, y)
+        The centre of the buffer in CRS of British National Grid
+    :param buffer: shapely.geometry.Polygon
+        The buffer around the location
+    :return: tuple(row, col) or None
+        The row and col of the highest cell; None when no cell with data is inside the buffer
+    """
+    cells = find_highest_cells(elevation_index, location, buffer)
+    return cells[0] if cells else None
+
+
+def clip_window(elevation_index, mask_polygon):
+    """Get the window of the elevation covering the bounds of the mask polygon,
+    rounded outwards to whole cells as rasterio.mask.mask(crop=True) does.
+
+    :param elevation_index: dictionary
+        The elevation and its pyramid returned by load_elevation()
+    :param mask_polygon: shapely.geometry.Polygon
+        The polygon of the mask
+    :return: tuple(row_start, row_stop, col_start, col_stop)
+    """
+    transform = elevation_index['transform']
+    height, width = elevation_index['values'].shape
+    min_x, min_y, max_x, max_y = mask_polygon.bounds
+    cols, rows = ~transform * np.array([(min_x, max_x), (max_y, min_y)])
+    row_start, row_stop = max(int(np.floor(rows.min())), 0), min(int(np.ceil(rows.max())), height)
+    col_start, col_stop = max(int(np.floor(cols.min())), 0), min(int(np.ceil(cols.max())), width)
+    return row_start, row_stop, col_start, col_stop
+
+
+def clip_elevation(elevation_index, mask_polygon):
+    """Clip the elevation by the mask polygon, as rasterio.mask.mask(crop=True, filled=False) does.
+
+    :param elevation_index: dictionary
+        The elevation and its pyramid returned by load_elevation()
+    :param mask_polygon: shapely.geometry.Polygon
+        The polygon of the mask
+    :return local_elevation_array: numpy.ma.MaskedArray
+        The elevation_array clipped by mask, whose shape is (1, rows, cols).
+    :return out_transform:
+        Information for mapping pixel coordinates in masked to another coordinate system.
+    """
+    values = elevation_index['values']
+    nodata = elevation_index['nodata']
+    transform = elevation_index['transform']
+    row_start, row_stop, col_start, col_stop = clip_window(elevation_index, mask_polygon)
+    out_transform = transform * transform.translation(col_start, row_start)
+
+    # Mask the cells whose centre is outside the polygon
+    window_rows, window_cols = np.mgrid[row_start:row_stop, col_start:col_stop]
+    xs, ys = transform * (window_cols + 0.5, window_rows + 0.5)
+    outside = ~shapely.contains_xy(mask_polygon, xs, ys)
+    local_elevation = np.array(values[row_start:row_stop, col_start:col_stop])  # Only pages in the window
+    count('cells clipped', local_elevation.size)
+    no_data = local_elevation == nodata if nodata is not None else np.zeros(local_elevation.shape, dtype=bool)
+    local_elevation_array = np.ma.masked_array(local_elevation[np.newaxis], mask=(no_data | outside)[np.newaxis])
+    return local_elevation_array, out_transform
+
+
+def buffer_mask(elevation_index, location, radius):
+    """Construct the buffer of the given location and the mask polygon where it overlaps the elevation map.
+
+    :param elevation_index: dictionary
+        The elevation and its pyramid returned by load_elevation()
+    :param location: tuple(x, y)
+        Location input by user, which is a xy coordinate pair in CRS of British National Grid
+    :param radius: int or float
+        The radius of buffer; use meter as unit
+    :return bf: shapely.geometry.Polygon
+        The buffer of the location
+    :return mask_polygon: shapely.geometry.Polygon
+        The part of the buffer overlapping the elevation map
+    """
+    bf = Point(location).buffer(radius)
+    elevation_bounds = elevation_index['bounds']   # Construct the polygon of the boundary of elevation map
+    elevation_boundary = Polygon([(elevation_bounds[0], elevation_bounds[1]),
+                                  (elevation_bounds[2], elevation_bounds[1]),
+                                  (elevation_bounds[2], elevation_bounds[3]),
+                                  (elevation_bounds[0], elevation_bounds[3])])
+    mask_polygon = bf.intersection(elevation_boundary)   # Ensure the mask overlaps elevation map
+    return bf, mask_polygon
+
+
+def find_highest_point(location, radius):
+    """Identify the highest point inside the buffer of given location, without clipping the elevation.
+
+    :param location: tuple(x, y)
+        Location input by user, which is a xy coordinate pair in CRS of British National Grid
+    :param radius: int or float
+        The radius of buffer; use meter as unit
+    :return: tuple(x, y) or None
+        The xy coordinates of the highest point in CRS of British National Grid;
+        None when the buffer does not intersect the elevation map
+    """
+    elevation_index = load_elevation()
+    bf, mask_polygon = buffer_mask(elevation_index, location, radius)
+    # Check if area of the mask exists',  which means the buffer intersects with elevation map
+    if mask_polygon.area == 0:
+        return None
+    highest_cell = find_highest_cell(elevation_index, location, bf)
+    if highest_cell is None:  # No cell with data inside the buffer, take the first cell of the clipped array
+        row_start, _, col_start, _ = clip_window(elevation_index, mask_polygon)
+        highest_cell = (row_start, col_start)
+    # Transform the row and col to xy coordinates in British National Grid
+    x, y = rasterio.transform.xy(elevation_index['transform'], highest_cell[0], highest_cell[1])
+    return x, y
+
+
+def find_highest_points(location, radius, k, separation=0):
+    """Identify the k highest points inside the buffer of given location, apart from each other,
+    without clipping the elevation.
+
+    :param location: tuple(x, y)
+        Location input by user, which is a xy coordinate pair in CRS of British National Grid
+    :param radius: int or float
+        The radius of buffer; use meter as unit
+    :param k: int
+        The number of points
+    :param separation: int or float
+        The distance that each point keeps from the higher points; use meter as unit
+    :return: list
+        The (x, y, elevation) of the points from the highest down, in CRS of British National Grid;
+        empty when the buffer does not intersect the elevation map or has no cell with data
+    """
+    elevation_index = load_elevation()
+    bf, mask_polygon = buffer_mask(elevation_index, location, radius)
+    if mask_polygon.area == 0:
+        return []
+    cells = find_highest_cells(elevation_index, location, bf, k, separation)
+    if not cells:
+        return []
+    rows, cols = np.array(cells).T
+    xs, ys = rasterio.transform.xy(elevation_index['transform'], rows, cols)
+    return [(float(x), float(y), float(elevation_index['values'][row, col]))
+            for x, y, row, col in zip(xs, ys, rows, cols)]
+
+
+def point_elevation(location):
+    """Get the elevation of the cell containing the location.
+
+    :param location: tuple(x, y)
+        A xy coordinate pair in CRS of British National Grid
+    :return: float or None
+        None when the location is outside the elevation map or the cell has no data
+    """
+    elevation_index = load_elevation()
+    values = elevation_index['values']
+    row, col = rasterio.transform.rowcol(elevation_index['transform'], location[0], location[1])
+    if not (0 <= row < values.shape[0] and 0 <= col < values.shape[1]) or values[row, col] == elevation_index['nodata']:
+        return None
+    return float(values[row, col])
 
 
 def identify_highest_point(location, radius):
@@ -26,28 +361,11 @@ def identify_highest_point(location, radius):
     :return out_transform:
         Information for mapping pixel coordinates in masked to another coordinate system.
     """
-    # Read elevation data and clip it with a 5km buffer whose central point is user's location
-    elevation_data = rasterio.open(elevation_path)
-    bf = Point(location).buffer(radius)
-    elevation_bounds = elevation_data.bounds   # Construct the polygon of the boundary of elevation map
-    elevation_boundary = Polygon([(elevation_bounds[0], elevation_bounds[1]),
-                                  (elevation_bounds[2], elevation_bounds[1]),
-                                  (elevation_bounds[2], elevation_bounds[3]),
-                                  (elevation_bounds[0], elevation_bounds[3])])
-
-    mask_polygon = bf.intersection(elevation_boundary)   # Ensure the mask overlaps elevation map
-    # Check if area of the mask exists',  which means 5km buffer intersects with elevation map
-    if mask_polygon.area != 0:
-        local_elevation_array, out_transform = rasterio.mask.mask(dataset=elevation_data, shapes=[mask_polygon],
-                                                                  crop=True, filled=False)
-        # Find the max value and the location in elevation clipped by mask
-        max_elevation = np.max(local_elevation_array)
-        location = np.where(local_elevation_array == max_elevation)
-        row_highest_point = location[1][0]
-        col_highest_point = location[2][0]
-        # Transform the row and col to xy coordinates in British National Grid
-        x, y = rasterio.transform.xy(out_transform, row_highest_point, col_highest_point)
-
-        return x, y, local_elevation_array, out_transform
-    else:  # If mask can't intersects elevation map, return none.
+    # Find the highest point by the max-pyramid, then clip the elevation with the buffer for the map
+    highest_point = find_highest_point(location, radius)
+    if highest_point is None:  # If mask can't intersects elevation map, return none.
         return None
+    elevation_index = load_elevation()
+    _, mask_polygon = buffer_mask(elevation_index, location, radius)
+    local_elevation_array, out_transform = clip_elevation(elevation_index, mask_polygon)
+    return highest_point[0], highest_point[1], local_elevation_array, out_transform
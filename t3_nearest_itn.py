@@ -1,9 +1,79 @@
-import json
+import numpy as np
+from scipy.spatial import cKDTree
 
-from rtree import index
+from data_cache import cache_key
+from instrumentation import count, stage
+from itn_store import open_itn
 
 solent_itn_json_path = 'Material/itn/solent_itn.json'
 
+_node_index_memo = {}  # The index already loaded in this process, keyed by the cache key
+
+
+def build_node_index(itn_store):
+    """Build the spatial index of ITN nodes.
+
+    :param itn_store: itn_store.ItnStore
+        The columnar store of ITN
+    :return node_ids: numpy.ndarray
+        The name of each node like 'osgb4000000026219230', in the same order as the index
+    :return node_tree: scipy.spatial.cKDTree
+        The KD-tree of the coordinates of nodes
+    """
+    node_tree = cKDTree(itn_store.node_coords)
+    return itn_store.node_ids, node_tree
+
+
+def load_node_index():
+    """Load the spatial index of ITN nodes from the columnar store of ITN.
+    The index is kept in memory, and rebuilt whenever the ITN file changes.
+
+    :return node_ids: numpy.ndarray
+        The name of each node, in the same order as the index
+    :return node_tree: scipy.spatial.cKDTree
+        The KD-tree of the coordinates of nodes
+    """
+    key = cache_key([solent_itn_json_path])
+    if key in _node_index_memo:
+        return _node_index_memo[key]
+
+    with stage('open ITN store'):
+        itn_store = open_itn(solent_itn_json_path)
+    with stage('build node index'):
+        node_index = build_node_index(itn_store)
+
+    _node_index_memo.clear()
+    _node_index_memo[key] = node_index
+    return node_index
+
+
+def set_node_index(node_ids, node_tree):
+    """Use a spatial index built elsewhere, e.g. over node coordinates attached from shared memory
+    by shared_pool.attach(), as the result of load_node_index() in this process.
+
+    :param node_ids: numpy.ndarray
+        The name of each node, in the same order as the index
+    :param node_tree: scipy.spatial.cKDTree
+        The KD-tree of the coordinates of nodes
+    """
+    _node_index_memo.clear()
+    _node_index_memo[cache_key([solent_itn_json_path])] = (node_ids, node_tree)
+
+
+def get_nearest_itn_nodes(points_coords):
+    """ Identify the nearest ITN node to each of the given locations by one query
+
+    :param points_coords: array-like of shape (n, 2)
+        The xy coordinate pairs in CRS of British National Grid
+    :return: numpy.ndarray
+        The name of the nearest node of each location
+    """
+    node_ids, node_tree = load_node_index()
+    points_coords = np.asarray(points_coords, dtype=float).reshape(-1, 2)
+    _, nearest_node_indexes = node_tree.query(points_coords, k=1)
+    count('points snapped', len(points_coords))
+    return node_ids[nearest_node_indexes]
+
 
 def get_nearest_itn_node(point_coords):
     """ Identify the nearest ITN node to the given location
@@ -14,21 +84,6 @@ def get_nearest_itn_node(point_coords):
     :return: nearest_node：string
         The name of the nearest node like 'osgb4000000026219230'
     """
-    # Convert JSON to Rtree
-    with open(solent_itn_json_path, 'r') as f:
-        solent_itn = json.load(f)
-    road_nodes = solent_itn['roadnodes']
-    idx = index.Index()
-    node_list = []  # Used to find the name of the node based on the number of Rtree
-    n = 0
-    for node in road_nodes:
-        node_coords = road_nodes[node]['coords']
-        idx.insert(n, node_coords)
-        node_list.append(node)
-        n = n + 1
-
-    # Get the nearest ITN node around the location
     # When there is more than one node get found, choose the first one
-    nearest_node_indexes = list(idx.nearest(point_coords, 1))
-    nearest_node = node_list[nearest_node_indexes[0]]
+    nearest_node = str(get_nearest_itn_nodes([point_coords])[0])
     return nearest_node
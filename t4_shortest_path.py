@@ -1,19 +1,74 @@
-import json
+import heapq
+from itertools import chain, count as counter
 
+import numpy as np
 import networkx as nx
-import rasterio
 import geopandas as gpd
-from shapely.geometry import LineString
+
+from data_cache import cache_key, load_cache, save_cache
+from elevation_store import open_elevation
+from instrumentation import active, count, stage
+from itn_store import open_itn
+from route_cache import RouteCache
 
 solent_itn_json_path = 'Material/itn/solent_itn.json'
 elevation_path = 'Material/elevation/SZ.asc'
+graph_cache_name = 'itn_graph.pickle'
+graph_cache_version = 4  # Bump when the structure of the cached graph changes
+
+default_walking_speed = 5 / 3.6 * 60  # unit: meter/minute
+default_climb_penalty = 10  # unit: meter of climb per additional minute
+search_methods = ('dijkstra', 'astar', 'bidirectional')
+cancel_check_interval = 1000  # The number of nodes settled between two checks of the cancel event
+
+_graph_memo = {}  # The graphs already loaded in this process, keyed by the cache key
+_closures = {'links': frozenset()}  # The fid of links closed by close_links(), applied to every graph loaded
+_link_elevation_memo = {}  # The lowest elevation of each link, keyed by the key of the network
+route_cache = RouteCache()  # The routes found in this process; use route_cache.configure() to change its size
+
+
+class RouteCancelled(Exception):
+    """Raised inside a search when its cancel event is set."""
+
+
+def cancellable_weight(cancel_event):
+    """Build the weight function of a search which can be aborted from another thread.
+
+    :param cancel_event: threading.Event
+        The search stops with RouteCancelled at the next edge once this event is set
+    :return: function
+        The weight function for the searches of networkx
+    """
+    def weight(u, v, data):
+        if cancel_event.is_set():
+            raise RouteCancelled()
+        return data['weight']
+    return weight
+
+
+def counting_weight(weight, settled):
+    """Wrap the weight of a search to collect the nodes it settles, i.e. the nodes whose edges it relaxes.
+
+    :param weight: string or function
+        The weight of edges, see cancellable_weight()
+    :param settled: set
+        The settled nodes are added to this set
+    :return: function
+        The weight function for the searches of networkx
+    """
+    get_weight = weight if callable(weight) else (lambda u, v, data: data[weight])
+
+    def counted_weight(u, v, data):
+        settled.add(u)
+        return get_weight(u, v, data)
+    return counted_weight
 
 
 def elevation_para_set(elevation):
     """Get some parameters of raster map of elevation for later use.
 
     :param elevation:
-        This object can be the data read by rasterio.open()
+        This object can be the data read by rasterio.open() or open_elevation()
     :return: list
         List of the parameters of elevation: minimum x of elevation,
         minimum y of elevation, width of each pixel, height of each pixel
@@ -52,84 +107,666 @@ def get_elevation(point, elevation_mat, elevation_para):
     return elevation_value
 
 
-def get_gdf(path, itn_graph, itn_json):
+def get_gdf(path, itn_graph, itn_store):
     """Transform path to GeoDataframe.
 
     :param path: list
         The sequence of fid of nodes constructing the path.
-    :param itn_graph: networkx.Graph()
+    :param itn_graph: networkx.DiGraph()
+        The is the graph of ITN
+    :param itn_store: itn_store.ItnStore
+        The columnar store of ITN, whose coordinate buffer the geometries of links are sliced from.
+    """
+    return links_gdf(path_links(path, itn_graph), itn_store)
+
+
+def path_links(path, itn_graph):
+    """Get the links along a path.
+
+    :param path: list
+        The sequence of fid of nodes constructing the path.
+    :param itn_graph: networkx.DiGraph()
         The is the graph of ITN
-    :param itn_json:
-        This object is the data load from GeoJSON.
+    :return: list
+        The fid of links along the path
     """
-    links = []  # this list will be used to populate the feature id (fid) column
-    geom = []  # this list will be used to populate the geometry column
+    return [itn_graph.edges[u, v]['fid'] for u, v in zip(path[:-1], path[1:])]  # the feature id (fid) column
+
+
+def links_gdf(links, itn_store):
+    """Transform the links of a path to GeoDataframe, without the graph.
 
-    first_node = path[0]
-    road_links = itn_json['roadlinks']
-    for node in path[1:]:
-        link_fid = itn_graph.edges[first_node, node]['fid']
-        links.append(link_fid)
-        geom.append(LineString(road_links[link_fid]['coords']))
-        first_node = node
+    :param links: list
+        The fid of links along the path
+    :param itn_store: itn_store.ItnStore
+        The columnar store of ITN, whose coordinate buffer the geometries of links are sliced from.
+    """
+    link_index = itn_store.link_index
+    geom = itn_store.link_geometries([link_index[link] for link in links])  # the geometry column
 
     path_gdf = gpd.GeoDataFrame({"fid": links, "geometry": geom})
     return path_gdf
 
 
-def shortest_path(start_node, end_node):
+def point_elevations(itn_store, elevation_mat, elevation_para):
+    """Sample the elevation matrix at the points of all links by a single fancy index,
+    reading the points straight from the coordinate buffer of the store.
+
+    :param itn_store: itn_store.ItnStore
+        The columnar store of ITN
+    :param elevation_mat: matrix
+        This is the matrix of elevation read from raster map
+    :param elevation_para: dictionary
+        The parameter set get from elevation_para_set(elevation)
+    :return: numpy.ndarray
+        The elevation of each point of itn_store.coords
+    """
+    points = np.asarray(itn_store.coords)
+    # Same indexing as get_elevation(), truncating towards zero like int()
+    row_ids = ((points[:, 0] - elevation_para['min_x']) / elevation_para['x_bin_width']).astype(np.intp)
+    col_ids = ((points[:, 1] - elevation_para['min_y']) / elevation_para['y_bin_width']).astype(np.intp)
+    return np.asarray(elevation_mat)[row_ids, col_ids]
+
+
+def link_weights(itn_store, elevation_mat, elevation_para, walking_speed, climb_penalty):
+    """Calculate the travel time of every link in both directions at once.
+    The weight of each link depends on its travel time,
+    which consists of basic walking time and additional time for climb.
+    The elevations of the points of all links come from point_elevations(),
+    and the climb of each link is summed by np.add.reduceat.
+
+    :param itn_store: itn_store.ItnStore
+        The columnar store of ITN
+    :param elevation_mat: matrix
+        This is the matrix of elevation read from raster map
+    :param elevation_para: dictionary
+        The parameter set get from elevation_para_set(elevation)
+    :param walking_speed: float
+        The walking speed on flat ground; use meter/minute as unit
+    :param climb_penalty: float
+        The meters of climb which cost one additional minute
+    :return time_cost_forward: numpy.ndarray
+        The travel time from the start node to the end node of each link, in the order of the store
+    :return time_cost_backward: numpy.ndarray
+        The travel time from the end node to the start node of each link
+    """
+    offsets = np.asarray(itn_store.coord_offsets[:-1])  # The index of the first point of each link
+    elevations = point_elevations(itn_store, elevation_mat, elevation_para)
+
+    # Difference between consecutive points; the differences across two links are set to zero
+    climb = np.concatenate([np.diff(elevations), np.zeros(1, dtype=elevations.dtype)])
+    climb[offsets[1:] - 1] = 0
+    add_time_forward = np.add.reduceat(np.clip(climb, 0, None), offsets)    # Ascent
+    add_time_backward = np.add.reduceat(np.clip(-climb, 0, None), offsets)  # Descent
+
+    # An additional minute is added for every climb_penalty meters of climb
+    count('links weighted', len(offsets))
+    walking_time_cost = np.asarray(itn_store.link_length) / walking_speed
+    time_cost_forward = walking_time_cost + add_time_forward / climb_penalty
+    time_cost_backward = walking_time_cost + add_time_backward / climb_penalty
+    return time_cost_forward, time_cost_backward
+
+
+def build_itn_graph(itn_store, elevation, walking_speed, climb_penalty):
+    """Construct the network of ITN whose weights are the travel time of each link.
+
+    :param itn_store: itn_store.ItnStore
+        The columnar store of ITN
+    :param elevation:
+        This object can be the data read by rasterio.open() or open_elevation()
+    :param walking_speed: float
+        The walking speed on flat ground; use meter/minute as unit
+    :param climb_penalty: float
+        The meters of climb which cost one additional minute
+    :return: networkx.DiGraph()
+        The directed graph of ITN, where the two directions of a link have their own uphill/downhill weight.
+        Each node keeps its 'coords', and the graph keeps the 'walking_speed' and the 'heuristic_factor'
+        used by the heuristic of A* search.
+    """
+    elevation_mat = elevation.read(1)
+    elevation_para = elevation_para_set(elevation)
+    time_cost_forward, time_cost_backward = link_weights(itn_store, elevation_mat, elevation_para,
+                                                         walking_speed, climb_penalty)
+
+    # Add both directions of each link
+    node_ids = itn_store.node_ids.tolist()
+    link_start = itn_store.link_start
+    link_end = itn_store.link_end
+    itn_graph = nx.DiGraph()
+    itn_graph.add_edges_from(chain.from_iterable(
+        ((node_ids[start], node_ids[end], {'fid': link, 'weight': forward}),
+         (node_ids[end], node_ids[start], {'fid': link, 'weight': backward}))
+        for link, start, end, forward, backward in zip(itn_store.link_fids.tolist(), link_start.tolist(),
+                                                       link_end.tolist(), time_cost_forward.tolist(),
+                                                       time_cost_backward.tolist())))
+
+    # The straight line distance divided by walking speed is a lower bound of the travel time,
+    # as long as no link is shorter than the distance between its nodes; the factor keeps it a lower bound
+    node_coords = np.asarray(itn_store.node_coords)
+    node_index = itn_store.node_index
+    nx.set_node_attributes(itn_graph, {node: tuple(node_coords[node_index[node]].tolist()) for node in itn_graph},
+                           'coords')
+    distances = np.hypot(*(node_coords[link_start] - node_coords[link_end]).T)
+    lengths = np.asarray(itn_store.link_length)
+    shorter = lengths < distances
+    heuristic_factor = float(np.min(lengths[shorter] / distances[shorter])) if shorter.any() else 1.0
+    itn_graph.graph['walking_speed'] = walking_speed
+    itn_graph.graph['heuristic_factor'] = heuristic_factor
+    return itn_graph
+
+
+def graph_cache_key(walking_speed=default_walking_speed, climb_penalty=default_climb_penalty):
+    """Get the key of the cached graph; products derived from the graph can use it as part of their own key.
+
+    :param walking_speed: float
+        The walking speed on flat ground; use meter/minute as unit
+    :param climb_penalty: float
+        The meters of climb which cost one additional minute
+    :return: string
+    """
+    return cache_key([solent_itn_json_path, elevation_path], (graph_cache_version, walking_speed, climb_penalty))
+
+
+def network_cache_key():
+    """Get the key of the network and elevation the graphs are built from, whatever the weighting parameters.
+    The route cache is emptied when it changes.
+
+    :return: string
+    """
+    return cache_key([solent_itn_json_path, elevation_path], (graph_cache_version,))
+
+
+def load_itn_graph(walking_speed=default_walking_speed, climb_penalty=default_climb_penalty):
+    """Load the weighted graph of ITN, building it only when no valid cache exists.
+    The graph is cached on disk and in memory, and the cache is rebuilt whenever the ITN file,
+    the elevation file or the weighting parameters change. The links closed by close_links() are removed
+    from the graph in memory only.
+
+    :param walking_speed: float
+        The walking speed on flat ground; use meter/minute as unit
+    :param climb_penalty: float
+        The meters of climb which cost one additional minute
+    :return itn_graph: networkx.DiGraph()
+        The graph of ITN
+    :return itn_store: itn_store.ItnStore
+        The columnar store of ITN, used by get_gdf() to build geometries
+    """
+    key = graph_cache_key(walking_speed, climb_penalty)
+    if key in _graph_memo:
+        return _graph_memo[key]
+
+    with stage('open ITN store'):
+        itn_store = open_itn(solent_itn_json_path)
+    itn_graph = load_cache(graph_cache_name, key)
+    if itn_graph is None:
+        with stage('read elevation'):
+            elevation = open_elevation(elevation_path)
+        with stage('build graph'):
+            itn_graph = build_itn_graph(itn_store, elevation, walking_speed, climb_penalty)
+        save_cache(graph_cache_name, key, itn_graph)
+    if _closures['links']:
+        remove_links(itn_graph, itn_store, _closures['links'])  # The cache on disk keeps the whole network
+    itn_graph.graph['network_key'] = network_cache_key()  # The key of the routes found on this graph
+
+    _graph_memo.clear()  # Only keep the graph of the latest parameters in memory
+    _graph_memo[key] = (itn_graph, itn_store)
+    return itn_graph, itn_store
+
+
+def remove_links(itn_graph, itn_store, links):
+    """Remove the edges of the given links from the graph, keeping them in itn_graph.graph['closed_edges']
+    so that restore_links() can put them back. Links already removed are skipped.
+
+    :param itn_graph: networkx.DiGraph()
+        The graph of ITN
+    :param itn_store: itn_store.ItnStore
+        The columnar store of ITN
+    :param links: iterable
+        The fid of links
+    :return: set
+        The (start node, end node) of each edge removed
+    """
+    closed_edges = itn_graph.graph.setdefault('closed_edges', {})
+    link_index = itn_store.link_index
+    node_ids = itn_store.node_ids
+    removed = set()
+    for link in links:
+        if link in closed_edges:
+            continue
+        i = link_index[link]
+        start, end = str(node_ids[itn_store.link_start[i]]), str(node_ids[itn_store.link_end[i]])
+        edges = []
+        for u, v in ((start, end), (end, start)):
+            data = itn_graph.get_edge_data(u, v)
+            # Of parallel links between the same nodes, the graph keeps only one edge in each direction
+            if data is not None and data['fid'] == link:
+                edges.append((u, v, data))
+                itn_graph.remove_edge(u, v)
+                removed.add((u, v))
+        closed_edges[link] = edges
+    count('edges closed', len(removed))
+    return removed
+
+
+def restore_links(itn_graph, links):
+    """Put back the edges removed by remove_links().
+
+    :param itn_graph: networkx.DiGraph()
+        The graph of ITN
+    :param links: iterable
+        The fid of links; links which are not removed are skipped
+    """
+    closed_edges = itn_graph.graph.get('closed_edges', {})
+    for link in links:
+        itn_graph.add_edges_from(closed_edges.pop(link, []))
+
+
+def open_network(itn_graph):
+    """Get the graph with every link open, for products describing the whole network such as
+    the contraction hierarchy and the CSR graph, which are cached on disk.
+
+    :param itn_graph: networkx.DiGraph()
+        The graph returned by load_itn_graph()
+    :return: networkx.DiGraph()
+        The graph itself when no link is closed, otherwise a copy with the closed links put back
+    """
+    closed_edges = itn_graph.graph.get('closed_edges')
+    if not closed_edges:
+        return itn_graph
+    whole_graph = itn_graph.copy()
+    whole_graph.graph['closed_edges'] = {}
+    whole_graph.add_edges_from(chain.from_iterable(closed_edges.values()))
+    return whole_graph
+
+
+def closed_links():
+    """Get the links closed by close_links().
+
+    :return: frozenset
+        The fid of closed links
+    """
+    return _closures['links']
+
+
+def _loaded_store():
+    # The store of the graph in memory, or the store opened now when no graph is loaded yet
+    for _, itn_store in _graph_memo.values():
+        return itn_store
+    return open_itn(solent_itn_json_path)
+
+
+def close_links(links):
+    """Mark links as impassable, e.g. when they are flooded.
+    Only the edges of these links are removed from the graph in memory, and only the cached routes along them
+    are dropped from the route cache, including the routes read later from its persistent tier;
+    graphs loaded later, of any weighting parameters, leave them out too.
+
+    :param links: iterable
+        The fid of links to close
+    :return: int
+        The number of cached routes invalidated
+    """
+    itn_store = _loaded_store()
+    links = set(links) - _closures['links']
+    unknown = [link for link in links if link not in itn_store.link_index]
+    if unknown:
+        raise ValueError('Unknown links: {}'.format(', '.join(sorted(unknown)[:10])))
+    if not links:
+        return 0
+
+    with stage('close links'):
+        _closures['links'] = _closures['links'] | links
+        for itn_graph, _ in _graph_memo.values():
+            remove_links(itn_graph, itn_store, links)
+        # A route is only affected when it goes along a link closed now, whether or not a graph is loaded
+        return route_cache.close_links(links)
+
+
+def link_min_elevations():
+    """Get the lowest elevation along each link, sampled at all of its points.
+    Points without data do not count; a link without any valid point gets infinity.
+
+    :return: numpy.ndarray
+        The lowest elevation of each link, in the order of the store
+    """
+    key = network_cache_key()
+    if key not in _link_elevation_memo:
+        itn_store = _loaded_store()
+        elevation = open_elevation(elevation_path)
+        elevations = point_elevations(itn_store, elevation.read(1), elevation_para_set(elevation)).astype(float)
+        if elevation.nodata is not None:
+            elevations[elevations == elevation.nodata] = np.inf
+        _link_elevation_memo.clear()
+        _link_elevation_memo[key] = np.minimum.reduceat(elevations, np.asarray(itn_store.coord_offsets[:-1]))
+    return _link_elevation_memo[key]
+
+
+def close_below_water_level(water_level):
+    """Close every link which dips below the given water level at any of its points.
+    Links closed before stay closed; reopen them with reopen_links() when the water falls.
+
+    :param water_level: float
+        Use meter as unit, like the elevation
+    :return: list
+        The fid of links closed by this call
+    """
+    flooded = _loaded_store().link_fids[link_min_elevations() < water_level].tolist()
+    links = [link for link in flooded if link not in _closures['links']]
+    close_links(links)
+    return links
+
+
+def reopen_links(links=None):
+    """Reopen links closed by close_links(), putting their edges back into the graph in memory.
+    Only the cached routes found while one of these links was closed are dropped,
+    since a shorter route may now go along it.
+
+    :param links: iterable or None
+        The fid of links to reopen; None to reopen every link
+    :return: int
+        The number of cached routes invalidated
+    """
+    links = set(_closures['links'] if links is None else links) & _closures['links']
+    if not links:
+        return 0
+
+    with stage('reopen links'):
+        _closures['links'] = _closures['links'] - links
+        for itn_graph, _ in _graph_memo.values():
+            restore_links(itn_graph, links)
+        return route_cache.reopen_links(links)
+
+
+def walking_time_heuristic(itn_graph):
+    """Build the heuristic of A* search: the straight line walking time between two nodes.
+    It never exceeds the travel time, since every link is at least as long as the straight line
+    (times the heuristic factor of the graph) and climbing only adds time.
+
+    :param itn_graph: networkx.DiGraph()
+        The graph of ITN returned by build_itn_graph()
+    :return: function
+        The heuristic for networkx.astar_path
+    """
+    node_coords = itn_graph.nodes
+    scale = itn_graph.graph['heuristic_factor'] / itn_graph.graph['walking_speed']
+
+    def heuristic(u, v):
+        u_coords = node_coords[u]['coords']
+        v_coords = node_coords[v]['coords']
+        return ((u_coords[0] - v_coords[0]) ** 2 + (u_coords[1] - v_coords[1]) ** 2) ** 0.5 * scale
+    return heuristic
+
+
+def search_path(itn_graph, start_node, end_node, method='dijkstra', weight='weight'):
+    """Search the shortest path between two nodes by the given method.
+
+    :param itn_graph: networkx.DiGraph()
+        The graph of ITN
+    :param start_node: string
+        This is the fid of start node in ITN
+    :param end_node: string
+        This is the fid of end node in ITN
+    :param method: string
+        'dijkstra', 'astar' (A* with the straight line walking time as heuristic)
+        or 'bidirectional' (Dijkstra from both ends)
+    :param weight: string or function
+        The weight of edges, see cancellable_weight()
+    :return: list
+        The sequence of fid of nodes constructing the path.
+    """
+    if method == 'dijkstra':
+        return nx.dijkstra_path(itn_graph, source=start_node, target=end_node, weight=weight)
+    elif method == 'astar':
+        return nx.astar_path(itn_graph, start_node, end_node, heuristic=walking_time_heuristic(itn_graph),
+                             weight=weight)
+    elif method == 'bidirectional':
+        return nx.bidirectional_dijkstra(itn_graph, start_node, end_node, weight=weight)[1]
+    raise ValueError('Unknown search method {}, choose one of {}'.format(method, search_methods))
+
+
+def shortest_path(start_node, end_node, walking_speed=default_walking_speed, climb_penalty=default_climb_penalty,
+                  cancel_event=None, method='dijkstra'):
     """Calculate the shortest path between two nodes
 
     :param start_node: string
         This is the fid of start node in ITN
     :param end_node: string
         This is the fid of end node in ITN
+    :param walking_speed: float
+        The walking speed on flat ground; use meter/minute as unit
+    :param climb_penalty: float
+        The meters of climb which cost one additional minute
+    :param cancel_event: threading.Event or None
+        When given, setting this event aborts the search with RouteCancelled
+    :param method: string
+        The search method, one of search_methods; all of them find paths with the same travel time
+    :return: geopandas.GeoDataFrame
+        A GeoDataFrame for the shortest path; repeated requests are answered by the route cache
     """
-    # Parameter settings
-    walking_speed = 5 / 3.6 * 60  # unit: meter/minute
+    network_key = network_cache_key()  # Checks the source files, so routes of changed files are not served
+    profile = (walking_speed, climb_penalty)
+    route = route_cache.get(network_key, start_node, end_node, profile)
+    if route is None or route['geometry'] is None:
+        itn_graph, itn_store = load_itn_graph(walking_speed, climb_penalty)
+        if itn_graph.graph['network_key'] != network_key:  # The graph was rebuilt from changed files
+            network_key, route = itn_graph.graph['network_key'], None
+        if route is None:
+            # Calculate the shortest path
+            weight = "weight" if cancel_event is None else cancellable_weight(cancel_event)
+            settled = set()
+            if active():  # Count the settled nodes only when they are recorded
+                weight = counting_weight(weight, settled)
+            with stage('search'):
+                path = search_path(itn_graph, start_node, end_node, method, weight)
+                count('nodes settled', len(settled))
+            route = {'path': path, 'links': path_links(path, itn_graph),
+                     'travel_time': nx.path_weight(itn_graph, path, 'weight'), 'closed': _closures['links']}
+
+        # Create the GeoDataFrame of the shortest path
+        with stage('path geometry'):
+            route = dict(route, geometry=get_gdf(route['path'], itn_graph, itn_store))
+            count('links', len(route['path']) - 1)
+        route_cache.put(network_key, start_node, end_node, profile, route)
+
+    return route['geometry'].copy()  # The cached GeoDataFrame is shared, callers get their own
+
+
+def batch_shortest_path(start_nodes, end_node, walking_speed=default_walking_speed,
+                        climb_penalty=default_climb_penalty):
+    """Calculate the shortest paths from many start nodes to one end node by a single search.
+    The search runs from the end node over the reversed graph, so every direction of a link keeps
+    its own uphill/downhill weight, and the paths of all start nodes are read from one shortest path tree.
+    The geometries are not built here; pass a path to route_gdf() when it is needed.
+
+    :param start_nodes: list
+        The fid of start nodes in ITN, e.g. the nearest nodes of residents
+    :param end_node: string
+        This is the fid of end node in ITN, e.g. the nearest node of the highest point
+    :param walking_speed: float
+        The walking speed on flat ground; use meter/minute as unit
+    :param climb_penalty: float
+        The meters of climb which cost one additional minute
+    :return: dictionary
+        For each start node, a dictionary with the 'path' (sequence of fid of nodes from the start node
+        to the end node) and the 'travel_time' in minutes; None when the end node can not be reached.
+        The search is skipped when every route is found in the route cache.
+    """
+    network_key = network_cache_key()  # Checks the source files, so routes of changed files are not served
+    profile = (walking_speed, climb_penalty)
+    routes = {}
+    for start_node in start_nodes:
+        route = route_cache.get(network_key, start_node, end_node, profile)
+        if route is not None:
+            routes[start_node] = {'path': route['path'], 'travel_time': route['travel_time']}
+    missing = [start_node for start_node in start_nodes if start_node not in routes]
+    if not missing:
+        return routes
+
+    itn_graph, itn_store = load_itn_graph(walking_speed, climb_penalty)
+    network_key = itn_graph.graph['network_key']  # Changed when the graph was rebuilt from changed files
+
+    # In the reversed graph, the predecessor of a node is the next node on its way to the end node
+    pred, travel_times = nx.dijkstra_predecessor_and_distance(itn_graph.reverse(copy=False), end_node,
+                                                              weight='weight')
+    count('nodes settled', len(travel_times))
+    for start_node in missing:
+        if start_node not in travel_times:
+            routes[start_node] = None
+            continue
+        path = [start_node]
+        while path[-1] != end_node:
+            path.append(pred[path[-1]][0])
+        routes[start_node] = {'path': path, 'travel_time': travel_times[start_node]}
+        route_cache.put(network_key, start_node, end_node, profile,
+                        dict(routes[start_node], links=path_links(path, itn_graph), geometry=None,
+                             closed=_closures['links']))
+    return routes
+
+
+def search_targets(itn_graph, start_node, targets, cancel_event=None):
+    """Dijkstra from the start node which stops as soon as every target is settled,
+    so the search covers no more of the graph than the farthest target needs.
+
+    :param itn_graph: networkx.DiGraph()
+        The graph of ITN
+    :param start_node: string
+        This is the fid of start node in ITN
+    :param targets: iterable
+        The fid of target nodes in ITN
+    :param cancel_event: threading.Event or None
+        When given, setting this event aborts the search with RouteCancelled
+    :return: dictionary
+        For each target reached, a dictionary with the 'path' (sequence of fid of nodes from the start node
+        to the target) and the 'travel_time' in minutes; targets which can not be reached are left out
+    """
+    remaining = set(targets)
+    settled = {}
+    pred = {start_node: None}
+    tentative = {start_node: 0.0}
+    tie_breaker = counter()  # Nodes are never compared when their travel times are equal
+    heap = [(0.0, next(tie_breaker), start_node)]
+    succ = itn_graph.succ
+    while heap and remaining:
+        travel_time, _, u = heapq.heappop(heap)
+        if u in settled:
+            continue
+        settled[u] = travel_time
+        remaining.discard(u)
+        if cancel_event is not None and len(settled) % cancel_check_interval == 0 and cancel_event.is_set():
+            raise RouteCancelled()
+        for v, data in succ[u].items():
+            v_time = travel_time + data['weight']
+            if v not in settled and v_time < tentative.get(v, np.inf):
+                tentative[v] = v_time
+                pred[v] = u
+                heapq.heappush(heap, (v_time, next(tie_breaker), v))
+    count('nodes settled', len(settled))
+
+    routes = {}
+    for target in set(targets) - remaining:
+        path = [target]
+        while path[-1] != start_node:
+            path.append(pred[path[-1]])
+        path.reverse()
+        routes[target] = {'path': path, 'travel_time': settled[target]}
+    return routes
+
+
+def one_to_many_shortest_path(start_node, end_nodes, walking_speed=default_walking_speed,
+                              climb_penalty=default_climb_penalty, cancel_event=None):
+    """Calculate the shortest paths from one start node to many end nodes by a single search,
+    which stops once every end node is settled; see search_targets().
+    The geometries are not built here; pass a path to route_gdf() when it is needed.
+
+    :param start_node: string
+        This is the fid of start node in ITN, e.g. the nearest node of the user
+    :param end_nodes: list
+        The fid of end nodes in ITN, e.g. the nearest nodes of candidate high points
+    :param walking_speed: float
+        The walking speed on flat ground; use meter/minute as unit
+    :param climb_penalty: float
+        The meters of climb which cost one additional minute
+    :param cancel_event: threading.Event or None
+        When given, setting this event aborts the search with RouteCancelled
+    :return: dictionary
+        For each end node, a dictionary with the 'path' and the 'travel_time' in minutes;
+        None when the end node can not be reached. The search is skipped when every route is found
+        in the route cache.
+    """
+    network_key = network_cache_key()  # Checks the source files, so routes of changed files are not served
+    profile = (walking_speed, climb_penalty)
+    routes = {}
+    for end_node in end_nodes:
+        route = route_cache.get(network_key, start_node, end_node, profile)
+        if route is not None:
+            routes[end_node] = {'path': route['path'], 'travel_time': route['travel_time']}
+    missing = [end_node for end_node in end_nodes if end_node not in routes]
+    if not missing:
+        return routes
+
+    itn_graph, itn_store = load_itn_graph(walking_speed, climb_penalty)
+    network_key = itn_graph.graph['network_key']  # Changed when the graph was rebuilt from changed files
+    with stage('search'):
+        found = search_targets(itn_graph, start_node, missing, cancel_event)
+    for end_node in missing:
+        routes[end_node] = found.get(end_node)
+        if end_node in found:
+            route_cache.put(network_key, start_node, end_node, profile,
+                            dict(found[end_node], links=path_links(found[end_node]['path'], itn_graph),
+                                 geometry=None, closed=_closures['links']))
+    return routes
+
+
+def route_gdf(path, walking_speed=default_walking_speed, climb_penalty=default_climb_penalty):
+    """Build the GeoDataFrame of a path returned by batch_shortest_path().
+
+    :param path: list
+        The sequence of fid of nodes constructing the path.
+    :param walking_speed: float
+        The walking speed on flat ground; use meter/minute as unit
+    :param climb_penalty: float
+        The meters of climb which cost one additional minute
+    :return: geopandas.GeoDataFrame
+        A GeoDataFrame for the path
+    """
+    itn_graph, itn_store = load_itn_graph(walking_speed, climb_penalty)
+    return get_gdf(path, itn_graph, itn_store)
+
+
+def check_search_methods(pair_num=100, seed=0):
+    """Check that every search method finds the same travel time as Dijkstra on random pairs of nodes.
+
+    :param pair_num: int
+        The number of random pairs of nodes
+    :param seed: int
+        The seed of random pairs
+    :return: float
+        The largest difference of travel time found; use minute as unit
+    """
+    itn_graph, itn_store = load_itn_graph()
+    nodes = list(itn_graph)
+    random_generator = np.random.default_rng(seed)
+    max_difference = 0.0
+    for start_index, end_index in random_generator.integers(len(nodes), size=(pair_num, 2)):
+        start_node, end_node = nodes[start_index], nodes[end_index]
+        try:
+            travel_time = nx.path_weight(itn_graph, search_path(itn_graph, start_node, end_node), 'weight')
+        except nx.NetworkXNoPath:
+            for method in search_methods[1:]:
+                try:
+                    search_path(itn_graph, start_node, end_node, method)
+                    raise AssertionError('{} found a path between {} and {}'.format(method, start_node, end_node))
+                except nx.NetworkXNoPath:
+                    pass
+            continue
+        for method in search_methods[1:]:
+            path = search_path(itn_graph, start_node, end_node, method)
+            max_difference = max(max_difference, abs(nx.path_weight(itn_graph, path, 'weight') - travel_time))
+    return max_difference
 
-    # Read elevation data
-    elevation = rasterio.open(elevation_path)
-    elevation_mat = elevation.read(1)
-    elevation_para = elevation_para_set(elevation)
 
-    # Create the graph of ITN
-    itn_json_input = open(solent_itn_json_path, 'r')
-    itn_json = json.load(itn_json_input)
-    itn_graph = nx.Graph()
-    road_links = itn_json['roadlinks']
-
-    # Construct the network of ITN.
-    # Calculate the weight of each link in both directions.
-    # The weight of each link depends on its travel time,
-    # which consists of basic walking time and additional time for climb
-    for link in road_links:
-        walking_time_cost = road_links[link]['length'] / walking_speed
-        # Calculate additional time cost for climbing
-        add_time_forward = 0
-        add_time_backward = 0
-        points = road_links[link]['coords']
-        previous_point = points[0]
-        previous_elevation = get_elevation(previous_point, elevation_mat, elevation_para)
-        for point in points[1:]:     # Skip the first point
-            curr_elevation = get_elevation(point, elevation_mat, elevation_para)
-            if curr_elevation > previous_elevation:   # Ascent
-                add_time_forward = add_time_forward + (curr_elevation - previous_elevation)
-            elif curr_elevation < previous_elevation:  # Descent
-                add_time_backward = add_time_backward + (previous_elevation - curr_elevation)
-            previous_elevation = curr_elevation
-
-        # An additional minute is added for every 10 meters of climb
-        time_cost_forward = walking_time_cost + add_time_forward/10
-        time_cost_backward = walking_time_cost + add_time_backward/10
-
-        itn_graph.add_edge(road_links[link]['start'], road_links[link]['end'], fid=link, weight=time_cost_forward)
-        itn_graph.add_edge(road_links[link]['end'], road_links[link]['start'], fid=link, weight=time_cost_backward)
-
-    # Calculate the shortest path
-    path = nx.dijkstra_path(itn_graph, source=start_node, target=end_node, weight="weight")
-
-    # Create the GeoDataFrame of the shortest path
-    shortest_path_gdf = get_gdf(path, itn_graph, itn_json)
-
-    return shortest_path_gdf
+if __name__ == "__main__":
+    # For Unit Test
+    difference = check_search_methods()
+    print('The largest difference of travel time between search methods:', difference)
+    assert difference < 1e-9
@@ -1,99 +1,117 @@
+import math
+import time
+from functools import lru_cache
+
 import numpy as np
 import rasterio
 import rasterio.plot
+from rasterio.enums import Resampling
+from rasterio.windows import Window, from_bounds
 import cartopy.crs as ccrs
-import geopandas as gpd
-import matplotlib.pyplot as plt
-from matplotlib import cm
+import matplotlib
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.cm import ScalarMappable
+from matplotlib.collections import LineCollection
+from matplotlib.colors import Normalize
+from matplotlib.figure import Figure
+from matplotlib.lines import Line2D
+from matplotlib.patches import Polygon
 from mpl_toolkits.axes_grid1.anchored_artists import AnchoredSizeBar
-from shapely.geometry import Polygon
-from shapely.geometry import LineString
 
+from instrumentation import stage
+
+isle_background = "Material/background/raster-50k_2724246.tif"
+figure_size = (5, 5)  # unit: inch
+figure_dpi = 300  # The resolution of exported maps
+screen_dpi = 100  # The resolution of the map shown in the window
+background_cache_size = 16  # The number of rendered background windows kept in memory
 
-def create_north_arrow(display_extent):
-    """Creat a north arrow for the map as a GeoDataFrame
 
-    :param display_extent: list[left, right, bottom, top]
-        The extent displayed on the map, 10km * 10km, whose center is the start point of the shortest path
-    :return: north_arrow_gdf: geopandas.GeoDataFrame
-        A north arrow having suitable size and position for the map
+def add_north_arrow(ax, unit=0.03, offset=(2, 2)):
+    """Draw a north arrow on the top left corner of the map.
+    The arrow is drawn in axes coordinates, so it stays in place whatever extent is displayed.
+
+    :param ax: matplotlib.axes.Axes
+    :param unit: float
+        Unit length for drawing, as a fraction of the axes; 0.03 is 300 m of a 10km * 10km map
+    :param offset: tuple(x, y)
+        The distance from the top left corner in units
     """
-    # Create the north arrow on the top left corner of the map
-    unit = 300  # Unit length for drawing
-    x_offset = 2
-    y_offset = 2
-    nodes = []
-    coordinates = [[1, 3], [0, 0], [1, 1], [2, 0], [1, 3],  # Coordinates of LineString
-                   [1, 3], [2, 0], [1, 1]]                  # Coordinates of Polygon
-    for xy in coordinates:
-        x = xy[0]
-        y = xy[1]
-        min_x = display_extent[0]
-        max_y = display_extent[3]
-
-        # Transform x,y to fit the map
-        x = (x + x_offset) * unit + min_x
-        y = (y - 3 - y_offset) * unit + max_y
-        nodes.append((x, y))
-    # Create the polygon of north arrow and construct GeoDataFrame
-    north_arrow = [LineString(nodes[:5]), Polygon(nodes[5:])]
-    north_arrow_gdf = gpd.GeoDataFrame({"fid": ['1', '2'], "geometry": north_arrow})
-    return north_arrow_gdf
+    def to_axes(points):
+        return [((x + offset[0]) * unit, 1 + (y - 3 - offset[1]) * unit) for x, y in points]
 
+    outline = to_axes([[1, 3], [0, 0], [1, 1], [2, 0], [1, 3]])
+    head = to_axes([[1, 3], [2, 0], [1, 1]])
+    ax.add_line(Line2D(*zip(*outline), transform=ax.transAxes, color='black', linewidth=0.5, zorder=4))
+    ax.add_patch(Polygon(head, closed=True, transform=ax.transAxes, color='black', linewidth=0.5, zorder=4))
+    ax.annotate('N', xy=((0.4 + offset[0]) * unit, 1 - (4.5 + offset[1]) * unit), xycoords='axes fraction')
 
-def map_plot(user_location, highest_point, path_gdf, local_elevation_array, out_transform, clip_mode):
-    """Plot a background map 10km * 10km of the surrounding area with path, buffer, a color-bar showing the elevation
-       range, a north arrow, a scale bar, and a legend for the user location, highest point and the shortest path.
-       Finally it shows a map
 
-    :param user_location: tuple(x, y)
-        Location input by user, which is a xy coordinate pair in CRS of British National Grid
-    :param highest_point: turple(x,y)
-        Location of the highest point identified, which is a xy coordinates pair of the highest point in
-        CRS of British National Grid.
-    :param path_gdf: geopandas.GeoDataFrame
-        A GeoDataFrame for the shortest path
-    :param local_elevation_array:  shapely.geometry.polygon
-        The elevation_array clipped by buffer.
-    :param out_transform:
-            Information for mapping pixel coordinates in masked to another coordinate system.
+def background_bounds(background_path=isle_background):
+    """Get the bounds of the background map without reading its pixels.
+
+    :param background_path: string
+        The path of the background GeoTIFF
+    :return: rasterio.coords.BoundingBox
     """
-    fig = plt.figure(figsize=(5, 5), dpi=300)  # Create the figure for mapping
-    ax = fig.add_subplot(1, 1, 1, projection=ccrs.OSGB())  # Create subplot in figure for mapping
-    ax.set_title(label='Flood Emergency Planning', fontdict={'fontsize': 10})
-
-    # Show background
-    isle_background = "Material/background/raster-50k_2724246.tif"
-    background = rasterio.open(str(isle_background))
-    back_array = background.read(1)
-    palette = np.array([value for key, value in background.colormap(1).items()])
-    background_image = palette[back_array]
-    bounds = background.bounds
-    extent = [bounds.left, bounds.right, bounds.bottom, bounds.top]
-    ax.imshow(background_image, origin="upper", extent=extent, zorder=0)
+    with rasterio.open(background_path) as background:
+        return background.bounds
 
-    # Show elevation in 5km buffer of user's location
-    rasterio.plot.show(source=local_elevation_array, ax=ax, zorder=1,
-                       transform=out_transform, origin="upper", alpha=0.5, cmap=plt.get_cmap('terrain'))
 
-    # Draw color bar
-    norm = cm.colors.Normalize(vmax=np.max(local_elevation_array), vmin=np.min(local_elevation_array))
-    cb = fig.colorbar(cm.ScalarMappable(norm=norm, cmap=plt.get_cmap('terrain')), ax=ax)
-    cb.ax.tick_params(labelsize=6)  # Set the label size of color bar
-    cb.ax.set_ylabel(ylabel='elevation(m)', size=6)  # Set the y_label of color bar
+@lru_cache(maxsize=background_cache_size)
+def render_background(display_extent, pixel_width, pixel_height, background_path=isle_background):
+    """Render the part of the background map covering the display extent.
+    Only the window of the display extent is read, decimated to at most the given pixel size,
+    so the memory used depends on the size of the figure rather than the whole map.
+    The rendered windows are kept in an LRU cache keyed by the extent and the pixel size.
 
-    # Show user's location
-    ax.scatter(user_location[0], user_location[1], marker='*', c='r', zorder=2, label='User Location', s=16)
-    # Show the highest point
-    ax.scatter(highest_point[0], highest_point[1], marker='^', c='g', zorder=2, label='Highest Point', s=10)
+    :param display_extent: tuple(left, right, bottom, top)
+        The extent displayed on the map
+    :param pixel_width: int
+        The width of the figure in pixels
+    :param pixel_height: int
+        The height of the figure in pixels
+    :param background_path: string
+        The path of the background GeoTIFF
+    :return background_image: numpy.ndarray or None
+        The RGB(A) image of the window; None when the extent does not overlap the background
+    :return image_extent: list[left, right, bottom, top]
+        The extent of the image
+    """
+    left, right, bottom, top = display_extent
+    with rasterio.open(background_path) as background:
+        # The window of the display extent, rounded outwards to whole pixels and clipped by the map
+        window = from_bounds(left, bottom, right, top, transform=background.transform)
+        col_start, row_start = max(math.floor(window.col_off), 0), max(math.floor(window.row_off), 0)
+        col_stop = min(math.ceil(window.col_off + window.width), background.width)
+        row_stop = min(math.ceil(window.row_off + window.height), background.height)
+        if col_stop <= col_start or row_stop <= row_start:
+            return None, list(display_extent)
+        window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+        # Decimate the window to the resolution of the figure; palette indexes must not be interpolated
+        factor = max(math.ceil(window.height / pixel_height), math.ceil(window.width / pixel_width), 1)
+        out_shape = (math.ceil(window.height / factor), math.ceil(window.width / factor))
+        back_array = background.read(1, window=window, out_shape=out_shape, resampling=Resampling.nearest)
+        palette = np.array([value for key, value in background.colormap(1).items()], dtype=np.uint8)
+        window_left, window_bottom, window_right, window_top = background.window_bounds(window)
+
+    background_image = palette[back_array]
+    background_image.flags.writeable = False  # The image is shared by the cache
+    return background_image, [window_left, window_right, window_bottom, window_top]
 
-    # Show shortest path
-    path_gdf.plot(ax=ax, edgecolor="blue", linewidth=0.5, zorder=3, label='The Shortest Path')
 
-    # Show legend
-    ax.legend(loc='lower right', prop={'size': 5})
+def display_extent_of(path_gdf, clip_mode, bounds):
+    """Get the extent displayed on the map, 10km * 10km, whose centre is the start point of the shortest path.
 
-    # Set the display extent, whose centre is the start point of the shortest path.
+    :param path_gdf: geopandas.GeoDataFrame
+        A GeoDataFrame for the shortest path
+    :param clip_mode: int
+        1 when user ask for clipping the map exceeding the range of background
+    :param bounds: rasterio.coords.BoundingBox
+        The bounds of the background map
+    :return: list[left, right, bottom, top]
+    """
     # Get the coordinate of start node of shortest path.
     xs, ys = path_gdf["geometry"][0].xy
     left = xs[0] - 5000
@@ -109,18 +127,162 @@ def map_plot(user_location, highest_point, path_gdf, local_elevation_array, out_
             bottom = bounds.bottom
         if top > bounds.top:
             top = bounds.top
-    display_extent = [left, right, bottom, top]
-    ax.set_extent(display_extent, crs=ccrs.OSGB())
+    return [left, right, bottom, top]
+
+
+class MapCanvas:
+    """A map of the surrounding area built once and updated for every request.
+    The static layers (the axes in British National Grid, title, color-bar, scale bar, north arrow and legend)
+    are created here; update() only swaps the data of the per-request artists: the window of the background,
+    the elevation in the buffer, the user location, the highest point and the shortest path.
+    The figure is not tied to any GUI: embed() shows it in a Tk widget, otherwise it is rendered offscreen by Agg.
+    """
+
+    def __init__(self, figsize=figure_size, dpi=figure_dpi, figure=None):
+        """
+        :param figsize: tuple(width, height)
+            The size of the figure; use inch as unit
+        :param dpi: int
+            The resolution of the figure
+        :param figure: matplotlib.figure.Figure or None
+            Draw on an existing figure, e.g. one created by pyplot; None to create one rendered by Agg
+        """
+        if figure is None:
+            figure = Figure(figsize=figsize, dpi=dpi)
+            FigureCanvasAgg(figure)
+        self.figure = figure
+        self.render_time = None  # The seconds taken by the latest update() and draw()
+        ax = figure.add_subplot(1, 1, 1, projection=ccrs.OSGB())  # Create subplot in figure for mapping
+        ax.set_title(label='Flood Emergency Planning', fontdict={'fontsize': 10})
+        self.ax = ax
+
+        # The per-request artists start empty and hidden
+        self.background = ax.imshow(np.zeros((1, 1, 3), dtype=np.uint8), origin="upper", extent=[0, 1, 0, 1],
+                                    zorder=0, visible=False)
+        self.elevation = ax.imshow(np.ma.masked_all((1, 1)), origin="upper", extent=[0, 1, 0, 1], zorder=1,
+                                   alpha=0.5, cmap=matplotlib.colormaps['terrain'], norm=Normalize(0, 1),
+                                   visible=False)
+        self.user_point = ax.scatter([], [], marker='*', c='r', zorder=2, label='User Location', s=16)
+        self.highest_point = ax.scatter([], [], marker='^', c='g', zorder=2, label='Highest Point', s=10)
+        self.path = LineCollection([], colors='blue', linewidths=0.5, zorder=3, label='The Shortest Path')
+        ax.add_collection(self.path, autolim=False)
+
+        # Draw color bar; it shares the norm of the elevation, so it follows the range of the elevation shown
+        cb = figure.colorbar(ScalarMappable(norm=self.elevation.norm, cmap=self.elevation.cmap), ax=ax)
+        cb.ax.tick_params(labelsize=6)  # Set the label size of color bar
+        cb.ax.set_ylabel(ylabel='elevation(m)', size=6)  # Set the y_label of color bar
 
-    # Draw scalar bar
-    scale_bar = AnchoredSizeBar(ax.transData,
-                                size=2000, label='2 km', loc=3, pad=0.5, borderpad=0.5,
-                                color='black', frameon=False, size_vertical=1)
-    ax.add_artist(scale_bar)
+        # Show legend
+        ax.legend(loc='lower right', prop={'size': 5})
 
-    # Draw north arrow
-    north_arrow_gdf = create_north_arrow(display_extent)
-    north_arrow_gdf.plot(ax=ax, color="black", zorder=4, linewidth=0.5)
-    ax.annotate(s='N', xy=(display_extent[0] + 300 * 2.4, display_extent[3] - 300 * 6.5))
+        # Draw scalar bar; its length follows the extent displayed
+        scale_bar = AnchoredSizeBar(ax.transData,
+                                    size=2000, label='2 km', loc=3, pad=0.5, borderpad=0.5,
+                                    color='black', frameon=False, size_vertical=1)
+        ax.add_artist(scale_bar)
+
+        # Draw north arrow
+        add_north_arrow(ax)
+
+    def update(self, user_location, highest_point, path_gdf, local_elevation_array, out_transform, clip_mode):
+        """Show a request on the map: a background map 10km * 10km of the surrounding area with path,
+        buffer, user location and highest point. Nothing is drawn until draw() or save().
+
+        :param user_location: tuple(x, y)
+            Location input by user, which is a xy coordinate pair in CRS of British National Grid
+        :param highest_point: turple(x,y)
+            Location of the highest point identified, which is a xy coordinates pair of the highest point in
+            CRS of British National Grid.
+        :param path_gdf: geopandas.GeoDataFrame
+            A GeoDataFrame for the shortest path
+        :param local_elevation_array: numpy.ma.MaskedArray
+            The elevation_array clipped by buffer.
+        :param out_transform:
+                Information for mapping pixel coordinates in masked to another coordinate system.
+        :param clip_mode: int
+            1 when user ask for clipping the map exceeding the range of background
+        """
+        start_time = time.perf_counter()
+        # Set the display extent, whose centre is the start point of the shortest path.
+        display_extent = display_extent_of(path_gdf, clip_mode, background_bounds())
+
+        # Show the background inside the display extent
+        width, height = self.figure.get_size_inches() * self.figure.dpi
+        with stage('render background'):
+            background_image, image_extent = render_background(tuple(display_extent), int(width), int(height))
+        if background_image is not None:
+            self.background.set_data(background_image)
+            self.background.set_extent(image_extent)
+        self.background.set_visible(background_image is not None)
+
+        # Show elevation in 5km buffer of user's location; the color bar follows its range
+        elevation = local_elevation_array[0]
+        self.elevation.set_data(elevation)
+        self.elevation.set_extent(rasterio.plot.plotting_extent(elevation, out_transform))
+        if elevation.count():
+            self.elevation.set_clim(elevation.min(), elevation.max())
+        self.elevation.set_visible(True)
+
+        # Show user's location, the highest point and the shortest path
+        self.user_point.set_offsets([user_location[:2]])
+        self.highest_point.set_offsets([highest_point[:2]])
+        self.path.set_segments([np.asarray(line.coords)[:, :2] for line in path_gdf['geometry']])
+
+        self.ax.set_extent(display_extent, crs=ccrs.OSGB())
+        self.render_time = time.perf_counter() - start_time
+
+    def draw(self):
+        """Render the figure on its canvas, offscreen by Agg or in the widget given by embed().
+        """
+        start_time = time.perf_counter()
+        with stage('draw map'):
+            self.figure.canvas.draw()
+        self.render_time = (self.render_time or 0.0) + time.perf_counter() - start_time
+
+    def save(self, path):
+        """Render the figure to an image file, e.g. a PNG for printing.
+
+        :param path: string
+        """
+        start_time = time.perf_counter()
+        with stage('save map'):
+            self.figure.savefig(path, dpi=self.figure.dpi)
+        self.render_time = (self.render_time or 0.0) + time.perf_counter() - start_time
+
+    def embed(self, master):
+        """Show the figure in a Tk widget with the navigation toolbar of matplotlib.
+
+        :param master: tkinter widget
+            The parent of the canvas, e.g. a tkinter.Toplevel
+        :return: matplotlib.backends.backend_tkagg.FigureCanvasTkAgg
+        """
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+
+        canvas = FigureCanvasTkAgg(self.figure, master=master)
+        NavigationToolbar2Tk(canvas, master)
+        canvas.get_tk_widget().pack(fill='both', expand=True)
+        return canvas
+
+
+def map_plot(user_location, highest_point, path_gdf, local_elevation_array, out_transform, clip_mode):
+    """Plot the map of a request on a figure of its own and show it in a pyplot window, which blocks
+    until the window is closed; the GUI keeps one MapCanvas instead.
+
+    :param user_location: tuple(x, y)
+        Location input by user, which is a xy coordinate pair in CRS of British National Grid
+    :param highest_point: turple(x,y)
+        Location of the highest point identified in CRS of British National Grid.
+    :param path_gdf: geopandas.GeoDataFrame
+        A GeoDataFrame for the shortest path
+    :param local_elevation_array: numpy.ma.MaskedArray
+        The elevation_array clipped by buffer.
+    :param out_transform:
+            Information for mapping pixel coordinates in masked to another coordinate system.
+    :param clip_mode: int
+        1 when user ask for clipping the map exceeding the range of background
+    """
+    import matplotlib.pyplot as plt
 
+    map_canvas = MapCanvas(figure=plt.figure(figsize=figure_size, dpi=figure_dpi))
+    map_canvas.update(user_location, highest_point, path_gdf, local_elevation_array, out_transform, clip_mode)
     plt.show()  # show the figure
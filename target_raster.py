@@ -0,0 +1,200 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+import shapely
+from scipy.ndimage import maximum_filter1d
+from shapely.geometry import Point
+
+from data_cache import cache_dir, file_signature, temp_path
+from elevation_store import open_elevation
+
+elevation_path = 'Material/elevation/SZ.asc'
+default_radius = 5000  # unit: meter
+tile_height = 256  # The number of rows computed by each task
+
+_target_memo = {}  # The target rasters already opened in this process and their signatures, keyed by path
+
+
+def target_raster_path(radius):
+    """Get the default path of the target raster of the given radius.
+    """
+    return os.path.join(cache_dir, 'evacuation_targets_{}m.tif'.format(int(radius)))
+
+
+def circle_footprint(radius, transform):
+    """Get the cells whose centre is inside the buffer of the centre of a cell, as offsets of rows and cols.
+    The buffer is the same polygon as the one used by identify_highest_point(), so the footprint selects
+    the same cells as its mask for a location at the centre of a cell.
+
+    :param radius: int or float
+        The radius of buffer; use meter as unit
+    :param transform: affine.Affine
+        The transform of the elevation
+    :return: list
+        tuple(row_offset, col_first, col_last) for each row of the footprint
+    """
+    bf = Point(0, 0).buffer(radius)
+    row_reach = int(np.ceil(radius / abs(transform.e))) + 1
+    col_reach = int(np.ceil(radius / abs(transform.a))) + 1
+    col_offsets = np.arange(-col_reach, col_reach + 1)
+    footprint = []
+    for row_offset in range(-row_reach, row_reach + 1):
+        inside = shapely.contains_xy(bf, col_offsets * transform.a,
+                                     np.full(col_offsets.shape, row_offset * transform.e))
+        if inside.any():
+            cols = col_offsets[inside]
+            footprint.append((row_offset, int(cols.min()), int(cols.max())))
+    return footprint
+
+
+def focal_max_tile(task):
+    """Compute the focal maximum of the keys for a tile of rows; this runs in worker processes.
+    The circular footprint is split into rows, and each row is a running maximum along the cols.
+
+    :param task: tuple(keys_path, row_start, row_stop, footprint)
+    :return: tuple(row_start, numpy.ndarray)
+        The largest key inside the footprint of each cell of the tile
+    """
+    keys_path, row_start, row_stop, footprint = task
+    keys = np.load(keys_path, mmap_mode='r')
+    height, width = keys.shape
+    tile_max = np.full((row_stop - row_start, width), -1, dtype=np.int64)
+    for row_offset, col_first, col_last in footprint:
+        # The rows of source cells which are inside the raster
+        source_start, source_stop = max(row_start + row_offset, 0), min(row_stop + row_offset, height)
+        if source_start >= source_stop:
+            continue
+        size = col_last - col_first + 1
+        row_max = maximum_filter1d(keys[source_start:source_stop], size, axis=1, mode='constant', cval=-1)
+        # maximum_filter1d covers cols [col - size // 2, col - size // 2 + size - 1]; shift it to the footprint
+        shift = col_first + size // 2
+        shifted = np.full(row_max.shape, -1, dtype=np.int64)
+        if shift >= 0:
+            shifted[:, :width - shift] = row_max[:, shift:]
+        else:
+            shifted[:, -shift:] = row_max[:, :width + shift]
+        target_rows = slice(source_start - row_offset - row_start, source_stop - row_offset - row_start)
+        np.maximum(tile_max[target_rows], shifted, out=tile_max[target_rows])
+    return row_start, tile_max
+
+
+def build_target_raster(radius=default_radius, output_path=None, processes=None):
+    """Precompute, for every cell of the elevation, the highest point within the radius of its centre,
+    and write the x, y and elevation of that point as a 3 band GeoTIFF.
+    The maximum is found with the same tie-break as identify_highest_point() (first occurrence row by row)
+    by encoding each cell as key = rank of elevation * cell number + (cell number - 1 - flat index).
+
+    :param radius: int or float
+        The radius of buffer; use meter as unit
+    :param output_path: string or None
+        The path of the GeoTIFF; None for target_raster_path(radius)
+    :param processes: int or None
+        The number of worker processes; None for the number of cores
+    :return: string
+        The path of the GeoTIFF
+    """
+    if output_path is None:
+        output_path = target_raster_path(radius)
+    elevation = open_elevation(elevation_path)
+    values = elevation.read(1, masked=True)
+    height, width = values.shape
+    cell_num = values.size
+
+    # Encode elevation and position in one integer, so that a running maximum also finds the first occurrence
+    valid = ~np.ma.getmaskarray(values)
+    unique_values, ranks = np.unique(values.data[valid], return_inverse=True)
+    keys = np.full(values.shape, -1, dtype=np.int64)
+    keys[valid] = ranks * cell_num + (cell_num - 1 - np.flatnonzero(valid))
+    os.makedirs(cache_dir, exist_ok=True)
+    # The keys are written to a file of this build, so builds for several radii can run at the same time
+    keys_path = temp_path(os.path.join(cache_dir, 'evacuation_target_keys.npy'))
+    try:
+        with open(keys_path, 'wb') as f:
+            np.save(f, keys)
+
+        footprint = circle_footprint(radius, elevation.transform)
+        tasks = [(keys_path, row_start, min(row_start + tile_height, height), footprint)
+                 for row_start in range(0, height, tile_height)]
+        max_keys = np.empty(values.shape, dtype=np.int64)
+        with ProcessPoolExecutor(processes) as executor:
+            for row_start, tile_max in executor.map(focal_max_tile, tasks):
+                max_keys[row_start:row_start + tile_max.shape[0]] = tile_max
+    finally:
+        os.remove(keys_path)
+
+    # Decode the keys to the position and elevation of the target
+    found = max_keys >= 0
+    target_index = cell_num - 1 - max_keys[found] % cell_num
+    target_rows, target_cols = np.divmod(target_index, width)
+    targets = np.full((3, height, width), np.nan)
+    targets[0][found], targets[1][found] = elevation.transform * (target_cols + 0.5, target_rows + 0.5)
+    targets[2][found] = unique_values[max_keys[found] // cell_num]
+
+    profile = {'driver': 'GTiff', 'width': width, 'height': height, 'count': 3, 'dtype': 'float64',
+               'crs': elevation.crs, 'transform': elevation.transform, 'nodata': np.nan,
+               'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'deflate'}
+    # Write to a temporary file first, so lookup_target() never opens a half written raster
+    tmp_path = temp_path(output_path)
+    try:
+        with rasterio.open(tmp_path, 'w', **profile) as target_raster:
+            target_raster.write(targets)
+            target_raster.descriptions = ('target_x', 'target_y', 'target_elevation')
+            target_raster.update_tags(radius=radius, source=json.dumps(list(file_signature(elevation_path))))
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):  # Writing failed
+            os.remove(tmp_path)
+    return output_path
+
+
+def lookup_target(location, radius=default_radius, path=None):
+    """Look up the highest point within the radius of the given location from the target raster.
+    The result is the highest point of the centre of the cell containing the location.
+
+    :param location: tuple(x, y)
+        The location in CRS of British National Grid
+    :param radius: int or float
+        The radius of buffer; use meter as unit
+    :param path: string or None
+        The path of the target raster; None for target_raster_path(radius)
+    :return: tuple(x, y, elevation) or None
+        None when the raster does not exist, was built from another elevation file,
+        or the location is outside it
+    """
+    if path is None:
+        path = target_raster_path(radius)
+    if not os.path.exists(path):
+        return None
+    # Reopen the raster when it has been rebuilt or the elevation has changed since it was opened
+    signature = (file_signature(path), file_signature(elevation_path))
+    if path in _target_memo and _target_memo[path][0] != signature:
+        _target_memo.pop(path)[1].close()
+    if path not in _target_memo:
+        target_raster = rasterio.open(path)
+        tags = target_raster.tags()
+        if float(tags['radius']) != radius or json.loads(tags['source']) != list(signature[1]):
+            target_raster.close()
+            return None
+        _target_memo[path] = (signature, target_raster)
+    target_raster = _target_memo[path][1]
+
+    row, col = target_raster.index(location[0], location[1])
+    if not (0 <= row < target_raster.height and 0 <= col < target_raster.width):
+        return None
+    x, y, elevation = target_raster.read(window=((row, row + 1), (col, col + 1)))[:, 0, 0]
+    if np.isnan(elevation):
+        return None
+    return float(x), float(y), float(elevation)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute the highest point within the radius of every cell.')
+    parser.add_argument('--radius', type=float, default=default_radius, help='radius of the search in meters')
+    parser.add_argument('--processes', type=int, help='number of worker processes')
+    parser.add_argument('-o', '--output', help='path of the GeoTIFF')
+    args = parser.parse_args()
+    print(build_target_raster(args.radius, args.output, args.processes))